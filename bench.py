@@ -0,0 +1,403 @@
+# --- START OF FILE bench.py ---
+# Oflayn yuklama testi: Gemini/Pollinations o'rniga lokal mock serverlar, Telegram o'rniga soxta klient.
+# Ishlatish: python bench.py --scenario group --messages 2000 --latency 0.3 --json bench_output.txt
+
+import argparse
+import asyncio
+import contextlib
+import importlib
+import io
+import itertools
+import json
+import logging
+import os
+import random
+import resource
+import shutil
+import socket
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import Counter
+from types import SimpleNamespace
+
+OWNER_ID = 100
+BOT_DIR = os.path.dirname(os.path.abspath(__file__))
+PROMPTS = ["salom", "qalaysan", "bugun ob-havo qanday", "menga she'r yozib ber", "python nima", "kim g'olib bo'ldi",
+           "nima gaplar", "kitob tavsiya qil", "yaxshi dam oldingmi", "rahmat"]
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def percentiles(values, *quantiles):
+    values = sorted(values)
+    if not values:
+        return [0.0] * len(quantiles)
+    return [values[min(len(values) - 1, int(q * len(values)))] for q in quantiles]
+
+def read_proc_io():
+    """Linuxda jarayonning fayl I/O hisoblagichlari; boshqa tizimlarda bo'sh lug'at."""
+    try:
+        with open("/proc/self/io") as f:
+            return {key: int(value) for key, value in (line.split(":") for line in f)}
+    except OSError:
+        return {}
+
+class MockUpstream:
+    """:generateContent, :streamGenerateContent va Pollinations rasm endpointini taqlid qiluvchi HTTP/1.1 server.
+    Har bir javob latency + [0, jitter] kutadi; error_rate ulushi 500, rate_limit_rate ulushi 429 qaytaradi."""
+
+    def __init__(self, latency, jitter, error_rate, rate_limit_rate, stream_chunks, reply_words):
+        self.latency, self.jitter = latency, jitter
+        self.error_rate, self.rate_limit_rate = error_rate, rate_limit_rate
+        self.stream_chunks, self.reply_words = stream_chunks, reply_words
+        self.requests = Counter()
+        self.statuses = Counter()
+        self.image = self._make_image()
+
+    @staticmethod
+    def _make_image():
+        from PIL import Image
+        buffer = io.BytesIO()
+        Image.effect_noise((1024, 1024), 64).convert("RGB").save(buffer, "JPEG", quality=95)
+        return buffer.getvalue()
+
+    def _reply_text(self):
+        return " ".join(random.choice(PROMPTS) for _ in range(self.reply_words))
+
+    async def handle(self, reader, writer):
+        try:
+            while request_line := await reader.readline():
+                method, target, _ = request_line.decode().split(" ", 2)
+                headers = {}
+                while (line := await reader.readline()).strip():
+                    name, value = line.decode().split(":", 1)
+                    headers[name.strip().lower()] = value.strip()
+                await reader.readexactly(int(headers.get("content-length", 0)))
+                await self.respond(writer, method, target.split("?", 1)[0])
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    def _write(self, writer, status, body, content_type="application/json", extra=""):
+        self.statuses[status] += 1
+        writer.write(f"HTTP/1.1 {status} X\r\nContent-Type: {content_type}\r\nContent-Length: {len(body)}\r\n{extra}\r\n".encode() + body)
+
+    async def respond(self, writer, method, path):
+        endpoint = "pollinations" if "/prompt/" in path else path.rsplit(":", 1)[-1] if ":" in path else path
+        self.requests[endpoint] += 1
+        await asyncio.sleep(self.latency + random.uniform(0, self.jitter))
+        roll = random.random()
+        if roll < self.error_rate:
+            self._write(writer, 500, b'{"error": {"code": 500, "message": "mock"}}')
+        elif roll < self.error_rate + self.rate_limit_rate:
+            self._write(writer, 429, b'{"error": {"code": 429}}', extra="Retry-After: 1\r\n")
+        elif endpoint == "generateContent":
+            body = {"candidates": [{"content": {"parts": [{"text": self._reply_text()}], "role": "model"}}]}
+            self._write(writer, 200, json.dumps(body).encode())
+        elif endpoint == "streamGenerateContent":
+            self.statuses[200] += 1
+            writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nTransfer-Encoding: chunked\r\n\r\n")
+            for _ in range(self.stream_chunks):
+                event = {"candidates": [{"content": {"parts": [{"text": self._reply_text() + " "}], "role": "model"}}]}
+                data = f"data: {json.dumps(event)}\r\n\r\n".encode()
+                writer.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+                await writer.drain()
+                await asyncio.sleep(self.latency / max(self.stream_chunks, 1))
+            writer.write(b"0\r\n\r\n")
+        elif endpoint == "pollinations":
+            self._write(writer, 200, self.image, content_type="image/jpeg")
+        else:
+            self._write(writer, 404, b'{"error": {"code": 404}}')
+        await writer.drain()
+
+class FakeMessage:
+    _ids = itertools.count(10_000_000)
+
+    def __init__(self, client, chat_id, text="", reply_to=None):
+        self.client, self.chat_id, self.text, self.reply_to_msg_id = client, chat_id, text, reply_to
+        self.id = next(self._ids)
+        self.out, self.photo = True, None
+
+    async def edit(self, text, **kwargs):
+        await self.client.rpc("edit")
+        self.text = text
+        return self
+
+    async def delete(self):
+        await self.client.rpc("delete")
+
+class FakeClient:
+    """TelegramClient o'rniga: har bir chaqiruvni sanaydi va rpc_latency kutadi."""
+
+    def __init__(self, rpc_latency):
+        self.rpc_latency = rpc_latency
+        self.calls = Counter()
+
+    async def rpc(self, name):
+        self.calls[name] += 1
+        if self.rpc_latency:
+            await asyncio.sleep(self.rpc_latency)
+
+    async def send_message(self, chat_id, text, reply_to=None, **kwargs):
+        await self.rpc("send_message")
+        return FakeMessage(self, chat_id, text, reply_to)
+
+    async def send_file(self, chat_id, file=None, reply_to=None, **kwargs):
+        await self.rpc("send_file")
+        return FakeMessage(self, chat_id, kwargs.get("caption", ""), reply_to)
+
+    async def delete_messages(self, chat_id, ids, **kwargs):
+        await self.rpc("delete_messages")
+        return []
+
+    async def get_entity(self, entity):
+        await self.rpc("get_entity")
+        if isinstance(entity, list):
+            return [SimpleNamespace(id=item, title=f"Guruh {item}") for item in entity]
+        return SimpleNamespace(id=entity, title=f"Guruh {entity}", first_name="Bench", bot=False)
+
+    async def iter_messages(self, *args, **kwargs):
+        self.calls["iter_messages"] += 1
+        return
+        yield
+
+    async def iter_dialogs(self, *args, **kwargs):
+        self.calls["iter_dialogs"] += 1
+        return
+        yield
+
+    @contextlib.asynccontextmanager
+    async def action(self, chat_id, action):
+        self.calls["action"] += 1
+        yield
+
+class FakeEvent:
+    """my_event_handler ishlatadigan NewMessage maydonlarining minimal to'plami."""
+    _ids = itertools.count(1)
+
+    def __init__(self, client, chat_id, sender_id, text, reply_to_msg_id=None, is_group=True):
+        self.client, self.chat_id, self.sender_id, self.text = client, chat_id, sender_id, text
+        self.raw_text = text
+        self.is_group, self.is_private, self.is_channel = is_group, not is_group, is_group
+        self.out = sender_id == OWNER_ID
+        self.message = SimpleNamespace(id=next(self._ids), reply_to_msg_id=reply_to_msg_id, text=text, voice=None, media=None, file=None)
+        self.sender = SimpleNamespace(id=sender_id, bot=False, first_name=f"user{sender_id}", username=None)
+        self.chat = SimpleNamespace(id=chat_id, title=f"Guruh {chat_id}") if is_group else self.sender
+
+    async def reply(self, text, **kwargs):
+        return await self.client.send_message(self.chat_id, text, reply_to=self.message.id)
+
+    async def get_sender(self):
+        await self.client.rpc("get_sender")
+        return self.sender
+
+    async def get_reply_message(self):
+        await self.client.rpc("get_reply_message")
+        return None
+
+    async def delete(self):
+        await self.client.rpc("delete")
+
+def build_traffic(client, args, own_ids):
+    """Ssenariy bo'yicha sintetik xabarlar ro'yxati."""
+    groups = list(own_ids)
+    events = []
+    for i in range(args.messages):
+        if args.scenario == "commands":
+            kind = random.choice([".ai", ".ai", ".ai", ".pic", ".help"])
+            text = f"{kind} {random.choice(PROMPTS)} {i % args.unique_prompts}" if kind != ".help" else kind
+            events.append(FakeEvent(client, OWNER_ID, OWNER_ID, text, is_group=False))
+        else:
+            chat_id = groups[0] if args.scenario == "burst" else random.choice(groups)
+            sender_id = 1000 + random.randrange(args.users)
+            reply_to = random.choice(own_ids[chat_id]) if random.random() < args.reply_ratio else None
+            events.append(FakeEvent(client, chat_id, sender_id, random.choice(PROMPTS), reply_to_msg_id=reply_to))
+    return events
+
+def prepare_environment(args, workdir, port):
+    base = f"http://127.0.0.1:{port}"
+    os.environ.update({
+        "API_ID": "1", "API_HASH": "bench", "GEMINI_API_KEY": "bench-key", "MY_TELEGRAM_ID": str(OWNER_ID),
+        "SESSION_NAME": os.path.join(workdir, "bench_session"),
+        "GEMINI_API_ROOT": f"{base}/v1beta", "POLLINATIONS_IMAGE_API_BASE_URL": f"{base}/prompt/",
+        "GEMINI_STREAMING": "1" if args.streaming else "0",
+    })
+    if not args.real_limits:
+        for name in ["GEMINI_REQUESTS_PER_MINUTE", "POLLINATIONS_REQUESTS_PER_MINUTE", "CHAT_REPLIES_PER_MINUTE"]:
+            os.environ.setdefault(name, "1000000")
+        for name in ["GEMINI_BURST", "POLLINATIONS_BURST", "CHAT_REPLY_BURST", "TELEGRAM_SEND_BURST"]:
+            os.environ.setdefault(name, "100000")
+        os.environ.setdefault("TELEGRAM_SENDS_PER_SECOND", "1000000")
+    if os.path.exists(os.path.join(BOT_DIR, "persona.json")):
+        shutil.copy(os.path.join(BOT_DIR, "persona.json"), workdir)
+
+async def wait_idle(bot, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        # Debounce oynasidagi partiyalar hali rejalashtiruvchiga tushmagan: ular ham kutiladi
+        if bot.auto_debouncer.pending == 0 and bot.scheduler.active == 0 and all(lane.queued == 0 for lane in bot.scheduler.lanes):
+            return True
+        await asyncio.sleep(0.05)
+    return False
+
+async def run_benchmark(bot, args, upstream, port):
+    server = await asyncio.start_server(upstream.handle, "127.0.0.1", port)
+    client = FakeClient(args.rpc_latency)
+    bot.client = client
+    bot.config.load()
+    bot.startup_ready.set()
+    bot.config.update(auto_reply_enabled=True, allow_all_users=True)
+    own_ids = {}
+    for chat_id in range(-1001000000001, -1001000000001 - args.groups, -1):
+        bot.config.add_active(chat_id)
+        own_ids[chat_id] = [FakeMessage(client, chat_id).id for _ in range(50)]
+        for message_id in own_ids[chat_id]:
+            bot.own_messages.add(chat_id, message_id)
+        bot.own_messages.warm_chats.add(chat_id)
+
+    # Navbatga qo'yilgandan bajarilguncha bo'lgan umumiy kechikish
+    e2e = []
+    submit = bot.scheduler.submit
+    def timed_submit(lane, chat_id, job):
+        queued_at = time.perf_counter()
+        async def wrapped():
+            try:
+                await job()
+            finally:
+                e2e.append(time.perf_counter() - queued_at)
+        return submit(lane, chat_id, wrapped)
+    bot.scheduler.submit = timed_submit
+
+    background = [asyncio.create_task(coro) for coro in (bot.history_cache.run(), bot.limiter.run(), bot.reply_index.run())]
+    events = build_traffic(client, args, own_ids)
+    opens = Counter()
+    sys.addaudithook(lambda name, _: opens.update([name]) if name == "open" else None)
+    io_before, rss_before = read_proc_io(), resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    opens_before = opens["open"]
+    tracemalloc.start()
+
+    start = time.perf_counter()
+    for i, event in enumerate(events):
+        await bot.my_event_handler(event)
+        if args.rate:
+            await asyncio.sleep(max(0.0, start + (i + 1) / args.rate - time.perf_counter()))
+        elif i % 100 == 0:
+            await asyncio.sleep(0)
+    fed = time.perf_counter() - start
+    idle = await wait_idle(bot, args.timeout)
+    elapsed = time.perf_counter() - start
+
+    _, traced_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    io_after = read_proc_io()
+    await bot.history_cache.flush()
+    await bot.reply_index.flush()
+    for task in background:
+        task.cancel()
+    await asyncio.gather(*background, return_exceptions=True)
+    await bot.scheduler.close()
+    await bot.history_cache.close()
+    await bot.reply_index.close()
+    await bot.close_http_clients()
+    bot.shutdown_image_executor()
+    server.close()
+
+    p50, p95, p99 = percentiles(e2e, 0.5, 0.95, 0.99)
+    return {
+        "scenario": args.scenario, "messages": len(events), "completed_jobs": len(e2e), "drained": idle,
+        "feed_seconds": round(fed, 3), "elapsed_seconds": round(elapsed, 3),
+        "messages_per_second": round(len(events) / elapsed, 1) if elapsed else 0.0,
+        "jobs_per_second": round(len(e2e) / elapsed, 1) if elapsed else 0.0,
+        "end_to_end_ms": {"p50": round(p50 * 1000, 1), "p95": round(p95 * 1000, 1), "p99": round(p99 * 1000, 1)},
+        "metrics": bot.metrics.snapshot(),
+        "memory": {"traced_peak_kb": traced_peak // 1024,
+                   "max_rss_growth_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before},
+        "file_io": {"opens": opens["open"] - opens_before,
+                    **{key: io_after[key] - io_before.get(key, 0) for key in ("syscr", "syscw", "read_bytes", "write_bytes") if key in io_after}},
+        "telegram_calls": dict(client.calls), "upstream_requests": dict(upstream.requests),
+        "upstream_statuses": dict(upstream.statuses), "scheduler": bot.scheduler.stats(), "limits": bot.limiter.stats(),
+    }
+
+class HandlerErrors(logging.Handler):
+    """Handlerlar ichida ushlanib logga yozilgan xatolar (my_event_handler va rejalashtiruvchi ishlari). Ular
+    benchmarkni buzmaydi, lekin o'lchovni ma'nosiz qiladi, shuning uchun hisobotdan keyin xato bilan chiqiladi."""
+
+    def __init__(self):
+        super().__init__(logging.ERROR)
+        self.records = []
+
+    def emit(self, record):
+        if record.funcName in ("my_event_handler", "_run"):
+            self.records.append(record)
+
+def print_report(report):
+    print(f"\n=== {report['scenario']}: {report['messages']} xabar, {report['elapsed_seconds']} s"
+          f"{'' if report['drained'] else ' (navbat tugamadi!)'} ===")
+    print(f"Xabar/s: {report['messages_per_second']}, bajarilgan ish/s: {report['jobs_per_second']}")
+    e2e = report["end_to_end_ms"]
+    print(f"Navbat+bajarish: p50 {e2e['p50']} / p95 {e2e['p95']} / p99 {e2e['p99']} ms")
+    for name, st in report["metrics"].items():
+        outcomes = ", ".join(f"{outcome}: {count}" for outcome, count in st["outcomes"].items())
+        print(f"  {name:<28} {st['count']:>6} ta  p50 {st['p50'] * 1000:>8.1f}  p95 {st['p95'] * 1000:>8.1f}  p99 {st['p99'] * 1000:>8.1f} ms  ({outcomes})")
+    print(f"Xotira: {report['memory']}")
+    print(f"Fayl I/O: {report['file_io']}")
+    print(f"Telegram chaqiruvlari: {report['telegram_calls']}")
+    print(f"Upstream: {report['upstream_requests']} {report['upstream_statuses']}")
+
+def main():
+    parser = argparse.ArgumentParser(description="bot.py uchun oflayn benchmark")
+    parser.add_argument("--scenario", choices=["commands", "group", "burst"], default="group")
+    parser.add_argument("--messages", type=int, default=1000)
+    parser.add_argument("--rate", type=float, default=0, help="xabar/s; 0 - imkon qadar tez")
+    parser.add_argument("--groups", type=int, default=5)
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--reply-ratio", type=float, default=0.2, help="bot xabariga reply ulushi")
+    parser.add_argument("--unique-prompts", type=int, default=50)
+    parser.add_argument("--latency", type=float, default=0.2, help="upstream javob kechikishi, s")
+    parser.add_argument("--jitter", type=float, default=0.1)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0)
+    parser.add_argument("--stream-chunks", type=int, default=5)
+    parser.add_argument("--reply-words", type=int, default=20)
+    parser.add_argument("--rpc-latency", type=float, default=0.01, help="soxta Telegram RPC kechikishi, s")
+    parser.add_argument("--streaming", action="store_true")
+    parser.add_argument("--real-limits", action="store_true", help="rate limitlarni .env/standart qiymatlarda qoldirish")
+    parser.add_argument("--timeout", type=float, default=300)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", help="hisobotni shu faylga yozish")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    json_path = os.path.abspath(args.json) if args.json else None
+    workdir = tempfile.mkdtemp(prefix="tg-bench-")
+    port = free_port()
+    prepare_environment(args, workdir, port)
+    sys.path.insert(0, BOT_DIR)
+    os.chdir(workdir)  # bot ma'lumot fayllari (sozlamalar, tarix, indeks, keshlar) vaqtinchalik papkada
+    handler_errors = HandlerErrors()
+    logging.getLogger().addHandler(handler_errors)
+    try:
+        bot = importlib.import_module("bot")
+        upstream = MockUpstream(args.latency, args.jitter, args.error_rate, args.rate_limit_rate, args.stream_chunks, args.reply_words)
+        report = asyncio.run(run_benchmark(bot, args, upstream, port))
+    finally:
+        os.chdir(BOT_DIR)
+        shutil.rmtree(workdir, ignore_errors=True)
+    print_report(report)
+    if json_path:
+        with open(json_path, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    if handler_errors.records:
+        first = handler_errors.records[0]
+        sys.exit(f"\n{len(handler_errors.records)} ta handler xatosi, natijalar ishonchsiz. Birinchisi: {first.getMessage()}\n"
+                 + (logging.Formatter().formatException(first.exc_info) if first.exc_info else ""))
+
+if __name__ == "__main__":
+    main()
@@ -1,22 +1,32 @@
 # --- START OF FILE bot.py ---
 
+import abc
 import asyncio
+import base64
+import bisect
+import concurrent.futures
+import contextlib
+import functools
+import hashlib
 import httpx
 import json
 import time
-import io
 import logging
+import multiprocessing
 import os
 import textwrap
-import pytz
 import random
 import re
+import sqlite3
+import tempfile
+import threading
+from collections import OrderedDict, deque
 from datetime import datetime
-from telethon import TelegramClient, events
+from telethon import TelegramClient, errors, events
 from telethon.tl.types import Message
 from telethon.tl.types import InputMediaDice
-from PIL import Image
 from dotenv import load_dotenv
+from media_workers import convert_voice, recompress_image
 from urllib.parse import quote
 
 # .env faylini yuklash
@@ -28,9 +38,14 @@ api_hash = os.environ.get("API_HASH")
 session_name = os.environ.get("SESSION_NAME", "suii_userbot_session")
 gemini_api_key = os.environ.get("GEMINI_API_KEY")
 my_telegram_id = int(os.environ.get("MY_TELEGRAM_ID", 0))
+# Akkauntga tegishli fayllar papkasi (runtime.py har bir akkauntga alohida papka beradi)
+BOT_DATA_DIR = os.environ.get("BOT_DATA_DIR", "")
+
+def data_path(name):
+    return os.path.join(BOT_DATA_DIR, name)
 
 # Pollinations.ai (Image) API endpoint
-POLLINATIONS_IMAGE_API_BASE_URL = "https://image.pollinations.ai/prompt/"
+POLLINATIONS_IMAGE_API_BASE_URL = os.environ.get("POLLINATIONS_IMAGE_API_BASE_URL", "https://image.pollinations.ai/prompt/")
 POLLINATIONS_IMAGE_MODEL = "flux"
 
 # Logging konfiguratsiyasi
@@ -40,12 +55,40 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(
 client = TelegramClient(session_name, api_id, api_hash)
 
 # Gemini API endpoint (base)
-GEMINI_BASE_API_URL = "https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-flash"
+GEMINI_API_ROOT = os.environ.get("GEMINI_API_ROOT", "https://generativelanguage.googleapis.com/v1beta")
+GEMINI_MODEL = "gemini-2.0-flash"
+GEMINI_BASE_API_URL = f"{GEMINI_API_ROOT}/models/{GEMINI_MODEL}"
+GEMINI_GENERATION_CONFIG = {"temperature": 1, "maxOutputTokens": 4096, "topP": 0.95}
+GEMINI_SAFETY_SETTINGS = [{"category": c, "threshold": "BLOCK_NONE"} for c in ["HARM_CATEGORY_HATE_SPEECH", "HARM_CATEGORY_DANGEROUS_CONTENT", "HARM_CATEGORY_SEXUALLY_EXPLICIT", "HARM_CATEGORY_HARASSMENT"]]
+GEMINI_TOOLS = [{"googleSearch": {}}]
+# Zaxira model: asosiy model circuit breaker tomonidan yopilsa yoki urinishlar tugasa ishlatiladi (bo'sh - o'chirilgan)
+GEMINI_FALLBACK_MODEL = os.environ.get("GEMINI_FALLBACK_MODEL", "")
+GEMINI_FALLBACK_API_URL = os.environ.get("GEMINI_FALLBACK_API_URL", f"{GEMINI_API_ROOT}/models/{GEMINI_FALLBACK_MODEL}" if GEMINI_FALLBACK_MODEL else "")
+# .ai javoblarini oqim bilan ko'rsatish: placeholder xabar har GEMINI_STREAM_EDIT_INTERVAL soniyada tahrirlanadi
+GEMINI_STREAMING = os.environ.get("GEMINI_STREAMING", "1") == "1"
+GEMINI_STREAM_EDIT_INTERVAL = float(os.environ.get("GEMINI_STREAM_EDIT_INTERVAL", 1.5))
+# Persona prefiksini Gemini cachedContents ga yuklash (kesh faqat versiyalangan model bilan ishlaydi)
+GEMINI_CONTEXT_CACHE = os.environ.get("GEMINI_CONTEXT_CACHE", "0") == "1"
+GEMINI_CONTEXT_CACHE_TTL = int(os.environ.get("GEMINI_CONTEXT_CACHE_TTL", 3600))
+GEMINI_CACHE_MODEL = os.environ.get("GEMINI_CACHE_MODEL", "gemini-2.0-flash-001")
 MAX_MESSAGE_LENGTH = 4096
 DEFAULT_SLEEP_TIME = 60
 
-# Sozlamalar fayli
-SETTINGS_FILE = "bot_settings.json"
+# HTTP klientlar: har bir upstream uchun bitta uzoq yashovchi connection pool
+HTTP_MAX_CONNECTIONS = int(os.environ.get("HTTP_MAX_CONNECTIONS", 20))
+HTTP_MAX_KEEPALIVE = int(os.environ.get("HTTP_MAX_KEEPALIVE", 10))
+HTTP_KEEPALIVE_EXPIRY = float(os.environ.get("HTTP_KEEPALIVE_EXPIRY", 60))
+HTTP_CONNECT_TIMEOUT = float(os.environ.get("HTTP_CONNECT_TIMEOUT", 10))
+HTTP2_ENABLED = os.environ.get("HTTP2_ENABLED", "0") == "1"
+HTTP_UPSTREAM_TIMEOUTS = {
+    "gemini": float(os.environ.get("GEMINI_TIMEOUT", 120)),
+    "pollinations": float(os.environ.get("POLLINATIONS_TIMEOUT", 120)),
+}
+
+# Sozlamalar va faol guruhlar fayllari
+SETTINGS_FILE = data_path("bot_settings.json")
+ACTIVE_GROUPS_FILE = data_path("active_groups.json")
+CONFIG_RELOAD_INTERVAL = float(os.environ.get("CONFIG_RELOAD_INTERVAL", 5))
 
 # Standart sozlamalar
 default_settings = {
@@ -54,37 +97,530 @@ default_settings = {
     "online_mode": False,
 }
 
-# Anti-flood uchun lug'at (user_id: last_reply_timestamp)
-user_reply_cooldown = {}
+# Anti-flood va upstream kvotalari: kalit bo'yicha token bucketlar (soniyadagi tezlik, maksimal zaxira)
 COOLDOWN_SECONDS = 3 
+RATE_LIMITS = {
+    "user": (1 / COOLDOWN_SECONDS, 1),
+    "chat": (float(os.environ.get("CHAT_REPLIES_PER_MINUTE", 20)) / 60, int(os.environ.get("CHAT_REPLY_BURST", 5))),
+    "gemini": (float(os.environ.get("GEMINI_REQUESTS_PER_MINUTE", 60)) / 60, int(os.environ.get("GEMINI_BURST", 10))),
+    "pollinations": (float(os.environ.get("POLLINATIONS_REQUESTS_PER_MINUTE", 10)) / 60, int(os.environ.get("POLLINATIONS_BURST", 3))),
+    "telegram": (float(os.environ.get("TELEGRAM_SENDS_PER_SECOND", 5)), int(os.environ.get("TELEGRAM_SEND_BURST", 10))),
+}
+RATE_LIMIT_IDLE_SECONDS = float(os.environ.get("RATE_LIMIT_IDLE_SECONDS", 600))
+GEMINI_MAX_WAIT = float(os.environ.get("GEMINI_MAX_WAIT", 20))
+AUTO_REPLY_MAX_WAIT = float(os.environ.get("AUTO_REPLY_MAX_WAIT", 5))
+POLLINATIONS_MAX_WAIT = float(os.environ.get("POLLINATIONS_MAX_WAIT", 30))
+TELEGRAM_MAX_WAIT = float(os.environ.get("TELEGRAM_MAX_WAIT", 30))
+
+# Metrikalar: handler va upstream chaqiruvlari uchun latency gistogrammalari, natija hisoblagichlari va in-flight gauge
+METRICS_PORT = int(os.environ.get("METRICS_PORT", 0))  # 0 - Prometheus endpoint o'chirilgan
+METRICS_HOST = os.environ.get("METRICS_HOST", "127.0.0.1")
+METRICS_DUMP_FILE = data_path(os.environ["METRICS_DUMP_FILE"]) if os.environ.get("METRICS_DUMP_FILE") else ""
+METRICS_DUMP_INTERVAL = float(os.environ.get("METRICS_DUMP_INTERVAL", 60))
+METRICS_RESERVOIR_SIZE = int(os.environ.get("METRICS_RESERVOIR_SIZE", 1024))
+METRICS_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 15, 30, 60, 120)
+
+class Histogram:
+    """Prometheus bucketlari va percentillar uchun oxirgi METRICS_RESERVOIR_SIZE ta o'lchov."""
+
+    def __init__(self):
+        self.buckets = [0] * len(METRICS_BUCKETS)
+        self.total = 0.0
+        self.count = 0
+        self.recent = deque(maxlen=METRICS_RESERVOIR_SIZE)
+
+    def observe(self, seconds):
+        index = bisect.bisect_left(METRICS_BUCKETS, seconds)
+        if index < len(self.buckets):
+            self.buckets[index] += 1
+        self.total += seconds
+        self.count += 1
+        self.recent.append(seconds)
 
-def load_settings():
-    if os.path.exists(SETTINGS_FILE):
+    def percentiles(self, *quantiles):
+        values = sorted(self.recent)
+        if not values:
+            return [0.0] * len(quantiles)
+        return [values[min(len(values) - 1, int(q * len(values)))] for q in quantiles]
+
+class Metrics:
+    """(guruh, nom) bo'yicha latency, natijalar (ok/error/timeout/rate_limited/cancelled) va bajarilayotganlar soni."""
+
+    def __init__(self):
+        self.latency = {}
+        self.outcomes = {}
+        self.in_flight = {}
+
+    def observe(self, group, name, seconds, outcome="ok"):
+        key = (group, name)
+        self.latency.setdefault(key, Histogram()).observe(seconds)
+        self.outcomes[key + (outcome,)] = self.outcomes.get(key + (outcome,), 0) + 1
+
+    @contextlib.asynccontextmanager
+    async def track(self, group, name):
+        """Yield qilingan ro'yxatning birinchi elementiga qo'shilgan soniyalar o'lchovdan chiqariladi
+        (masalan, oqim bo'lagini iste'molchi qayta ishlayotgan vaqt)."""
+        key = (group, name)
+        self.in_flight[key] = self.in_flight.get(key, 0) + 1
+        start, outcome, excluded = time.monotonic(), "ok", [0.0]
         try:
-            with open(SETTINGS_FILE, "r", encoding='utf-8') as file:
-                settings = json.load(file)
-                for key, value in default_settings.items():
-                    settings.setdefault(key, value)
-                return settings
-        except json.JSONDecodeError:
-            pass
-    save_settings(default_settings)
-    return default_settings
-
-def save_settings(settings):
+            yield excluded
+        except (asyncio.TimeoutError, httpx.TimeoutException):
+            outcome = "timeout"
+            raise
+        except RateLimitedError:
+            outcome = "rate_limited"
+            raise
+        except (asyncio.CancelledError, GeneratorExit):
+            outcome = "cancelled"
+            raise
+        except Exception:
+            outcome = "error"
+            raise
+        finally:
+            self.in_flight[key] -= 1
+            self.observe(group, name, time.monotonic() - start - excluded[0], outcome)
+
+    def timed(self, group, name=None):
+        """Korutinani o'lchaydigan dekorator; nom berilmasa funksiya nomidan olinadi."""
+        def decorator(func):
+            label = name or func.__name__.removeprefix("handle_")
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                async with self.track(group, label):
+                    return await func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def snapshot(self):
+        result = {}
+        for (group, name), hist in sorted(self.latency.items()):
+            p50, p95, p99 = hist.percentiles(0.5, 0.95, 0.99)
+            outcomes = {outcome: count for (g, n, outcome), count in self.outcomes.items() if (g, n) == (group, name)}
+            result[f"{group}/{name}"] = {"count": hist.count, "p50": p50, "p95": p95, "p99": p99,
+                                         "outcomes": outcomes, "in_flight": self.in_flight.get((group, name), 0)}
+        return result
+
+    def render_prometheus(self):
+        lines = ["# TYPE bot_latency_seconds histogram"]
+        for (group, name), hist in sorted(self.latency.items()):
+            labels = f'group="{group}",name="{name}"'
+            cumulative = 0
+            for bound, count in zip(METRICS_BUCKETS, hist.buckets):
+                cumulative += count
+                lines.append(f'bot_latency_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f'bot_latency_seconds_bucket{{{labels},le="+Inf"}} {hist.count}')
+            lines.append(f"bot_latency_seconds_sum{{{labels}}} {hist.total:.6f}")
+            lines.append(f"bot_latency_seconds_count{{{labels}}} {hist.count}")
+        lines.append("# TYPE bot_calls_total counter")
+        for (group, name, outcome), count in sorted(self.outcomes.items()):
+            lines.append(f'bot_calls_total{{group="{group}",name="{name}",outcome="{outcome}"}} {count}')
+        lines.append("# TYPE bot_in_flight gauge")
+        for (group, name), count in sorted(self.in_flight.items()):
+            lines.append(f'bot_in_flight{{group="{group}",name="{name}"}} {count}')
+        lines.append("# TYPE bot_queue_depth gauge")
+        for lane, st in scheduler.stats().items():
+            lines.append(f'bot_queue_depth{{lane="{lane}"}} {st["queued"]}')
+        return "\n".join(lines) + "\n"
+
+    async def _serve_http(self, reader, writer):
+        try:
+            while (await asyncio.wait_for(reader.readline(), timeout=5)).strip():
+                pass  # yo'l va sarlavhalar ahamiyatsiz: har qanday GET metrikalarni qaytaradi
+            body = self.render_prometheus().encode()
+            writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n"
+                         b"Content-Length: %d\r\nConnection: close\r\n\r\n" % len(body) + body)
+            await writer.drain()
+        except Exception as e:
+            logging.debug(f"Metrika so'rovini qayta ishlashda xatolik: {e}")
+        finally:
+            writer.close()
+
+    async def run(self):
+        if METRICS_PORT:
+            server = await asyncio.start_server(self._serve_http, METRICS_HOST, METRICS_PORT)
+            logging.info(f"Metrikalar http://{METRICS_HOST}:{METRICS_PORT}/metrics manzilida.")
+        if not (METRICS_PORT or METRICS_DUMP_FILE):
+            return
+        try:
+            while True:
+                await asyncio.sleep(METRICS_DUMP_INTERVAL)
+                if METRICS_DUMP_FILE:
+                    try:
+                        await asyncio.to_thread(atomic_write_json, METRICS_DUMP_FILE, self.snapshot(), 2)
+                    except OSError as e:
+                        logging.error(f"Metrikalarni yozishda xatolik: {e}")
+        finally:
+            if METRICS_PORT:
+                server.close()
+
+metrics = Metrics()
+
+class RateLimitedError(Exception):
+    pass
+
+class TokenBucket:
+    __slots__ = ("rate", "capacity", "tokens", "updated", "blocked_until")
+
+    def __init__(self, rate, capacity, now):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+        self.blocked_until = 0
+
+    def wait_time(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        # tokens manfiy bo'lishi mumkin: bu oldinroq navbatga turgan chaqiruvlar uchun band qilingan tokenlar
+        return max((1 - self.tokens) / self.rate if self.tokens < 1 else 0, self.blocked_until - now)
+
+# Bir nechta akkaunt (runtime.py) uchun umumiy lokal ombor: upstream limitlari, AI javoblar keshi, persona keshi
+SHARED_STORE_FILE = os.environ.get("SHARED_STORE_FILE", "")  # bo'sh - o'chirilgan
+SHARED_RATE_LIMIT_KINDS = ("gemini", "pollinations")
+
+class SharedStore:
+    """Jarayonlar orasida SQLite (WAL) orqali bo'lishiladigan holat: umumiy token bucketlar va TTL li kalit-qiymatlar.
+    Vaqt time.time() bo'yicha, chunki monotonic soat jarayonlar orasida taqqoslanmaydi."""
+
+    def __init__(self, path):
+        self.path = path
+        self._db = None
+        self._lock = threading.Lock()
+
+    def _conn(self):
+        if self._db is None:
+            db = sqlite3.connect(self.path, timeout=10, check_same_thread=False, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.executescript("""
+                CREATE TABLE IF NOT EXISTS buckets (name TEXT PRIMARY KEY, tokens REAL, updated REAL, blocked_until REAL);
+                CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value TEXT, expires REAL);
+            """)
+            self._db = db
+        return self._db
+
+    def _update_bucket(self, name, rate, capacity, change):
+        now = time.time()
+        with self._lock:
+            db = self._conn()
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                bucket = TokenBucket(rate, capacity, now)
+                row = db.execute("SELECT tokens, updated, blocked_until FROM buckets WHERE name = ?", (name,)).fetchone()
+                if row:
+                    bucket.tokens, bucket.updated, bucket.blocked_until = row
+                result = change(bucket, now)
+                db.execute("INSERT OR REPLACE INTO buckets VALUES (?, ?, ?, ?)", (name, bucket.tokens, bucket.updated, bucket.blocked_until))
+                db.execute("COMMIT")
+                return result
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+
+    def reserve(self, name, rate, capacity, max_wait):
+        def change(bucket, now):
+            wait = bucket.wait_time(now)
+            if wait > max_wait:
+                return None
+            bucket.tokens -= 1
+            return wait
+        return self._update_bucket(name, rate, capacity, change)
+
+    def penalize(self, name, rate, capacity, seconds):
+        def change(bucket, now):
+            bucket.wait_time(now)
+            bucket.blocked_until = max(bucket.blocked_until, now + seconds)
+            bucket.tokens = min(bucket.tokens, 0)
+        self._update_bucket(name, rate, capacity, change)
+
+    def get(self, key):
+        with self._lock:
+            row = self._conn().execute("SELECT value FROM kv WHERE key = ? AND expires > ?", (key, time.time())).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._conn().execute("INSERT OR REPLACE INTO kv VALUES (?, ?, ?)", (key, json.dumps(value, ensure_ascii=False), time.time() + ttl))
+
+    def purge_expired(self):
+        with self._lock:
+            self._conn().execute("DELETE FROM kv WHERE expires <= ?", (time.time(),))
+
+shared_store = SharedStore(SHARED_STORE_FILE) if SHARED_STORE_FILE else None
+
+class RateLimiter:
+    """(tur, kalit) bo'yicha token bucketlar. Chaqiruvchi darhol javob oladi: token bor bo'lsa o'tadi,
+    max_wait ichida bo'shasa navbatda kutadi, aks holda rad etiladi. Uzoq ishlatilmagan bucketlar o'chiriladi."""
+
+    def __init__(self, limits, idle_seconds, shared=None, shared_kinds=()):
+        self.limits = limits
+        self.idle_seconds = idle_seconds
+        # shared_kinds dagi limitlar (upstream kvotalari) barcha akkauntlar uchun umumiy ombordan olinadi
+        self.shared = shared
+        self.shared_kinds = shared_kinds if shared else ()
+        self.rejected = {kind: 0 for kind in limits}
+        self.penalties = {kind: 0 for kind in limits}
+        self._buckets = {}
+        self._shared_writes = set()
+
+    def _bucket(self, kind, key, now):
+        bucket = self._buckets.get((kind, key))
+        if bucket is None:
+            bucket = self._buckets[(kind, key)] = TokenBucket(*self.limits[kind], now)
+        return bucket
+
+    def reserve(self, kind, key=None, max_wait=0.0):
+        """Token band qiladi va kutish vaqtini qaytaradi; max_wait dan ko'p kutish kerak bo'lsa None."""
+        now = time.monotonic()
+        bucket = self._bucket(kind, key, now)
+        wait = bucket.wait_time(now)
+        if wait > max_wait:
+            self.rejected[kind] += 1
+            return None
+        bucket.tokens -= 1
+        return wait
+
+    def try_acquire(self, kind, key=None):
+        return self.reserve(kind, key) is not None
+
+    async def acquire(self, kind, key=None, max_wait=0.0):
+        if kind in self.shared_kinds:
+            wait = await asyncio.to_thread(self.shared.reserve, kind, *self.limits[kind], max_wait)
+            if wait is None:
+                self.rejected[kind] += 1
+        else:
+            wait = self.reserve(kind, key, max_wait)
+        if wait is None:
+            return False
+        if wait > 0:
+            await asyncio.sleep(wait)
+        return True
+
+    def penalize(self, kind, seconds, key=None):
+        """Upstream Retry-After yoki FloodWait qaytarganda bucketni shu muddatga yopadi."""
+        now = time.monotonic()
+        bucket = self._bucket(kind, key, now)
+        bucket.blocked_until = max(bucket.blocked_until, now + seconds)
+        bucket.tokens = min(bucket.tokens, 0)
+        if kind in self.shared_kinds:
+            # Boshqa jarayonlar ham to'xtashi uchun umumiy omborga yoziladi. SQLite qulfi band bo'lsa busy timeout
+            # gacha kutishi mumkin, shuning uchun yozuv event loopni bloklamasdan oqimda bajariladi
+            task = asyncio.ensure_future(asyncio.to_thread(self.shared.penalize, kind, *self.limits[kind], seconds))
+            self._shared_writes.add(task)
+            task.add_done_callback(self._shared_write_done)
+        self.penalties[kind] += 1
+        logging.warning(f"'{kind}' limiti {seconds:.0f} soniyaga yopildi.")
+
+    def _shared_write_done(self, task):
+        self._shared_writes.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logging.error(f"Umumiy limitni yozishda xatolik: {task.exception()}")
+
+    def evict_idle(self):
+        now = time.monotonic()
+        for bucket_key, bucket in list(self._buckets.items()):
+            if now - bucket.updated > self.idle_seconds and now > bucket.blocked_until:
+                del self._buckets[bucket_key]
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(60)
+            self.evict_idle()
+            if self.shared:
+                await asyncio.to_thread(self.shared.purge_expired)
+
+    def stats(self):
+        return {kind: {"rejected": self.rejected[kind], "penalties": self.penalties[kind]} for kind in self.limits}
+
+limiter = RateLimiter(RATE_LIMITS, RATE_LIMIT_IDLE_SECONDS, shared_store, SHARED_RATE_LIMIT_KINDS)
+
+def retry_after_seconds(response, default=30.0):
     try:
-        with open(SETTINGS_FILE, "w", encoding='utf-8') as file:
-            json.dump(settings, file, indent=4, ensure_ascii=False)
-    except Exception as e:
-        logging.error(f"Sozlamalar faylini saqlashda xatolik: {e}")
+        return float(response.headers.get("Retry-After", default))
+    except ValueError:
+        return default
+
+def check_upstream_response(kind, response):
+    if response.status_code == 429:
+        limiter.penalize(kind, retry_after_seconds(response))
+    response.raise_for_status()
+
+def remove_file(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+def atomic_write_json(path, data, indent=None):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, indent=indent, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+def _file_mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+class ConfigStore:
+    """Sozlamalar va faol guruhlar xotirada turadi. Fayl faqat qiymat haqiqatan o'zgarganda yoziladi,
+    qo'lda tahrirlangan fayllar esa mtime o'zgarganda qayta o'qiladi."""
+
+    def __init__(self, settings_file, groups_file, defaults):
+        self.settings_file = settings_file
+        self.groups_file = groups_file
+        self.defaults = defaults
+        self.settings = dict(defaults)
+        self.active_groups = {}  # chat_id -> None; tartibni saqlaydigan hash to'plam
+        self._mtimes = {}
+
+    def load(self):
+        self._load_settings()
+        self._load_groups()
+
+    def _read_json(self, path):
+        # mtime o'qishdan oldin yoziladi: buzilgan fayl har CONFIG_RELOAD_INTERVAL da qayta o'qilib ogohlantirish
+        # takrorlanmasin, fayl keyingi safar o'zgargandagina qayta uriniladi
+        self._mtimes[path] = _file_mtime(path)
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def _write_json(self, path, data):
+        try:
+            atomic_write_json(path, data, indent=4)
+            self._mtimes[path] = _file_mtime(path)
+        except Exception as e:
+            logging.error(f"{path} faylini saqlashda xatolik: {e}")
+
+    def _load_settings(self):
+        try:
+            loaded = self._read_json(self.settings_file)
+            self.settings = {**self.defaults, **loaded}
+        except FileNotFoundError:
+            self.settings = dict(self.defaults)
+            self._write_json(self.settings_file, self.settings)
+        except json.JSONDecodeError as e:
+            logging.warning(f"Sozlamalar faylini o'qib bo'lmadi, avvalgi qiymatlar qoldirildi: {e}")
+
+    def _load_groups(self):
+        try:
+            self.active_groups = dict.fromkeys(self._read_json(self.groups_file).get("groups", []))
+        except FileNotFoundError:
+            self.active_groups = {}
+        except json.JSONDecodeError as e:
+            logging.warning(f"Faol guruhlar faylini o'qib bo'lmadi, avvalgi ro'yxat qoldirildi: {e}")
+
+    def get(self, key):
+        return self.settings[key]
+
+    def update(self, **values):
+        changed = {key: value for key, value in values.items() if self.settings.get(key) != value}
+        if changed:
+            self.settings.update(changed)
+            self._write_json(self.settings_file, self.settings)
+        return bool(changed)
+
+    def is_active(self, chat_id):
+        return chat_id in self.active_groups
+
+    def add_active(self, chat_id):
+        if chat_id in self.active_groups:
+            return False
+        self.active_groups[chat_id] = None
+        self._write_json(self.groups_file, {"groups": list(self.active_groups)})
+        return True
+
+    def remove_active(self, chat_id):
+        if chat_id not in self.active_groups:
+            return False
+        del self.active_groups[chat_id]
+        self._write_json(self.groups_file, {"groups": list(self.active_groups)})
+        return True
+
+    def reload_if_changed(self):
+        for path, loader in ((self.settings_file, self._load_settings), (self.groups_file, self._load_groups)):
+            if _file_mtime(path) != self._mtimes.get(path):
+                logging.info(f"{path} o'zgargani aniqlandi, qayta yuklanmoqda.")
+                loader()
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(CONFIG_RELOAD_INTERVAL)
+            try:
+                self.reload_if_changed()
+            except Exception as e:
+                logging.error(f"Sozlamalarni qayta yuklashda xatolik: {e}", exc_info=True)
 
 # Global o'zgaruvchilar
-settings = load_settings()
-allow_all_users = settings["allow_all_users"]
-auto_reply_enabled = settings["auto_reply_enabled"]
-online_mode = settings["online_mode"]
+config = ConfigStore(SETTINGS_FILE, ACTIVE_GROUPS_FILE, default_settings)
 active_auto_send_tasks = {}
 
+http_clients = {}
+http_request_counts = {}
+
+def _http2_available():
+    try:
+        import h2  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+def create_http_client(name):
+    http2 = HTTP2_ENABLED and _http2_available()
+    if HTTP2_ENABLED and not http2:
+        logging.warning(f"HTTP/2 uchun 'h2' paketi o'rnatilmagan, {name} HTTP/1.1 bilan ishlaydi.")
+    http_request_counts.setdefault(name, 0)
+
+    async def count_request(request):
+        http_request_counts[name] += 1
+
+    return httpx.AsyncClient(
+        http2=http2,
+        limits=httpx.Limits(max_connections=HTTP_MAX_CONNECTIONS, max_keepalive_connections=HTTP_MAX_KEEPALIVE, keepalive_expiry=HTTP_KEEPALIVE_EXPIRY),
+        timeout=httpx.Timeout(HTTP_UPSTREAM_TIMEOUTS[name], connect=HTTP_CONNECT_TIMEOUT),
+        event_hooks={"request": [count_request]},
+    )
+
+def get_http_client(name):
+    http_client = http_clients.get(name)
+    if http_client is None or http_client.is_closed:
+        http_client = http_clients[name] = create_http_client(name)
+    return http_client
+
+def open_http_clients():
+    for name in HTTP_UPSTREAM_TIMEOUTS:
+        get_http_client(name)
+    logging.info(f"HTTP klientlar tayyor: {', '.join(http_clients)}")
+
+async def close_http_clients():
+    for name, http_client in list(http_clients.items()):
+        try:
+            await http_client.aclose()
+        except Exception as e:
+            logging.warning(f"{name} HTTP klientini yopishda xatolik: {e}")
+    http_clients.clear()
+
+def http_pool_connections(http_client):
+    """(ulanishlar, bo'shlar) yoki None. httpx pool holatini ochiq API orqali bermaydi: ichki httpcore pooli
+    o'qiladi, httpx yangilanib tuzilma o'zgarsa statistika faqat so'rovlar soni bilan ko'rsatiladi."""
+    try:
+        pool = getattr(getattr(http_client, "_transport", None), "_pool", None)
+        connections = list(getattr(pool, "connections", None))
+        return len(connections), sum(1 for conn in connections if conn.is_idle())
+    except Exception:
+        return None
+
+def get_http_pool_stats():
+    stats = {}
+    for name, http_client in http_clients.items():
+        stats[name] = {"requests": http_request_counts.get(name, 0), "connections": None, "idle": None, "active": None}
+        pool = http_pool_connections(http_client)
+        if pool is not None:
+            stats[name].update(connections=pool[0], idle=pool[1], active=pool[0] - pool[1])
+    return stats
+
 def mask_sensitive_info(text, api_key, gemini_base_url):
     masked_key = re.sub(r"([A-Za-z0-9_-]{15})([A-Za-z0-9_-]+)", r"\1********", api_key) if api_key else "API_KEY_HIDDEN"
     masked_gemini_url = re.sub(r"(https?://[^/]+)/.*", r"\1/API_ENDPOINT_HIDDEN", gemini_base_url) if gemini_base_url else "GEMINI_API_URL_HIDDEN"
@@ -92,26 +628,288 @@ def mask_sensitive_info(text, api_key, gemini_base_url):
     text = text.replace(gemini_base_url, masked_gemini_url) if gemini_base_url else text
     return text
 
+# Bir xil so'rovlarni birlashtirish (single-flight) va qisqa muddatli javob keshlari
+AI_CACHE_TTL = float(os.environ.get("AI_CACHE_TTL", 120))
+AI_CACHE_SIZE = int(os.environ.get("AI_CACHE_SIZE", 1000))
+DETECTIVE_CACHE_TTL = float(os.environ.get("DETECTIVE_CACHE_TTL", 60))
+
+class TTLCache:
+    """Hajmi cheklangan LRU kesh; har bir yozuv ttl soniyadan keyin eskiradi."""
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # key -> (expires_at, value)
+
+    def get(self, key):
+        item = self._entries.get(key)
+        if item is None or item[0] < time.monotonic():
+            if item is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return item[1]
+
+    def set(self, key, value):
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._entries)}
+
+class SingleFlight:
+    """Bir vaqtda kelgan bir xil kalitli chaqiruvlar bitta upstream so'rovni bo'lishadi.
+    Kutayotgan barcha chaqiruvchilar bekor qilinsa, umumiy vazifa ham bekor qilinadi va uning tugashi kutiladi."""
+
+    def __init__(self):
+        self.leaders = 0
+        self.shared = 0
+        self._calls = {}  # key -> [task, waiters]
+
+    async def do(self, key, coro_factory):
+        call = self._calls.get(key)
+        if call is None:
+            call = self._calls[key] = [asyncio.ensure_future(coro_factory()), 0]
+            call[0].add_done_callback(lambda _, key=key, call=call: self._calls.pop(key, None) if self._calls.get(key) is call else None)
+            self.leaders += 1
+        else:
+            self.shared += 1
+        call[1] += 1
+        try:
+            return await asyncio.shield(call[0])
+        finally:
+            call[1] -= 1
+            if call[1] == 0 and not call[0].done():
+                # Keyingi chaqiruvchilar bekor qilinayotgan vazifaga qo'shilmasdan yangisini boshlaydi
+                if self._calls.get(key) is call:
+                    del self._calls[key]
+                call[0].cancel()
+                await asyncio.wait({call[0]})
+
+    def stats(self):
+        return {"leaders": self.leaders, "shared": self.shared, "in_flight": len(self._calls)}
+
+ai_response_cache = TTLCache(AI_CACHE_SIZE, AI_CACHE_TTL)
+detective_cache = TTLCache(AI_CACHE_SIZE, DETECTIVE_CACHE_TTL)
+ai_single_flight = SingleFlight()
+
+# Rasm quvuri: (prompt, model) bo'yicha diskdagi kesh, oqimli yuklab olish va event loopdan tashqarida qayta siqish
+IMAGE_CACHE_DIR = os.environ.get("IMAGE_CACHE_DIR", data_path("image_cache"))
+IMAGE_CACHE_MAX_BYTES = int(os.environ.get("IMAGE_CACHE_MAX_BYTES", 200 * 1024 * 1024))
+IMAGE_FORMAT = os.environ.get("IMAGE_FORMAT", "JPEG").upper()
+IMAGE_MAX_SIDE = int(os.environ.get("IMAGE_MAX_SIDE", 1280))
+IMAGE_QUALITY = int(os.environ.get("IMAGE_QUALITY", 85))
+IMAGE_WORKERS = int(os.environ.get("IMAGE_WORKERS", 2))
+IMAGE_PROCESS_POOL = os.environ.get("IMAGE_PROCESS_POOL", "0") == "1"
+# Telegramga yuklangan rasmlarni qayta yuklamasdan yuborish uchun (file reference bir necha soat amal qiladi)
+UPLOADED_PHOTO_TTL = float(os.environ.get("UPLOADED_PHOTO_TTL", 3600))
+
+def create_process_pool(max_workers):
+    """CPU og'ir ishlar uchun jarayonlar puli. fork ishlayotgan event loop va ochiq ulanishlar nusxasini oladi,
+    shuning uchun forkserver (bo'lmasa spawn) ishlatiladi; vazifalar media_workers modulidan import qilinadi.
+    Bu usullarda bola jarayon asosiy skriptni qayta bajaradi. bot.py ning o'zi asosiy skript bo'lsa, har bir bola
+    jarayonda Telegram klienti sessiya faylida qayta yaratilardi, shuning uchun bu holda oqimlar puli ishlatiladi."""
+    if __name__ == "__main__":
+        logging.warning("bot.py to'g'ridan-to'g'ri ishga tushirilgan: jarayonlar puli o'rniga oqimlar puli ishlatiladi. "
+                        "Jarayonlar puli uchun botni start.py yoki runtime.py orqali ishga tushiring.")
+        return concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+    methods = multiprocessing.get_all_start_methods()
+    context = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+    return concurrent.futures.ProcessPoolExecutor(max_workers=max_workers, mp_context=context)
+
+def sniff_image_extension(path):
+    """Fayl boshidagi imzo bo'yicha rasm kengaytmasi; rasm bo'lmasa None."""
+    with open(path, 'rb') as f:
+        head = f.read(12)
+    if head.startswith(b"\xff\xd8\xff"):
+        return "jpg"
+    if head.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "png"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "webp"
+    return None
+
+class ImageDiskCache:
+    """Kontent-manzilli rasm keshi: fayl nomi (prompt, model) ning sha256 xeshi, hajm oshsa eng eski ishlatilganlar o'chiriladi.
+    Metodlar bloklovchi, asyncio.to_thread orqali chaqiriladi."""
+
+    def __init__(self, root_dir, max_bytes, extension):
+        self.root_dir = root_dir
+        self.max_bytes = max_bytes
+        self.extension = extension
+        # Qayta siqib bo'lmagan rasmlar asl formati kengaytmasi bilan saqlanadi
+        self.extensions = list(dict.fromkeys([extension, "jpg", "png", "webp"]))
+        self.hits = 0
+        self.misses = 0
+        self._total_bytes = None
+        self._files = 0
+
+    def path_for(self, key, extension=None):
+        digest = hashlib.sha256(json.dumps(key, ensure_ascii=False).encode('utf-8')).hexdigest()
+        return os.path.join(self.root_dir, digest[:2], f"{digest}.{extension or self.extension}")
+
+    def new_temp_file(self):
+        path = os.path.join(self.root_dir, 'tmp')
+        os.makedirs(path, exist_ok=True)
+        return tempfile.mkstemp(suffix=".part", dir=path)
+
+    def get(self, key):
+        for extension in self.extensions:
+            path = self.path_for(key, extension)
+            try:
+                os.utime(path)
+            except FileNotFoundError:
+                continue
+            self.hits += 1
+            return path
+        self.misses += 1
+        return None
+
+    def put(self, key, src_path, extension=None):
+        path = self.path_for(key, extension)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(src_path, path)
+        if self._total_bytes is None:
+            self._scan()
+        else:
+            self._total_bytes += os.path.getsize(path)
+            self._files += 1
+        if self._total_bytes > self.max_bytes:
+            self._evict(keep=path)
+        return path
+
+    def _entries(self):
+        for dirpath, dirnames, filenames in os.walk(self.root_dir):
+            if os.path.basename(dirpath) == 'tmp':
+                continue
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                stat = os.stat(path)
+                yield stat.st_mtime, stat.st_size, path
+
+    def _scan(self):
+        entries = list(self._entries())
+        self._total_bytes = sum(size for _, size, _ in entries)
+        self._files = len(entries)
+        return entries
+
+    def _evict(self, keep=None):
+        target = self.max_bytes * 0.9
+        for _, size, path in sorted(self._scan()):
+            if self._total_bytes <= target:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+                self._total_bytes -= size
+                self._files -= 1
+            except OSError:
+                pass
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "size": self._files, "bytes": self._total_bytes or 0}
+
+image_disk_cache = ImageDiskCache(IMAGE_CACHE_DIR, IMAGE_CACHE_MAX_BYTES, "jpg" if IMAGE_FORMAT == "JPEG" else IMAGE_FORMAT.lower())
+uploaded_photos = TTLCache(AI_CACHE_SIZE, UPLOADED_PHOTO_TTL)
+image_executor = None
+
+def get_image_executor():
+    global image_executor
+    if image_executor is None:
+        image_executor = create_process_pool(IMAGE_WORKERS) if IMAGE_PROCESS_POOL else concurrent.futures.ThreadPoolExecutor(max_workers=IMAGE_WORKERS)
+    return image_executor
+
+def shutdown_image_executor():
+    global image_executor
+    if image_executor is not None:
+        image_executor.shutdown(wait=False, cancel_futures=True)
+        image_executor = None
+
+def image_cache_key(prompt):
+    return (" ".join(prompt.split()), POLLINATIONS_IMAGE_MODEL)
+
 async def generate_image_from_pollinations(prompt: str):
+    """Tayyor rasm fayli yo'lini qaytaradi: avval diskdagi keshdan, bo'lmasa yuklab olib qayta siqadi."""
+    cache_key = image_cache_key(prompt)
+    image_path = await asyncio.to_thread(image_disk_cache.get, cache_key)
+    if image_path is None:
+        image_path = await ai_single_flight.do(("pollinations",) + cache_key, lambda: build_cached_image(cache_key))
+    return image_path
+
+async def build_cached_image(cache_key):
+    raw_path = await download_image_from_pollinations(cache_key[0])
+    if not raw_path:
+        return None
+    image_path, extension = raw_path, None
+    try:
+        try:
+            image_path = await asyncio.get_running_loop().run_in_executor(get_image_executor(), recompress_image, raw_path, IMAGE_FORMAT, IMAGE_MAX_SIDE, IMAGE_QUALITY)
+        except Exception as e:
+            # Asl fayl o'z formatining kengaytmasi bilan keshlanadi, masalan PNG .jpg nomi ostida saqlanmaydi
+            extension = await asyncio.to_thread(sniff_image_extension, raw_path)
+            if extension is None:
+                logging.warning(f"Rasmni qayta siqib bo'lmadi va yuklangan fayl rasm emas: {e}")
+                return None
+            logging.warning(f"Rasmni qayta siqib bo'lmadi, asl {extension} fayl ishlatiladi: {e}")
+        return await asyncio.to_thread(image_disk_cache.put, cache_key, image_path, extension)
+    finally:
+        # put() faylni keshga ko'chiradi; xato bo'lganda qolgan vaqtinchalik fayllar o'chiriladi
+        for path in {raw_path, image_path}:
+            await asyncio.to_thread(remove_file, path)
+
+async def download_image_from_pollinations(prompt: str):
+    tmp_path = None
     try:
-        encoded_prompt = quote(prompt, safe='')
-        api_url = f"{POLLINATIONS_IMAGE_API_BASE_URL}{encoded_prompt}?model={POLLINATIONS_IMAGE_MODEL}"
-        async with httpx.AsyncClient() as client_http:
-            response = await client_http.get(api_url, timeout=120)
-            response.raise_for_status()
-            return response.content
+        # Metrika xatolar shu yerda ushlanib None ga aylanishidan oldin yoziladi
+        async with metrics.track("upstream", "pollinations"):
+            if not await limiter.acquire("pollinations", max_wait=POLLINATIONS_MAX_WAIT):
+                raise RateLimitedError("pollinations")
+            encoded_prompt = quote(prompt, safe='')
+            api_url = f"{POLLINATIONS_IMAGE_API_BASE_URL}{encoded_prompt}?model={POLLINATIONS_IMAGE_MODEL}"
+            fd, tmp_path = await asyncio.to_thread(image_disk_cache.new_temp_file)
+            f = os.fdopen(fd, 'wb')
+            try:
+                async with get_http_client("pollinations").stream("GET", api_url) as response:
+                    check_upstream_response("pollinations", response)
+                    async for chunk in response.aiter_bytes(64 * 1024):
+                        await asyncio.to_thread(f.write, chunk)
+            finally:
+                await asyncio.to_thread(f.close)
+        return tmp_path
+    except RateLimitedError:
+        logging.warning("Pollinations.ai limiti to'lgan, so'rov rad etildi.")
+        return None
     except Exception as e:
         logging.error(f"Pollinations.ai so'rovda xatolik: {e}", exc_info=True)
+        if tmp_path:
+            await asyncio.to_thread(remove_file, tmp_path)
         return None
 
 async def generate_image_with_progress(prompt, event):
     thinking_message = await event.reply("🎨 Rasm AI tomonidan chizilmoqda, kuting... ⏳")
     try:
-        image_bytes = await generate_image_from_pollinations(prompt)
-        if image_bytes:
-            image_bytes_io = io.BytesIO(image_bytes)
-            file = await client.upload_file(image_bytes_io, file_name="generated_image.png")
-            await client.send_file(event.chat_id, file=file, caption=f"Sizning Rasmingiz: `{prompt}`", parse_mode='markdown', reply_to=event.message.id)
+        cache_key = image_cache_key(prompt)
+        caption = f"Sizning Rasmingiz: `{prompt}`"
+        photo = uploaded_photos.get(cache_key)
+        if photo is not None:
+            try:
+                await telegram_send(lambda: client.send_file(event.chat_id, file=photo, caption=caption, parse_mode='markdown', reply_to=event.message.id))
+                await thinking_message.delete()
+                return
+            except errors.FileReferenceExpiredError:
+                pass
+        image_path = await generate_image_from_pollinations(prompt)
+        if image_path:
+            sent = await telegram_send(lambda: client.send_file(event.chat_id, file=image_path, caption=caption, parse_mode='markdown', reply_to=event.message.id))
+            if sent is not None and sent.photo:
+                uploaded_photos.set(cache_key, sent.photo)
             await thinking_message.delete()
         else:
             await thinking_message.edit("Rasm yaratilmadi! API bilan bog'liq xatolik bo'lishi mumkin.")
@@ -119,7 +917,7 @@ async def generate_image_with_progress(prompt, event):
         logging.error(f"Rasm generatsiya qilishda kutilmagan xatolik: {e}", exc_info=True)
         await thinking_message.edit(f"Rasm generatsiya qilishda kutilmagan xatolik: {e}")
 
-PERSONA_FILE = "persona.json"
+PERSONA_FILE = os.environ.get("PERSONA_FILE", "persona.json")
 def load_persona():
     try:
         with open(PERSONA_FILE, 'r', encoding='utf-8') as f:
@@ -127,100 +925,964 @@ def load_persona():
     except (FileNotFoundError, json.JSONDecodeError):
         return {}
 
-CHAT_HISTORY_DIR = "chat_histories"
+def compile_persona(persona):
+    labels = [("role", "Sizning rolingiz"), ("style", "Javob berish uslubingiz"), ("context_example", "Kontekst/Misol"), ("admin", "Admin haqida")]
+    persona_parts = [f"{label}: {persona[key]}" for key, label in labels if persona.get(key)]
+    if not persona_parts:
+        return ""
+    return "Sizning shaxsiyatingiz va ko'rsatmalar:\n" + "\n".join(persona_parts)
+
+class PersonaPrefix:
+    """Persona matni bir marta tuziladi va faqat persona.json mtime o'zgarganda qayta tuziladi.
+    GEMINI_CONTEXT_CACHE yoqilgan bo'lsa, u cachedContents sifatida ro'yxatdan o'tkaziladi va TTL muntazam uzaytiriladi."""
+
+    def __init__(self, path):
+        self.path = path
+        self.text = ""
+        self.version = 0
+        self._mtime = None
+        self._checked_at = None
+        self._cache_name = None
+        self._cache_version = None
+        self._cache_expires = 0
+        self._cache_retry_at = 0
+        self._cache_lock = asyncio.Lock()
+
+    def refresh(self):
+        now = time.monotonic()
+        if self._checked_at is not None and now - self._checked_at < CONFIG_RELOAD_INTERVAL:
+            return self.text
+        self._checked_at = now
+        mtime = _file_mtime(self.path)
+        if mtime != self._mtime or self.version == 0:
+            self._mtime = mtime
+            self.text = compile_persona(load_persona())
+            self.version += 1
+        return self.text
+
+    def system_instruction(self, summary=""):
+        text = self.refresh()
+        if summary:
+            text = f"{text}\n\nFoydalanuvchi bilan avvalgi suhbat qisqacha mazmuni:\n{summary}".strip()
+        return {"parts": [{"text": text}]} if text else None
+
+    async def cached_content(self):
+        if not GEMINI_CONTEXT_CACHE or not self.refresh():
+            return None
+        now = time.time()
+        if self._cache_name and self._cache_version == self.version and now < self._cache_expires - 60:
+            return self._cache_name
+        if now < self._cache_retry_at:
+            return None
+        async with self._cache_lock:
+            if self._cache_name and self._cache_version == self.version and now < self._cache_expires - 60:
+                return self._cache_name
+            http_client = get_http_client("gemini")
+            ttl = f"{GEMINI_CONTEXT_CACHE_TTL}s"
+            try:
+                if self._cache_name and self._cache_version == self.version:
+                    response = await http_client.patch(f"{GEMINI_API_ROOT}/{self._cache_name}", params={"key": gemini_api_key, "updateMask": "ttl"}, json={"ttl": ttl})
+                    if response.status_code == 404:
+                        self._cache_name = None
+                    else:
+                        response.raise_for_status()
+                # Boshqa akkauntlar shu persona uchun yaratgan keshni umumiy ombordan oladi
+                shared_key = "persona_cache:" + hashlib.sha256(self.text.encode()).hexdigest()
+                if (not self._cache_name or self._cache_version != self.version) and shared_store:
+                    shared_name = await asyncio.to_thread(shared_store.get, shared_key)
+                    if shared_name:
+                        self._cache_name, self._cache_version = shared_name, self.version
+                if not self._cache_name or self._cache_version != self.version:
+                    if self._cache_name:
+                        await http_client.delete(f"{GEMINI_API_ROOT}/{self._cache_name}", params={"key": gemini_api_key})
+                    body = {"model": f"models/{GEMINI_CACHE_MODEL}", "systemInstruction": self.system_instruction(), "tools": GEMINI_TOOLS, "ttl": ttl}
+                    response = await http_client.post(f"{GEMINI_API_ROOT}/cachedContents", params={"key": gemini_api_key}, json=body)
+                    response.raise_for_status()
+                    self._cache_name = response.json()["name"]
+                    self._cache_version = self.version
+                    logging.info(f"Persona Gemini kontekst keshiga yuklandi: {self._cache_name}")
+                if shared_store:
+                    await asyncio.to_thread(shared_store.set, shared_key, self._cache_name, GEMINI_CONTEXT_CACHE_TTL - 60)
+                self._cache_expires = now + GEMINI_CONTEXT_CACHE_TTL
+                return self._cache_name
+            except Exception as e:
+                # Masalan, prefiks minimal token sonidan qisqa bo'lsa; bir muddat oddiy systemInstruction ishlatiladi
+                logging.warning(f"Gemini kontekst keshini yaratib bo'lmadi: {mask_sensitive_info(str(e), gemini_api_key, GEMINI_BASE_API_URL)}")
+                self._cache_name = None
+                self._cache_retry_at = now + 600
+                return None
+
+persona_prefix = PersonaPrefix(PERSONA_FILE)
+
+async def build_gemini_request(contents, use_cache=True, summary=""):
+    """Gemini so'rovi tanasini va model URL ini qaytaradi. Persona kontekst keshida bo'lsa, systemInstruction va tools yuborilmaydi.
+    use_cache=False - zaxira model uchun: kontekst keshi boshqa modelga bog'langan. Suhbat xulosasi systemInstruction ga
+    qo'shiladi; cachedContent bilan systemInstruction birga yuborilmaydi, shuning uchun xulosa bo'lsa kesh ishlatilmaydi."""
+    request_data = {"contents": contents, "generationConfig": GEMINI_GENERATION_CONFIG, "safetySettings": GEMINI_SAFETY_SETTINGS}
+    cached_content = use_cache and not summary and await persona_prefix.cached_content()
+    if cached_content:
+        request_data["cachedContent"] = cached_content
+        return f"{GEMINI_API_ROOT}/models/{GEMINI_CACHE_MODEL}", request_data
+    system_instruction = persona_prefix.system_instruction(summary)
+    if system_instruction:
+        request_data["systemInstruction"] = system_instruction
+    request_data["tools"] = GEMINI_TOOLS
+    return GEMINI_BASE_API_URL, request_data
+
+CHAT_HISTORY_DIR = data_path("chat_histories")
+HISTORY_BACKEND = os.environ.get("HISTORY_BACKEND", "sqlite")
+HISTORY_DB_FILE = os.environ.get("HISTORY_DB_FILE", data_path("chat_histories.db"))
+HISTORY_MAX_TURNS = int(os.environ.get("HISTORY_MAX_TURNS", 30))
+# Tarix token byudjetiga sig'maguncha eski navbatlar qisqa xulosaga aylantiriladi (fon vazifasida)
+CONTEXT_TOKEN_BUDGET = int(os.environ.get("CONTEXT_TOKEN_BUDGET", 2000))
+SUMMARY_MAX_TOKENS = int(os.environ.get("SUMMARY_MAX_TOKENS", 300))
+HISTORY_CACHE_SIZE = int(os.environ.get("HISTORY_CACHE_SIZE", 500))
+HISTORY_IDLE_SECONDS = float(os.environ.get("HISTORY_IDLE_SECONDS", 1800))
+HISTORY_FLUSH_INTERVAL = float(os.environ.get("HISTORY_FLUSH_INTERVAL", 5))
+
 def create_chat_history_dir():
     os.makedirs(os.path.join(CHAT_HISTORY_DIR, 'group'), exist_ok=True)
     os.makedirs(os.path.join(CHAT_HISTORY_DIR, 'user'), exist_ok=True)
 def get_chat_history_file_path(chat_id, sender_id, is_private):
-    create_chat_history_dir()
     if is_private:
         return os.path.join(CHAT_HISTORY_DIR, 'user', f"user_{sender_id}.json")
     else:
-        group_dir = os.path.join(CHAT_HISTORY_DIR, 'group', str(chat_id))
-        os.makedirs(group_dir, exist_ok=True)
-        return os.path.join(group_dir, f"user_{sender_id}.json")
+        return os.path.join(CHAT_HISTORY_DIR, 'group', str(chat_id), f"user_{sender_id}.json")
+
+# Suhbat tarixi omborlari. Kalit: (chat_id, sender_id, is_private).
+# load (history, last_activity, summary) qaytaradi.
+# write_batch elementlari: (key, (history, new_turns, last_activity, summary)); saqlanmagan kalitlar ro'yxati qaytariladi.
+# Barcha metodlar bloklovchi, ular asyncio.to_thread orqali chaqiriladi.
+
+class JsonHistoryStore:
+    """Eski ko'rinish: har bir foydalanuvchi uchun alohida JSON fayl."""
+
+    def __init__(self, root_dir):
+        self.root_dir = root_dir
+        self._known_dirs = set()
+
+    def load(self, key):
+        file_path = get_chat_history_file_path(*key)
+        if os.path.exists(file_path):
+            try:
+                with open(file_path, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+                    return data.get("history", []), data.get("last_activity", 0), data.get("summary", "")
+            except (json.JSONDecodeError, Exception):
+                pass
+        return [], 0, ""
+
+    def write_batch(self, items):
+        failed = []
+        for key, (history, _, last_activity, summary) in items:
+            file_path = get_chat_history_file_path(*key)
+            try:
+                history_dir = os.path.dirname(file_path)
+                if history_dir not in self._known_dirs:
+                    os.makedirs(history_dir, exist_ok=True)
+                    self._known_dirs.add(history_dir)
+                atomic_write_json(file_path, {"history": history, "last_activity": last_activity, "summary": summary})
+            except Exception as e:
+                logging.error(f"Suhbat tarixini saqlashda xatolik: {e}", exc_info=True)
+                failed.append(key)
+        return failed
+
+    def delete(self, key):
+        file_path = get_chat_history_file_path(*key)
+        if os.path.exists(file_path):
+            os.remove(file_path)
+            return True
+        return False
+
+    def purge_chat(self, chat_id):
+        removed = 0
+        group_dir = os.path.join(self.root_dir, 'group', str(chat_id))
+        if os.path.isdir(group_dir):
+            for name in os.listdir(group_dir):
+                os.remove(os.path.join(group_dir, name))
+                removed += 1
+            os.rmdir(group_dir)
+            self._known_dirs.discard(group_dir)
+        if self.delete((chat_id, chat_id, True)):
+            removed += 1
+        return removed
+
+    def iter_all(self):
+        for sub, is_private in (('user', True), ('group', False)):
+            base = os.path.join(self.root_dir, sub)
+            if not os.path.isdir(base):
+                continue
+            for dirpath, _, filenames in os.walk(base):
+                if not is_private and dirpath == base:
+                    continue
+                for name in filenames:
+                    match = re.fullmatch(r"user_(-?\d+)\.json", name)
+                    if not match:
+                        continue
+                    sender_id = int(match.group(1))
+                    chat_id = sender_id if is_private else int(os.path.basename(dirpath))
+                    key = (chat_id, sender_id, is_private)
+                    yield key, self.load(key)
+
+    def close(self):
+        pass
+
+class SqliteHistoryStore:
+    """Barcha suhbatlar bitta WAL rejimidagi SQLite faylida; har bir navbat alohida qator sifatida qo'shiladi."""
+
+    def __init__(self, db_path, max_turns):
+        self.db_path = db_path
+        self.max_turns = max_turns
+        self._db = None
+        self._lock = threading.Lock()
+
+    def _conn(self):
+        if self._db is None:
+            db = sqlite3.connect(self.db_path, check_same_thread=False)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.execute("PRAGMA foreign_keys=ON")
+            db.executescript("""
+                CREATE TABLE IF NOT EXISTS conversations (
+                    id INTEGER PRIMARY KEY,
+                    chat_id INTEGER NOT NULL,
+                    sender_id INTEGER NOT NULL,
+                    is_private INTEGER NOT NULL,
+                    last_activity REAL NOT NULL DEFAULT 0,
+                    UNIQUE (chat_id, sender_id, is_private)
+                );
+                CREATE INDEX IF NOT EXISTS idx_conversations_sender ON conversations (sender_id);
+                CREATE TABLE IF NOT EXISTS turns (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    conversation_id INTEGER NOT NULL REFERENCES conversations (id) ON DELETE CASCADE,
+                    role TEXT NOT NULL,
+                    parts TEXT NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS idx_turns_conversation ON turns (conversation_id, id);
+                CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+            """)
+            if "summary" not in [row[1] for row in db.execute("PRAGMA table_info(conversations)")]:
+                db.execute("ALTER TABLE conversations ADD COLUMN summary TEXT NOT NULL DEFAULT ''")
+            self._db = db
+        return self._db
+
+    def _conversation_id(self, db, key, create=False):
+        chat_id, sender_id, is_private = key
+        row = db.execute("SELECT id FROM conversations WHERE chat_id = ? AND sender_id = ? AND is_private = ?", (chat_id, sender_id, int(is_private))).fetchone()
+        if row or not create:
+            return row[0] if row else None
+        return db.execute("INSERT INTO conversations (chat_id, sender_id, is_private) VALUES (?, ?, ?)", (chat_id, sender_id, int(is_private))).lastrowid
+
+    def load(self, key):
+        with self._lock:
+            db = self._conn()
+            conversation_id = self._conversation_id(db, key)
+            if conversation_id is None:
+                return [], 0, ""
+            last_activity, summary = db.execute("SELECT last_activity, summary FROM conversations WHERE id = ?", (conversation_id,)).fetchone()
+            rows = db.execute("SELECT role, parts FROM turns WHERE conversation_id = ? ORDER BY id", (conversation_id,)).fetchall()
+            return [{"role": role, "parts": json.loads(parts)} for role, parts in rows], last_activity, summary
+
+    def write_batch(self, items):
+        with self._lock:
+            db = self._conn()
+            try:
+                with db:
+                    for key, (history, new_turns, last_activity, summary) in items:
+                        conversation_id = self._conversation_id(db, key, create=True)
+                        db.execute("UPDATE conversations SET last_activity = ?, summary = ? WHERE id = ?", (last_activity, summary, conversation_id))
+                        db.executemany("INSERT INTO turns (conversation_id, role, parts) VALUES (?, ?, ?)",
+                                       [(conversation_id, turn["role"], json.dumps(turn["parts"], ensure_ascii=False)) for turn in new_turns])
+                        db.execute("DELETE FROM turns WHERE conversation_id = ? AND id NOT IN "
+                                   "(SELECT id FROM turns WHERE conversation_id = ? ORDER BY id DESC LIMIT ?)",
+                                   (conversation_id, conversation_id, min(self.max_turns, len(history))))
+                return []
+            except sqlite3.Error as e:
+                logging.error(f"Suhbat tarixini SQLite ga yozishda xatolik: {e}", exc_info=True)
+                return [key for key, _ in items]
+
+    def delete(self, key):
+        with self._lock, self._conn() as db:
+            chat_id, sender_id, is_private = key
+            return db.execute("DELETE FROM conversations WHERE chat_id = ? AND sender_id = ? AND is_private = ?", (chat_id, sender_id, int(is_private))).rowcount > 0
+
+    def purge_chat(self, chat_id):
+        with self._lock, self._conn() as db:
+            return db.execute("DELETE FROM conversations WHERE chat_id = ?", (chat_id,)).rowcount
+
+    def get_meta(self, key):
+        with self._lock:
+            row = self._conn().execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+            return row[0] if row else None
+
+    def set_meta(self, key, value):
+        with self._lock, self._conn() as db:
+            db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+def create_history_store():
+    if HISTORY_BACKEND == "json":
+        return JsonHistoryStore(CHAT_HISTORY_DIR)
+    return SqliteHistoryStore(HISTORY_DB_FILE, HISTORY_MAX_TURNS)
+
+def migrate_json_histories(store, batch_size=500):
+    """Eski JSON tarix fayllarini SQLite omboriga bir marta ko'chiradi. JSON fayllar o'chirilmaydi."""
+    if not isinstance(store, SqliteHistoryStore) or store.get_meta("json_migrated"):
+        return 0
+    migrated, batch = 0, []
+    for key, (history, last_activity, summary) in JsonHistoryStore(CHAT_HISTORY_DIR).iter_all():
+        history = history[-HISTORY_MAX_TURNS:]
+        batch.append((key, (history, history, last_activity, summary)))
+        if len(batch) >= batch_size:
+            migrated += len(batch) - len(store.write_batch(batch))
+            batch = []
+    if batch:
+        migrated += len(batch) - len(store.write_batch(batch))
+    store.set_meta("json_migrated", str(time.time()))
+    if migrated:
+        logging.info(f"{migrated} ta suhbat tarixi JSON fayllardan SQLite ga ko'chirildi.")
+    return migrated
+
+def estimate_tokens(text):
+    # Taxminiy hisob: o'rtacha bir token ~4 belgi
+    return len(text) // 4 + 1
+
+def turn_tokens(turn):
+    return sum(estimate_tokens(part.get("text", "")) for part in turn["parts"]) + 4
+
+def trim_to_budget(history, max_turns, budget):
+    """Tarixni navbatlar soni va token byudjetiga moslaydi; (qoldirilgan, chiqarib tashlangan) qaytaradi."""
+    keep, used = [], 0
+    for turn in reversed(history[-max_turns:]):
+        cost = turn_tokens(turn)
+        if keep and used + cost > budget:
+            break
+        keep.append(turn)
+        used += cost
+    keep.reverse()
+    return keep, history[:len(history) - len(keep)]
+
+def context_budget(summary):
+    """Navbatlar uchun token byudjeti. Xulosa contents ga emas, systemInstruction ga qo'shiladi
+    (build_gemini_request), lekin u ham byudjetdan joy oladi."""
+    return max(CONTEXT_TOKEN_BUDGET - (estimate_tokens(summary) if summary else 0), 0)
+
+def build_context(history, summary):
+    """Gemini contents: byudjetga sig'adigan oxirgi navbatlar. Saqlangan tarix append va set_summary da shu
+    byudjetga qirqiladi, bu yerda faqat eski yozuvlar uchun qayta tekshiriladi."""
+    context, _ = trim_to_budget(history, len(history), context_budget(summary))
+    while context and context[0]["role"] != "user":
+        context = context[1:]
+    return context
+
+class ChatHistoryCache:
+    """(chat_id, sender_id, is_private) bo'yicha LRU kesh. O'zgargan tarixlar fon vazifasida to'plab omborga yoziladi.
+    Byudjetdan chiqib ketgan navbatlar summary_backlog ga tushadi va fon vazifasi ularni xulosaga qo'shadi.
+    summary_backlog faqat xotirada: qayta ishga tushganda xulosaga hali qo'shilmagan navbatlar yo'qoladi. Bu ataylab
+    qabul qilingan - xulosa taxminiy kontekst, navbatlarni omborda saqlash esa har bir yozuvni og'irlashtirardi."""
+
+    def __init__(self, store, max_entries, idle_seconds, flush_interval):
+        self.store = store
+        self.max_entries = max_entries
+        self.idle_seconds = idle_seconds
+        self.flush_interval = flush_interval
+        self._entries = OrderedDict()  # key -> [history, last_activity, last_access, summary]
+        self._pending = {}  # key -> (history, new_turns, last_activity, summary), hali yozilmagan
+        self._flushing = {}
+        self._flush_lock = asyncio.Lock()
+        self.summary_backlog = {}  # key -> xulosaga qo'shilmagan eski navbatlar
+        self.summary_needed = asyncio.Event()
+        self._generations = {}  # key yoki chat_id -> tozalashlar soni: tozalangan tarixga eski xulosa yozilmasin
+
+    async def get(self, chat_id, sender_id, is_private):
+        history, last_activity, _ = await self._load_entry((chat_id, sender_id, is_private))
+        return list(history), last_activity
+
+    async def get_context(self, chat_id, sender_id, is_private):
+        """(contents, xulosa) qaytaradi."""
+        history, _, summary = await self._load_entry((chat_id, sender_id, is_private))
+        return build_context(history, summary), summary
+
+    async def _load_entry(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            snapshot = self._pending.get(key) or self._flushing.get(key)
+            if snapshot is None:
+                async with metrics.track("io", "history_load"):
+                    history, last_activity, summary = await asyncio.to_thread(self.store.load, key)
+            else:
+                history, _, last_activity, summary = snapshot
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = self._entries[key] = [list(history), last_activity, 0, summary]
+                self._evict_overflow()
+        self._entries.move_to_end(key)
+        entry[2] = time.monotonic()
+        return entry[0], entry[1], entry[3]
+
+    def _mark_dirty(self, key, entry, new_turns):
+        pending = self._pending.get(key)
+        self._pending[key] = (entry[0], (pending[1] if pending else []) + list(new_turns), entry[1], entry[3])
+
+    async def append(self, chat_id, sender_id, is_private, turns, last_activity):
+        key = (chat_id, sender_id, is_private)
+        history, _, summary = await self._load_entry(key)
+        history = self._trim(key, history + list(turns), summary)
+        entry = self._entries[key] = [history, last_activity, time.monotonic(), summary]
+        self._entries.move_to_end(key)
+        self._mark_dirty(key, entry, turns)
+        self._evict_overflow()
+
+    def _trim(self, key, history, summary):
+        """Tarixni xulosadan qolgan byudjetga qirqadi; chiqib ketgan navbatlar xulosaga qo'shish uchun navbatga tushadi."""
+        history, dropped = trim_to_budget(history, HISTORY_MAX_TURNS, context_budget(summary))
+        if dropped:
+            self.summary_backlog.setdefault(key, []).extend(dropped)
+            self.summary_needed.set()
+        return history
+
+    async def get_summary(self, key):
+        _, _, summary = await self._load_entry(key)
+        return summary
+
+    def generation(self, key):
+        return self._generations.get(key, 0), self._generations.get(key[0], 0)
+
+    async def set_summary(self, key, summary, generation):
+        """generation - xulosa uchun navbatlar olingan paytdagi generation(key). O'shandan beri tarix
+        (.adm clear history / clear chat history) tozalangan bo'lsa, xulosa yozilmaydi va False qaytadi."""
+        await self._load_entry(key)
+        if generation != self.generation(key):
+            return False
+        entry = self._entries[key]
+        # Xulosa uzaygan bo'lsa navbatlar byudjeti qisqaradi: sig'maganlari keyingi xulosaga o'tadi
+        entry[0], entry[3] = self._trim(key, entry[0], summary), summary
+        self._mark_dirty(key, entry, [])
+        return True
+
+    async def discard(self, chat_id, sender_id, is_private):
+        key = (chat_id, sender_id, is_private)
+        self._generations[key] = self._generations.get(key, 0) + 1
+        async with self._flush_lock:
+            self.summary_backlog.pop(key, None)
+            cached = self._entries.pop(key, None) is not None
+            cached = self._pending.pop(key, None) is not None or cached
+            return await asyncio.to_thread(self.store.delete, key) or cached
+
+    async def purge_chat(self, chat_id):
+        self._generations[chat_id] = self._generations.get(chat_id, 0) + 1
+        async with self._flush_lock:
+            for mapping in (self._entries, self._pending, self.summary_backlog):
+                for key in [key for key in mapping if key[0] == chat_id]:
+                    del mapping[key]
+            return await asyncio.to_thread(self.store.purge_chat, chat_id)
+
+    def _evict_overflow(self):
+        # Yozilmagan yozuvlar _pending da qoladi, shuning uchun ularni keshdan chiqarish xavfsiz
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _evict_idle(self):
+        deadline = time.monotonic() - self.idle_seconds
+        for key in [key for key, entry in self._entries.items() if entry[2] < deadline]:
+            del self._entries[key]
+
+    @metrics.timed("io", "history_flush")
+    async def flush(self):
+        async with self._flush_lock:
+            if not self._pending:
+                return 0
+            self._flushing, self._pending = self._pending, {}
+            try:
+                failed = await asyncio.to_thread(self.store.write_batch, list(self._flushing.items()))
+                for key in failed:
+                    # Keyingi urinishda yozilmagan navbatlar yangilari bilan birga yuboriladi
+                    history, new_turns, last_activity, summary = self._flushing[key]
+                    newer = self._pending.get(key)
+                    self._pending[key] = (newer[0], new_turns + newer[1], newer[2], newer[3]) if newer else (history, new_turns, last_activity, summary)
+                return len(self._flushing) - len(failed)
+            finally:
+                self._flushing = {}
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+                self._evict_idle()
+            except Exception as e:
+                logging.error(f"Suhbat tarixlarini omborga yozishda xatolik: {e}", exc_info=True)
+
+    async def close(self):
+        await self.flush()
+        await asyncio.to_thread(self.store.close)
+
+history_cache = ChatHistoryCache(create_history_store(), HISTORY_CACHE_SIZE, HISTORY_IDLE_SECONDS, HISTORY_FLUSH_INTERVAL)
+
+class GeminiBlockedError(Exception):
+    pass
+
+def gemini_user_turn(prompt):
+    return {"role": "user", "parts": [{"text": prompt[:MAX_MESSAGE_LENGTH]}]}
+
+def format_gemini_text(text):
+    return re.sub(r"^\*\s(?![\*\s])", "• ", text, flags=re.MULTILINE)
+
+async def remember_gemini_exchange(chat_id, sender_id, is_private, prompt, response_text):
+    await history_cache.append(chat_id, sender_id, is_private, [gemini_user_turn(prompt), {"role": "model", "parts": [{"text": response_text[:MAX_MESSAGE_LENGTH]}]}], time.time())
+
+# Gemini chidamliligi: urinish vaqti cheklangan, sekin urinish p95 dan keyin takrorlanadi (hedge),
+# 5xx/429/timeoutda jitterli qayta urinish, upstream nosog'lom bo'lsa circuit breaker darhol rad etadi
+GEMINI_ATTEMPT_TIMEOUT = float(os.environ.get("GEMINI_ATTEMPT_TIMEOUT", 30))
+GEMINI_DEADLINE = float(os.environ.get("GEMINI_DEADLINE", 60))
+GEMINI_RETRIES = int(os.environ.get("GEMINI_RETRIES", 2))
+GEMINI_RETRY_BASE = float(os.environ.get("GEMINI_RETRY_BASE", 0.5))
+GEMINI_RETRY_MAX = float(os.environ.get("GEMINI_RETRY_MAX", 8))
+GEMINI_HEDGE = os.environ.get("GEMINI_HEDGE", "1") == "1"
+GEMINI_HEDGE_DEFAULT_DELAY = float(os.environ.get("GEMINI_HEDGE_DEFAULT_DELAY", 4))
+GEMINI_HEDGE_MIN_DELAY = float(os.environ.get("GEMINI_HEDGE_MIN_DELAY", 1))
+GEMINI_HEDGE_MAX_DELAY = float(os.environ.get("GEMINI_HEDGE_MAX_DELAY", 15))
+GEMINI_HEDGE_MIN_SAMPLES = 20
+CIRCUIT_FAILURE_THRESHOLD = int(os.environ.get("CIRCUIT_FAILURE_THRESHOLD", 5))
+CIRCUIT_RESET_SECONDS = float(os.environ.get("CIRCUIT_RESET_SECONDS", 30))
+
+class CircuitOpenError(Exception):
+    pass
+
+class CircuitBreaker:
+    """Ketma-ket threshold ta xatodan keyin ochiladi va reset_seconds davomida chaqiruvlarni darhol rad etadi.
+    Keyin bitta sinov chaqiruvi o'tkaziladi (half-open): muvaffaqiyatli bo'lsa yopiladi, aks holda yana ochiladi."""
+
+    def __init__(self, name, threshold, reset_seconds):
+        self.name = name
+        self.threshold = threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_at = None
+        self.opens = 0
+        self.rejected = 0
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        return "half-open" if time.monotonic() - self.opened_at >= self.reset_seconds else "open"
+
+    def allow(self):
+        state = self.state
+        if state == "open":
+            self.rejected += 1
+            return False
+        if state == "half-open":
+            # Sinov chaqiruvi natijasi kelguncha qolganlar yana reset_seconds kutadi
+            self.opened_at = time.monotonic()
+        return True
+
+    def record_success(self):
+        if self.opened_at is not None:
+            logging.info(f"'{self.name}' circuit breaker yopildi.")
+        self.failures = 0
+        self.opened_at = None
+
+    def record_failure(self):
+        self.failures += 1
+        if self.opened_at is None and self.failures >= self.threshold:
+            self.opens += 1
+            logging.warning(f"'{self.name}' circuit breaker ochildi: {self.failures} ta ketma-ket xato.")
+        if self.opened_at is not None or self.failures >= self.threshold:
+            self.opened_at = time.monotonic()
+
+gemini_breaker = CircuitBreaker("gemini", CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_SECONDS)
+gemini_fallback_breaker = CircuitBreaker("gemini_fallback", CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_SECONDS)
+gemini_attempt_latency = Histogram()  # faqat muvaffaqiyatli urinishlar: hedge kechikishi shu p95 dan olinadi
+gemini_hedge_stats = {"fired": 0, "won": 0}
+
+def is_retryable_error(error):
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code == 429 or error.response.status_code >= 500
+    return isinstance(error, (httpx.TransportError, asyncio.TimeoutError))
+
+def gemini_retry_delay(attempt, error):
+    delay = random.uniform(0, min(GEMINI_RETRY_MAX, GEMINI_RETRY_BASE * 2 ** attempt))
+    if isinstance(error, httpx.HTTPStatusError) and error.response.status_code == 429:
+        delay = max(delay, retry_after_seconds(error.response, default=1.0))
+    return delay
 
-def load_chat_history(chat_id, sender_id, is_private):
-    file_path = get_chat_history_file_path(chat_id, sender_id, is_private)
-    if os.path.exists(file_path):
+def gemini_hedge_delay():
+    if gemini_attempt_latency.count < GEMINI_HEDGE_MIN_SAMPLES:
+        return GEMINI_HEDGE_DEFAULT_DELAY
+    return min(max(gemini_attempt_latency.percentiles(0.95)[0], GEMINI_HEDGE_MIN_DELAY), GEMINI_HEDGE_MAX_DELAY)
+
+async def gemini_attempt(model_url, request_data, timeout):
+    start = time.monotonic()
+    async with metrics.track("upstream", "gemini_attempt"):
+        api_url = f"{model_url}:generateContent?key={gemini_api_key}"
+        response = await asyncio.wait_for(get_http_client("gemini").post(api_url, headers={'Content-Type': 'application/json'}, json=request_data), timeout)
+        check_upstream_response("gemini", response)
+        json_response = response.json()
+    gemini_attempt_latency.observe(time.monotonic() - start)
+    if "candidates" in json_response and json_response["candidates"]:
+        return format_gemini_text(json_response["candidates"][0]["content"]["parts"][0]["text"])
+    raise GeminiBlockedError(json_response.get('promptFeedback', {}).get('blockReason', 'Noma\'lum'))
+
+async def hedged_gemini_call(model_url, request_data, deadline):
+    """Urinish p95 kechikishdan oshib ketsa, ikkinchi nusxa yuboriladi (kvotada token bo'lsa); qaysi biri
+    oldin muvaffaqiyatli tugasa o'sha olinadi, qolgani bekor qilinadi. Bitta nusxa xato bersa, qolgani kutiladi;
+    hammasi xato bo'lsa qayta urinib bo'lmaydigan xato afzal ko'riladi."""
+    timeout = lambda: max(0.1, min(GEMINI_ATTEMPT_TIMEOUT, deadline - time.monotonic()))
+    primary = asyncio.create_task(gemini_attempt(model_url, request_data, timeout()))
+    pending, error = {primary}, None
+    try:
+        if GEMINI_HEDGE:
+            done, _ = await asyncio.wait(pending, timeout=gemini_hedge_delay())
+            if not done and await limiter.acquire("gemini"):
+                gemini_hedge_stats["fired"] += 1
+                pending.add(asyncio.create_task(gemini_attempt(model_url, request_data, timeout())))
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    if task is not primary:
+                        gemini_hedge_stats["won"] += 1
+                    return task.result()
+                if error is None or not is_retryable_error(task.exception()):
+                    error = task.exception()
+        raise error
+    finally:
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+
+async def call_gemini_resilient(breaker, model_url, request_data, deadline):
+    """Cheklangan sonli qayta urinish (jitterli eksponensial kutish, 429 da Retry-After hisobga olinadi).
+    Birinchi urinish tokeni chaqiruvchida olinadi, har bir qayta urinish o'z tokenini oladi; token bo'lmasa oxirgi xato ko'tariladi."""
+    for attempt in range(GEMINI_RETRIES + 1):
+        if not breaker.allow():
+            raise CircuitOpenError(breaker.name)
         try:
-            with open(file_path, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-                return data.get("history", []), data.get("last_activity", 0)
-        except (json.JSONDecodeError, Exception):
-            pass
-    return [], 0
+            text = await hedged_gemini_call(model_url, request_data, deadline)
+        except Exception as e:
+            if not is_retryable_error(e):
+                breaker.record_success()  # upstream javob berdi: 4xx yoki bloklangan javob uning sog'lig'iga ta'sir qilmaydi
+                raise
+            breaker.record_failure()
+            delay = gemini_retry_delay(attempt, e)
+            if attempt == GEMINI_RETRIES or time.monotonic() + delay >= deadline:
+                raise
+            logging.info(f"Gemini xatosi ({type(e).__name__}), {delay:.1f} soniyadan keyin qayta urinish.")
+            await asyncio.sleep(delay)
+            if not await limiter.acquire("gemini"):
+                raise
+        else:
+            breaker.record_success()
+            return text
 
-def save_chat_history(chat_id, sender_id, is_private, history, last_activity):
-    file_path = get_chat_history_file_path(chat_id, sender_id, is_private)
+@metrics.timed("upstream", "gemini")
+async def generate_gemini_text(context, prompt, max_wait=GEMINI_MAX_WAIT, summary=""):
+    """Gemini dan javob matnini oladi. Javob bloklansa GeminiBlockedError, kvota tugagan bo'lsa RateLimitedError,
+    asosiy va zaxira model ham yopiq bo'lsa CircuitOpenError ko'tariladi. Umumiy vaqt GEMINI_DEADLINE bilan cheklangan."""
+    if not await limiter.acquire("gemini", max_wait=max_wait):
+        raise RateLimitedError("gemini")
+    contents = context + [gemini_user_turn(prompt)]
+    deadline = time.monotonic() + GEMINI_DEADLINE
     try:
-        with open(file_path, 'w', encoding='utf-8') as f:
-            json.dump({"history": history, "last_activity": last_activity}, f, indent=4, ensure_ascii=False)
+        model_url, request_data = await build_gemini_request(contents, summary=summary)
+        return await call_gemini_resilient(gemini_breaker, model_url, request_data, deadline)
     except Exception as e:
-        logging.error(f"Suhbat tarixini saqlashda xatolik: {e}", exc_info=True)
+        if not GEMINI_FALLBACK_API_URL or not (isinstance(e, CircuitOpenError) or is_retryable_error(e)) or time.monotonic() >= deadline:
+            raise
+        if not await limiter.acquire("gemini"):
+            raise
+        logging.warning(f"Asosiy Gemini modeli ishlamayapti ({type(e).__name__}), zaxira modelga o'tilmoqda.")
+        _, request_data = await build_gemini_request(contents, use_cache=False, summary=summary)
+        return await call_gemini_resilient(gemini_fallback_breaker, GEMINI_FALLBACK_API_URL, request_data, deadline)
 
-async def get_gemini_response(prompt, chat_id, sender_id, is_private):
-    try:
-        history, _ = load_chat_history(chat_id, sender_id, is_private)
-        contents = []
-        persona = load_persona()
-        if persona:
-            persona_parts = [f"Sizning rolingiz: {persona.get('role')}", f"Javob berish uslubingiz: {persona.get('style')}", f"Kontekst/Misol: {persona.get('context_example')}", f"Admin haqida: {persona.get('admin')}"]
-            full_persona_text = "\n".join(filter(None, persona_parts))
-            if full_persona_text:
-                contents.extend([{"role": "user", "parts": [{"text": f"Sizning shaxsiyatingiz va ko'rsatmalar:\n{full_persona_text}"}]}, {"role": "model", "parts": [{"text": "Tushundim."}]}])
-
-        contents.extend(history)
-        contents.append({"role": "user", "parts": [{"text": prompt[:MAX_MESSAGE_LENGTH]}]})
-        request_data = {"contents": contents, "generationConfig": {"temperature": 1, "maxOutputTokens": 4096, "topP": 0.95}, "safetySettings": [{"category": c, "threshold": "BLOCK_NONE"} for c in ["HARM_CATEGORY_HATE_SPEECH", "HARM_CATEGORY_DANGEROUS_CONTENT", "HARM_CATEGORY_SEXUALLY_EXPLICIT", "HARM_CATEGORY_HARASSMENT"]], "tools": [{"googleSearch": {}}]}
-        headers = {'Content-Type': 'application/json'}
-        async with httpx.AsyncClient() as client_http:
-            api_url = f"{GEMINI_BASE_API_URL}:generateContent?key={gemini_api_key}"
-            response = await client_http.post(api_url, headers=headers, json=request_data, timeout=120)
-            response.raise_for_status()
-            json_response = response.json()
-
-        if "candidates" in json_response and json_response["candidates"]:
-            response_text = json_response["candidates"][0]["content"]["parts"][0]["text"]
-            response_text = re.sub(r"^\*\s(?![\*\s])", "• ", response_text, flags=re.MULTILINE)
-            history.append({"role": "user", "parts": [{"text": prompt[:MAX_MESSAGE_LENGTH]}]})
-            history.append({"role": "model", "parts": [{"text": response_text[:MAX_MESSAGE_LENGTH]}]})
-            save_chat_history(chat_id, sender_id, is_private, history[-10:], time.time())
-            return response_text
-        else:
-            error_reason = json_response.get('promptFeedback', {}).get('blockReason', 'Noma\'lum')
-            return f"AI javob berishda qiyinchilikka uchradi. Sabab: {error_reason}"
-    except httpx.RequestError:
+def shared_answer_key(prompt):
+    """Umumiy ombordagi kalit: persona va model izi hamda normallashtirilgan prompt. Chat, xabar va yuboruvchi
+    IDlari kirmaydi, shuning uchun bir xil personali akkauntlar bir xil savolga bitta javobni bo'lishadi."""
+    persona = hashlib.sha256(f"{GEMINI_BASE_API_URL}\n{persona_prefix.refresh()}".encode()).hexdigest()[:16]
+    return "ai:" + json.dumps([persona, normalize_text(prompt) or prompt.strip()], ensure_ascii=False)
+
+async def generate_shared_gemini_text(context, prompt, max_wait, summary=""):
+    """Umumiy ombor yoqilgan bo'lsa, boshqa akkauntlar olgan javob qayta ishlatiladi. Faqat tarixsiz
+    (context va xulosa bo'sh) so'rovlar bo'lishiladi: tarixli javob bitta suhbatga tegishli."""
+    if shared_store is None or context or summary:
+        return await generate_gemini_text(context, prompt, max_wait, summary)
+    shared_key = shared_answer_key(prompt)
+    response_text = await asyncio.to_thread(shared_store.get, shared_key)
+    if response_text is None:
+        response_text = await generate_gemini_text(context, prompt, max_wait, summary)
+        await asyncio.to_thread(shared_store.set, shared_key, response_text, AI_CACHE_TTL)
+    return response_text
+
+def context_fingerprint(context):
+    return hashlib.sha256(json.dumps(context, ensure_ascii=False, sort_keys=True).encode()).hexdigest()[:16]
+
+def gemini_error_text(error):
+    """Gemini xatosi uchun foydalanuvchiga ko'rsatiladigan matn; kvota to'lgan bo'lsa None (javob berilmaydi)."""
+    if isinstance(error, RateLimitedError):
+        logging.warning("Gemini limiti to'lgan, so'rov rad etildi.")
+        return None
+    if isinstance(error, CircuitOpenError):
+        return "AI vaqtincha ishlamayapti, birozdan keyin urinib ko'ring."
+    if isinstance(error, GeminiBlockedError):
+        return f"AI javob berishda qiyinchilikka uchradi. Sabab: {error}"
+    if isinstance(error, httpx.RequestError):
         return "Tashqi API bilan bog'lanishda xatolik yuz berdi."
-    except Exception as e:
-        masked_error = mask_sensitive_info(str(e), gemini_api_key, GEMINI_BASE_API_URL)
-        logging.error(f"Kutilmagan xatolik: {masked_error}", exc_info=True)
-        return "Kutilmagan xatolik yuz berdi."
+    masked_error = mask_sensitive_info(str(error), gemini_api_key, GEMINI_BASE_API_URL)
+    logging.error(f"Kutilmagan xatolik: {masked_error}", exc_info=error)
+    return "Kutilmagan xatolik yuz berdi."
 
-async def get_account_stats():
-    stats = {'users': 0, 'groups': 0, 'channels': 0, 'bots': 0, 'unread': 0}
-    async for dialog in client.iter_dialogs():
-        if dialog.is_user:
-            if dialog.entity.bot: stats['bots'] += 1
-            else: stats['users'] += 1
-        elif dialog.is_group: stats['groups'] += 1
-        elif dialog.is_channel: stats['channels'] += 1
-        stats['unread'] += dialog.unread_count
-    return stats
+async def generate_gemini_answer(prompt, chat_id, sender_id, is_private, context_key=None, max_wait=GEMINI_MAX_WAIT):
+    """context_key berilsa (masalan, bir xil bot xabariga reply), bir xil normallashtirilgan so'rovlar
+    bitta Gemini chaqiruvini bo'lishadi va javob AI_CACHE_TTL davomida keshdan beriladi. Javob yuboruvchining
+    suhbat tarixidan tuziladi, shuning uchun kalitda tarix izi bor: tarixi bir xil (masalan, bo'sh) foydalanuvchilar
+    bitta javobni bo'lishadi, boshqa tarixli so'rov yoki tarix yangilangach takroriy so'rov eski javobni olmaydi.
+    Xatolar ko'tariladi va tarixga hech narsa yozilmaydi: buni javobni yuborgan chaqiruvchi qiladi."""
+    context, summary = await history_cache.get_context(chat_id, sender_id, is_private)
+    if context_key is None:
+        return await generate_gemini_text(context, prompt, max_wait, summary)
+    cache_key = ("gemini", context_key, context_fingerprint([summary, context]), normalize_text(prompt) or prompt.strip())
+    response_text = ai_response_cache.get(cache_key)
+    if response_text is None:
+        response_text = await ai_single_flight.do(cache_key, lambda: generate_shared_gemini_text(context, prompt, max_wait, summary))
+        ai_response_cache.set(cache_key, response_text)
+    return response_text
 
-def load_active_groups(filename="active_groups.json"):
+async def get_gemini_response(prompt, chat_id, sender_id, is_private, context_key=None, max_wait=GEMINI_MAX_WAIT):
+    """generate_gemini_answer + suhbat tarixiga yozish. Xatolar foydalanuvchiga ko'rsatiladigan matnga aylantiriladi,
+    Gemini kvotasi max_wait ichida bo'shamasa None qaytariladi."""
     try:
-        with open(filename, 'r', encoding='utf-8') as f:
-            return json.load(f).get("groups", [])
-    except (FileNotFoundError, json.JSONDecodeError):
-        return []
+        response_text = await generate_gemini_answer(prompt, chat_id, sender_id, is_private, context_key, max_wait)
+    except Exception as e:
+        return gemini_error_text(e)
+    await remember_gemini_exchange(chat_id, sender_id, is_private, prompt, response_text)
+    return response_text
 
-def save_active_groups(group_ids, filename="active_groups.json"):
+async def stream_gemini_response(prompt, chat_id, sender_id, is_private):
+    """Javobni :streamGenerateContent (SSE) orqali bo'laklab qaytaradi; oqim tugagach suhbat tarixiga yoziladi."""
+    if not await limiter.acquire("gemini", max_wait=GEMINI_MAX_WAIT):
+        raise RateLimitedError("gemini")
+    context, summary = await history_cache.get_context(chat_id, sender_id, is_private)
+    contents = context + [gemini_user_turn(prompt)]
+    # Oqimni takrorlab bo'lmaydi: faqat circuit breaker va zaxira model qo'llanadi
+    if gemini_breaker.allow():
+        breaker, (model_url, request_data) = gemini_breaker, await build_gemini_request(contents, summary=summary)
+    elif GEMINI_FALLBACK_API_URL and gemini_fallback_breaker.allow():
+        breaker, model_url, (_, request_data) = gemini_fallback_breaker, GEMINI_FALLBACK_API_URL, await build_gemini_request(contents, use_cache=False, summary=summary)
+    else:
+        raise CircuitOpenError("gemini")
+    api_url = f"{model_url}:streamGenerateContent?alt=sse&key={gemini_api_key}"
+    chunks = []
     try:
-        with open(filename, 'w', encoding='utf-8') as f:
-            json.dump({"groups": group_ids}, f, indent=4)
+        # Faqat upstream vaqti o'lchanadi: bo'lak yield qilingandan keyin Telegram tahrirlariga ketgan vaqt chiqariladi
+        async with metrics.track("upstream", "gemini_stream") as excluded, get_http_client("gemini").stream("POST", api_url, json=request_data) as response:
+            check_upstream_response("gemini", response)
+            async for line in response.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                data = json.loads(line[5:])
+                block_reason = data.get("promptFeedback", {}).get("blockReason")
+                if block_reason:
+                    raise GeminiBlockedError(block_reason)
+                candidates = data.get("candidates") or []
+                text = "".join(part.get("text", "") for part in candidates[0].get("content", {}).get("parts", [])) if candidates else ""
+                if text:
+                    chunks.append(text)
+                    paused = time.monotonic()
+                    try:
+                        yield text
+                    finally:
+                        excluded[0] += time.monotonic() - paused
     except Exception as e:
-        logging.error(f"Faol guruhlar faylini saqlashda xatolik: {e}")
+        if is_retryable_error(e):
+            breaker.record_failure()
+        raise
+    breaker.record_success()
+    if chunks:
+        await remember_gemini_exchange(chat_id, sender_id, is_private, prompt, format_gemini_text("".join(chunks)))
+
+async def summarize_turns(summary, turns):
+    transcript = "\n".join(f"{'Foydalanuvchi' if turn['role'] == 'user' else 'Siz'}: {' '.join(part.get('text', '') for part in turn['parts'])}" for turn in turns)
+    prompt = (f"Avvalgi xulosa va suhbatning yangi parchasini birlashtirib, ismlar, faktlar va kelishuvlarni saqlagan holda "
+              f"{SUMMARY_MAX_TOKENS} tokendan oshmaydigan qisqa xulosa yoz.\n\nAvvalgi xulosa:\n{summary or 'Yo`q'}\n\nSuhbat:\n{transcript}")
+    request_data = {"contents": [gemini_user_turn(prompt)], "generationConfig": {"temperature": 0.2, "maxOutputTokens": SUMMARY_MAX_TOKENS}}
+    response = await get_http_client("gemini").post(f"{GEMINI_BASE_API_URL}:generateContent?key={gemini_api_key}", json=request_data)
+    check_upstream_response("gemini", response)
+    candidates = response.json().get("candidates") or []
+    return candidates[0]["content"]["parts"][0]["text"].strip() if candidates else None
+
+async def run_summarizer():
+    """Tarixdan chiqib ketgan navbatlarni fon rejimida suhbat xulosasiga qo'shadi; javob berish yo'lini kutdirmaydi."""
+    while True:
+        await history_cache.summary_needed.wait()
+        history_cache.summary_needed.clear()
+        for key in list(history_cache.summary_backlog):
+            turns = history_cache.summary_backlog.pop(key, None)
+            if not turns:
+                continue
+            generation = history_cache.generation(key)
+            try:
+                if not await limiter.acquire("gemini", max_wait=GEMINI_MAX_WAIT):
+                    raise RateLimitedError("gemini")
+                summary = await summarize_turns(await history_cache.get_summary(key), turns)
+                if summary and not await history_cache.set_summary(key, summary, generation):
+                    logging.info("Suhbat tarixi xulosa tayyorlanayotganda tozalandi, xulosa tashlab yuborildi.")
+            except Exception as e:
+                masked_error = mask_sensitive_info(str(e), gemini_api_key, GEMINI_BASE_API_URL)
+                logging.warning(f"Suhbat xulosasini yangilab bo'lmadi, keyinroq qayta uriniladi: {masked_error}")
+                if generation == history_cache.generation(key):
+                    history_cache.summary_backlog[key] = turns + history_cache.summary_backlog.get(key, [])
+                await asyncio.sleep(60)
+                history_cache.summary_needed.set()
+                break
+
+# Dialoglar va entity nomlari keshi: ishga tushganda bir marta to'ldiriladi, keyin update eventlar orqali yangilanadi
+DIALOG_CACHE_FILE = os.environ.get("DIALOG_CACHE_FILE", data_path("dialog_cache.json"))
+DIALOG_REFRESH_INTERVAL = float(os.environ.get("DIALOG_REFRESH_INTERVAL", 1800))
+DIALOG_SAVE_INTERVAL = float(os.environ.get("DIALOG_SAVE_INTERVAL", 60))
+
+def tashkent_tz():
+    # pytz faqat vaqt kerak bo'lganda yuklanadi: ishga tushishni sekinlashtirmasin
+    import pytz
+    return pytz.timezone('Asia/Tashkent')
+
+def dialog_kind(dialog):
+    if dialog.is_user:
+        return "bot" if dialog.entity.bot else "user"
+    if dialog.is_group:
+        return "group"
+    return "channel" if dialog.is_channel else None
+
+class DialogCache:
+    """Akkaunt dialoglarining xotiradagi nusxasi (chat_id -> tur, nom, o'qilmaganlar soni).
+    Statistika va faol guruhlar ro'yxati shu yerdan olinadi; to'liq iter_dialogs faqat davriy yangilashda chaqiriladi.
+    Dialoglar ro'yxatida yo'q entitylarning nomlari (masalan, chiqib ketilgan faol guruh) statistikaga kirmasligi
+    uchun alohida other_titles da saqlanadi."""
+
+    def __init__(self, path):
+        self.path = path
+        self.dialogs = {}
+        self.other_titles = {}
+        self.refreshed_at = 0
+        self._dirty = False
+
+    def load(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            self.dialogs = {int(chat_id): info for chat_id, info in data.get("dialogs", {}).items()}
+            self.refreshed_at = data.get("refreshed_at", 0)
+        except (FileNotFoundError, json.JSONDecodeError, ValueError):
+            self.dialogs = {}
+
+    async def save(self):
+        """Nusxa event loopda olinadi (eventlar dialogs ni o'zgartirib turadi), faylga esa oqimda yoziladi."""
+        if not self._dirty:
+            return
+        self._dirty = False
+        snapshot = {"refreshed_at": self.refreshed_at, "dialogs": {chat_id: dict(info) for chat_id, info in self.dialogs.items()}}
+        try:
+            await asyncio.to_thread(atomic_write_json, self.path, snapshot)
+        except Exception:
+            self._dirty = True
+            raise
+
+    async def refresh(self):
+        dialogs = {}
+        async for dialog in client.iter_dialogs():
+            kind = dialog_kind(dialog)
+            if kind:
+                dialogs[dialog.id] = {"kind": kind, "title": dialog.name, "unread": dialog.unread_count}
+        self.dialogs = dialogs
+        self.refreshed_at = time.time()
+        self._dirty = True
+        logging.info(f"Dialoglar keshi yangilandi: {len(dialogs)} ta dialog.")
+
+    def stats(self):
+        stats = {'users': 0, 'groups': 0, 'channels': 0, 'bots': 0, 'unread': 0}
+        for info in self.dialogs.values():
+            stats[{"user": "users", "bot": "bots", "group": "groups", "channel": "channels"}[info["kind"]]] += 1
+            stats['unread'] += info["unread"]
+        return stats
+
+    async def titles(self, chat_ids):
+        """Nomlarni keshdan beradi; keshda yo'qlarini bitta get_entity chaqiruvida oladi. Paketdagi bitta noto'g'ri
+        ID butun chaqiruvni yiqitsa, entitylar bittalab olinadi va topilmaganlari o'tkazib yuboriladi."""
+        missing = [chat_id for chat_id in chat_ids if chat_id not in self.dialogs and chat_id not in self.other_titles]
+        if missing:
+            try:
+                entities = await client.get_entity(missing)
+            except Exception as e:
+                logging.warning(f"Entitylarni birga olishda xatolik, bittalab olinmoqda: {e}")
+                entities = []
+                for chat_id in missing:
+                    try:
+                        entities.append(await client.get_entity(chat_id))
+                    except Exception as e:
+                        logging.debug(f"{chat_id} entitysini olib bo'lmadi: {e}")
+                        entities.append(None)
+            for chat_id, entity in zip(missing, entities):
+                if entity is not None:
+                    self.other_titles[chat_id] = getattr(entity, 'title', None) or getattr(entity, 'first_name', None)
+        return {chat_id: self.dialogs[chat_id]["title"] if chat_id in self.dialogs else self.other_titles.get(chat_id) for chat_id in chat_ids}
+
+    def on_new_message(self, event):
+        info = self.dialogs.get(event.chat_id)
+        if info is None:
+            chat = event.chat  # update ichida kelgan entity, RPC talab qilmaydi
+            if event.is_private:
+                kind = "bot" if getattr(chat, 'bot', False) else "user"
+            else:
+                kind = "group" if event.is_group else "channel"
+            title = getattr(chat, 'title', None) or getattr(chat, 'first_name', None)
+            info = self.dialogs[event.chat_id] = {"kind": kind, "title": title, "unread": 0}
+        info["unread"] = 0 if event.out else info["unread"] + 1
+        self._dirty = True
+
+    def on_read(self, chat_id):
+        info = self.dialogs.get(chat_id)
+        if info and info["unread"]:
+            info["unread"] = 0
+            self._dirty = True
+
+    def on_chat_action(self, event):
+        if event.new_title and event.chat_id in self.dialogs:
+            self.dialogs[event.chat_id]["title"] = event.new_title
+            self._dirty = True
+        elif (event.user_left or event.user_kicked) and event.user_id == my_telegram_id:
+            self.dialogs.pop(event.chat_id, None)
+            self._dirty = True
+
+    async def run(self):
+        # Diskdagi nusxa yangi bo'lsa, ishga tushishda to'liq yangilash o'tkazib yuboriladi
+        stale = time.time() - self.refreshed_at >= DIALOG_REFRESH_INTERVAL
+        last_refresh = time.monotonic()
+        while True:
+            if stale or time.monotonic() - last_refresh >= DIALOG_REFRESH_INTERVAL:
+                stale = False
+                try:
+                    await self.refresh()
+                except Exception as e:
+                    logging.error(f"Dialoglar keshini yangilashda xatolik: {e}", exc_info=True)
+                last_refresh = time.monotonic()
+            try:
+                await self.save()
+            except Exception as e:
+                logging.error(f"Dialoglar keshini saqlashda xatolik: {e}")
+            await asyncio.sleep(DIALOG_SAVE_INTERVAL)
+
+dialog_cache = DialogCache(DIALOG_CACHE_FILE)
+
+async def get_account_stats():
+    if not dialog_cache.refreshed_at:
+        await dialog_cache.refresh()
+    return dialog_cache.stats()
 
 async def delete_message_after_delay(command_message, reply_message=None, delay=15):
     await asyncio.sleep(delay)
@@ -230,15 +1892,12 @@ async def delete_message_after_delay(command_message, reply_message=None, delay=
     except Exception: pass
 
 async def set_online_status(status: bool):
-    global online_mode
-    online_mode = status
-    settings["online_mode"] = status
-    save_settings(settings)
-    logging.info(f"Online rejim o'zgartirildi: {online_mode}")
+    config.update(online_mode=status)
+    logging.info(f"Online rejim o'zgartirildi: {status}")
 
 async def account_online_loop():
     while True:
-        if online_mode: logging.debug("Account online holatda saqlanmoqda.")
+        if config.get("online_mode"): logging.debug("Account online holatda saqlanmoqda.")
         await asyncio.sleep(DEFAULT_SLEEP_TIME)
 
 async def handle_online_command(event, status):
@@ -252,97 +1911,492 @@ async def handle_online_command(event, status):
         reply_message = await event.reply("Noto'g'ri buyruq. `on` yoki `off` ishlating.")
     asyncio.create_task(delete_message_after_delay(event, reply_message))
 
+# Ommaviy o'chirish: Telegram bitta delete_messages chaqiruvida 100 tagacha xabarni qabul qiladi
+BULK_DELETE_BATCH = 100
+BULK_DELETE_PROGRESS_INTERVAL = float(os.environ.get("BULK_DELETE_PROGRESS_INTERVAL", 3))
+bulk_delete_tasks = {}
+
+def parse_bulk_delete_args(args):
+    """`.adm del [son] [dan:YYYY-MM-DD] [gacha:YYYY-MM-DD]` argumentlarini ajratadi."""
+    limit, after, before = None, None, None
+    tz = tashkent_tz()
+    for arg in args:
+        if arg.isdigit():
+            limit = int(arg)
+        elif arg.startswith(("dan:", "gacha:")):
+            name, value = arg.split(":", 1)
+            date = tz.localize(datetime.strptime(value, "%Y-%m-%d"))
+            if name == "dan": after = date
+            else: before = date
+        else:
+            raise ValueError(arg)
+    return limit, after, before
+
+async def bulk_delete_own_messages(chat_id, status_message, limit=None, after=None, before=None):
+    """O'z xabarlarini yig'ib 100 talik paketlarda o'chiradi. Xabarlarni olish va o'chirish
+    navbat orqali parallel ishlaydi, FloodWait kelsa kutib shu paketni qayta yuboradi."""
+    batches = asyncio.Queue(maxsize=2)
+    found = deleted = 0
+    last_report = time.monotonic()
+
+    async def collect():
+        nonlocal found
+        batch, cancelled = [], False
+        try:
+            async for msg in client.iter_messages(chat_id, from_user='me', limit=limit, offset_date=before):
+                if after and msg.date < after: break
+                if msg.id == status_message.id: continue
+                batch.append(msg.id)
+                found += 1
+                if len(batch) == BULK_DELETE_BATCH:
+                    await batches.put(batch)
+                    batch = []
+            if batch: await batches.put(batch)
+        except asyncio.CancelledError:
+            # Iste'molchining o'zi bekor qildi va navbatni endi o'qimaydi: to'la navbatga put() abadiy kutib qolardi
+            cancelled = True
+            raise
+        finally:
+            if not cancelled:
+                await batches.put(None)
+
+    collector = asyncio.create_task(collect())
+    try:
+        while (batch := await batches.get()) is not None:
+            while True:
+                try:
+                    if not await limiter.acquire("telegram", max_wait=TELEGRAM_MAX_WAIT):
+                        await asyncio.sleep(TELEGRAM_MAX_WAIT)
+                        continue
+                    affected = await client.delete_messages(chat_id, batch, revoke=True)
+                    deleted += sum(item.pts_count for item in affected) if affected else len(batch)
+                    break
+                except errors.FloodWaitError as e:
+                    limiter.penalize("telegram", e.seconds)
+                    await safe_edit(status_message, f"⏳ FloodWait: {e.seconds} soniya kutilmoqda... ({deleted} ta o'chirildi)")
+                    await asyncio.sleep(e.seconds)
+            if time.monotonic() - last_report >= BULK_DELETE_PROGRESS_INTERVAL:
+                last_report = time.monotonic()
+                await safe_edit(status_message, f"🗑️ O'chirilmoqda: {deleted}/{found}...")
+        await collector
+        await safe_edit(status_message, f"Bu chatdagi {deleted} ta xabarim o'chirildi.")
+    except asyncio.CancelledError:
+        await safe_edit(status_message, f"⛔ To'xtatildi: {deleted} ta xabar o'chirildi.")
+    except Exception as e:
+        logging.error(f"Ommaviy o'chirishda xatolik: {e}", exc_info=True)
+        await safe_edit(status_message, f"❌ Xatolik: {deleted} ta xabar o'chirildi.")
+    finally:
+        collector.cancel()
+        await asyncio.gather(collector, return_exceptions=True)
+        bulk_delete_tasks.pop(chat_id, None)
+    asyncio.create_task(delete_message_after_delay(None, status_message))
+
+async def handle_bulk_delete_command(event, args):
+    if args == ["stop"]:
+        task = bulk_delete_tasks.get(event.chat_id)
+        if task: task.cancel()
+        return await event.reply("O'chirish to'xtatilmoqda..." if task else "Bu chatda o'chirish jarayoni yo'q.")
+    if event.chat_id in bulk_delete_tasks:
+        return await event.reply("Bu chatda o'chirish allaqachon ketmoqda. To'xtatish: `.adm del stop`")
+    try:
+        limit, after, before = parse_bulk_delete_args(args)
+    except ValueError:
+        return await event.reply("Noto'g'ri format. Misol: `.adm del 500 dan:2024-01-01 gacha:2024-06-01`")
+    status_message = await event.reply("🗑️ Xabarlar yig'ilmoqda...")
+    bulk_delete_tasks[event.chat_id] = asyncio.create_task(
+        bulk_delete_own_messages(event.chat_id, status_message, limit=limit, after=after, before=before))
+    return None
+
+@metrics.timed("handler")
 async def handle_admin_command(event, command):
-    global allow_all_users, auto_reply_enabled
     if event.sender_id != my_telegram_id: return
     reply_message = None
 
     if command == "setuser all":
-        allow_all_users, auto_reply_enabled = True, True
-        settings.update({"allow_all_users": True, "auto_reply_enabled": True})
+        config.update(allow_all_users=True, auto_reply_enabled=True)
         reply_message = await event.reply("Barcha foydalanuvchilarga ruxsat berildi va avto-javob yoqildi.")
     elif command == "setuser off":
-        allow_all_users, auto_reply_enabled = False, False
-        settings.update({"allow_all_users": False, "auto_reply_enabled": False})
+        config.update(allow_all_users=False, auto_reply_enabled=False)
         reply_message = await event.reply("Faqat admin uchun ruxsatlar qoldirildi va avto-javob o'chirildi.")
     elif command == "statistika":
         stats = await get_account_stats()
-        uzbek_time = datetime.now(pytz.timezone('Asia/Tashkent')).strftime("%Y-%m-%d %H:%M:%S")
+        uzbek_time = datetime.now(tashkent_tz()).strftime("%Y-%m-%d %H:%M:%S")
         stats_msg = (f"📊 **Statistika**:\n\n"
                      f"👤 Foydalanuvchilar: {stats['users']}\n👥 Guruhlar: {stats['groups']}\n"
                      f"📢 Kanallar: {stats['channels']}\n🤖 Botlar: {stats['bots']}\n"
                      f"✉️ O'qilmagan: {stats['unread']}\n\n🕰️ Vaqt: {uzbek_time}")
         reply_message = await event.reply(stats_msg)
     elif command == "sendavto on":
-        auto_reply_enabled = True
-        settings["auto_reply_enabled"] = True
+        config.update(auto_reply_enabled=True)
         reply_message = await event.reply("Avtomatik javob yoqildi!")
     elif command == "sendavto off":
-        auto_reply_enabled = False
-        settings["auto_reply_enabled"] = False
+        config.update(auto_reply_enabled=False)
         reply_message = await event.reply("Avtomatik javob o'chirildi!")
     elif command.startswith("online "):
         await handle_online_command(event, command.split(" ", 1)[1].strip())
         return
     elif command == "active status":
-        groups = []
-        for gid in load_active_groups():
-            try:
-                entity = await client.get_entity(gid)
-                groups.append(f"`{gid}`: {entity.title}")
-            except Exception:
-                groups.append(f"`{gid}`: Noma'lum")
+        titles = await dialog_cache.titles(list(config.active_groups))
+        groups = [f"`{gid}`: {title}" if title else f"`{gid}`: Noma'lum" for gid, title in titles.items()]
         reply_message = await event.reply(f"**Faol guruhlar:**\n" + ("\n".join(groups) or "Yo'q"))
     elif command == "set active":
-        active_groups = load_active_groups()
-        if event.chat_id not in active_groups:
-            active_groups.append(event.chat_id)
-            save_active_groups(active_groups)
+        if config.add_active(event.chat_id):
+            asyncio.create_task(own_messages.warm(event.chat_id))
             reply_message = await event.reply(f"Ushbu guruh faol ro'yxatga qo'shildi!")
         else: reply_message = await event.reply("Bu guruh avvaldan faol!")
     elif command == "del active":
-        active_groups = load_active_groups()
-        if event.chat_id in active_groups:
-            active_groups.remove(event.chat_id)
-            save_active_groups(active_groups)
+        if config.remove_active(event.chat_id):
             reply_message = await event.reply(f"Ushbu guruh faol ro'yxatdan o'chirildi!")
         else: reply_message = await event.reply("Bu guruh faol ro'yxatda yo'q!")
     elif command == "clear history":
-        file_path = get_chat_history_file_path(event.chat_id, event.sender_id, event.is_private)
-        if os.path.exists(file_path):
-            os.remove(file_path)
+        if await history_cache.discard(event.chat_id, event.sender_id, event.is_private):
             reply_message = await event.reply("Suhbat tarixi o'chirildi.")
         else: reply_message = await event.reply("Suhbat tarixi topilmadi.")
-    elif command == "del":
-        deleted_count = 0
-        async for msg in client.iter_messages(event.chat_id, from_user='me'):
-            try:
-                await msg.delete()
-                deleted_count += 1
-            except Exception: pass
-        reply_message = await event.reply(f"Bu chatdagi {deleted_count} ta xabarim o'chirildi.")
+    elif command == "clear chat history":
+        removed = await history_cache.purge_chat(event.chat_id)
+        reply_message = await event.reply(f"Ushbu chatdagi {removed} ta suhbat tarixi o'chirildi.")
+    elif command == "pool":
+        lines = [f"`{name}`: {st['requests']} so'rov, " + (f"{st['connections']} ulanish ({st['active']} band, {st['idle']} bo'sh)" if st['connections'] is not None else "ulanishlar noma'lum")
+                 for name, st in get_http_pool_stats().items()]
+        reply_message = await event.reply("🔌 **HTTP pool**:\n\n" + ("\n".join(lines) or "Klientlar ochilmagan"))
+    elif command == "cache":
+        caches = {"AI javoblar": ai_response_cache, "Detektiv": detective_cache, "Rasmlar (disk)": image_disk_cache, "Yuklangan rasmlar": uploaded_photos}
+        lines = [f"{name}: {st['hits']} hit / {st['misses']} miss, {st['size']} ta yozuv" for name, st in ((name, cache.stats()) for name, cache in caches.items())]
+        flight = ai_single_flight.stats()
+        lines.append(f"Birlashtirilgan so'rovlar: {flight['shared']} ta ({flight['leaders']} upstream chaqiruv, {flight['in_flight']} jarayonda)")
+        reply_message = await event.reply("🗃️ **Kesh**:\n\n" + "\n".join(lines))
+    elif command == "queue":
+        lines = [f"`{name}`: {st['active']} bajarilmoqda, {st['queued']} navbatda, {st['dropped']} tashlangan" for name, st in scheduler.stats().items()]
+        lines.append(f"Debounce: {auto_debouncer.merged} ta xabar avvalgisiga qo'shildi, {auto_debouncer.pending} ta partiya kutmoqda")
+        voice = voice_pipeline.stats()
+        lines.append(f"Ovozli: {voice['processed']} tayyor, {voice['failed']} xato, {voice['dropped']} tashlangan")
+        reply_message = await event.reply("🚦 **Navbatlar**:\n\n" + "\n".join(lines))
+    elif command == "metrics":
+        lines = [f"`{name}`: {st['count']} ta, p50 {st['p50'] * 1000:.0f} / p95 {st['p95'] * 1000:.0f} / p99 {st['p99'] * 1000:.0f} ms"
+                 + "".join(f", {outcome}: {count}" for outcome, count in st['outcomes'].items() if outcome != "ok")
+                 + (f", {st['in_flight']} jarayonda" if st['in_flight'] else "") for name, st in metrics.snapshot().items()]
+        reply_message = await event.reply("📈 **Metrikalar**:\n\n" + ("\n".join(lines) or "Hali o'lchovlar yo'q"))
+    elif command == "limits":
+        lines = [f"`{kind}`: {st['rejected']} rad etilgan, {st['penalties']} marta upstream tomonidan to'xtatilgan" for kind, st in limiter.stats().items()]
+        lines += [f"`{breaker.name}` circuit: {breaker.state}, {breaker.opens} marta ochilgan, {breaker.rejected} rad etilgan" for breaker in (gemini_breaker, gemini_fallback_breaker)]
+        lines.append(f"Hedge: {gemini_hedge_stats['fired']} ta yuborilgan, {gemini_hedge_stats['won']} tasi yutgan (kechikish {gemini_hedge_delay():.1f} s)")
+        reply_message = await event.reply("⏱️ **Limitlar**:\n\n" + "\n".join(lines))
+    elif command == "del" or command.startswith("del "):
+        # Jarayon alohida vazifada ishlaydi va holat xabarini o'zi tahrirlaydi
+        reply_message = await handle_bulk_delete_command(event, command.split()[1:])
     else: reply_message = await event.reply("Noto'g'ri admin buyrug'i!")
     
-    save_settings(settings)
     asyncio.create_task(delete_message_after_delay(event, reply_message))
 
+@metrics.timed("upstream", "telegram")
+async def telegram_send(coro_factory):
+    """Telegramga yuborishni umumiy limit orqali o'tkazadi. FloodWait kelsa limitni yopadi va
+    kutish qisqa bo'lsa bir marta qayta uradi; limit uzoq yopiq bo'lsa None qaytaradi."""
+    if not await limiter.acquire("telegram", max_wait=TELEGRAM_MAX_WAIT):
+        logging.warning("Telegram yuborish limiti to'lgan, xabar yuborilmadi.")
+        return None
+    try:
+        result = await coro_factory()
+    except errors.FloodWaitError as e:
+        limiter.penalize("telegram", e.seconds)
+        if e.seconds > TELEGRAM_MAX_WAIT:
+            raise
+        await asyncio.sleep(e.seconds)
+        result = await coro_factory()
+    own_messages.track(result)
+    return result
+
 async def send_long_message(chat_id, text, reply_to=None, parse_mode="markdown"):
-    for part in textwrap.wrap(text, MAX_MESSAGE_LENGTH, replace_whitespace=False):
-        await client.send_message(chat_id, part, reply_to=reply_to, parse_mode=parse_mode)
+    """Bo'laklarni tartib bilan yuboradi. Bo'lak yuborilmasa (limit yopiq) qolganlari ham yuborilmaydi,
+    aks holda javob o'rtasida bo'shliq bilan yetib borardi; hammasi yuborilgan bo'lsa True qaytadi."""
+    parts = textwrap.wrap(text, MAX_MESSAGE_LENGTH, replace_whitespace=False)
+    for index, part in enumerate(parts):
+        if await telegram_send(lambda: client.send_message(chat_id, part, reply_to=reply_to, parse_mode=parse_mode)) is None:
+            logging.warning(f"{chat_id} chatiga uzun xabarning {index + 1}/{len(parts)} qismi yuborilmadi, qolganlari bekor qilindi.")
+            return False
+    return True
+
+async def safe_edit(message, text, parse_mode="markdown", wait_flood=False):
+    """Tahrirlash xatolari oqimni to'xtatmaydi; matn xabarda bo'lsa True qaytadi.
+    wait_flood=True (yakuniy tahrirlar) bo'lsa qisqa FloodWait kutiladi va tahrir bir marta qayta yuboriladi."""
+    try:
+        await message.edit(text, parse_mode=parse_mode)
+        return True
+    except errors.MessageNotModifiedError:
+        return True
+    except errors.FloodWaitError as e:
+        limiter.penalize("telegram", e.seconds)
+        if wait_flood and e.seconds <= TELEGRAM_MAX_WAIT:
+            await asyncio.sleep(e.seconds)
+            return await safe_edit(message, text, parse_mode)
+        logging.warning(f"FloodWait ({e.seconds} s): xabar tahrirlanmadi.")
+    except Exception as e:
+        logging.debug(f"Xabarni tahrirlab bo'lmadi: {e}")
+    return False
+
+def split_stream_text(text, limit=MAX_MESSAGE_LENGTH):
+    cut = text.rfind("\n", 0, limit)
+    if cut <= 0:
+        cut = text.rfind(" ", 0, limit)
+    if cut <= 0:
+        cut = limit
+    return text[:cut], text[cut:].lstrip()
+
+async def stream_gemini_to_message(event, prompt, message):
+    """Gemini oqimini placeholder xabarni tahrirlash orqali ko'rsatadi; MAX_MESSAGE_LENGTH dan oshsa yangi xabarga o'tadi."""
+    text, shown_text, last_edit = "", "", time.monotonic()
+
+    async def roll_over(text):
+        """Sig'magan boshini joriy xabarda yakunlab, davomini yangi xabarga o'tkazadi. Yangi xabar yuborilmasa
+        (limit yopiq) None qaytadi: yakunlangan xabar qayta tahrirlanmaydi va oqim to'xtatiladi."""
+        nonlocal message, shown_text, last_edit
+        while len(text) > MAX_MESSAGE_LENGTH:
+            head, text = split_stream_text(text)
+            await safe_edit(message, format_gemini_text(head), wait_flood=True)
+            next_message = await telegram_send(lambda: client.send_message(event.chat_id, "⏳", reply_to=event.message.id))
+            if next_message is None:
+                logging.warning("Oqim davomi uchun yangi xabar yuborilmadi, oqim to'xtatildi.")
+                return None
+            message, shown_text, last_edit = next_message, "", time.monotonic()
+        return text
+
+    try:
+        async with contextlib.aclosing(stream_gemini_response(prompt, event.chat_id, event.sender_id, event.is_private)) as stream:
+            async for chunk in stream:
+                text = await roll_over(text + chunk)
+                if text is None:
+                    return
+                if text != shown_text and time.monotonic() - last_edit >= GEMINI_STREAM_EDIT_INTERVAL:
+                    # Oraliq tahrirlar formatlashsiz: yarim kelgan markdown buzilib ko'rinmasligi uchun
+                    await safe_edit(message, text + " ▌", parse_mode=None)
+                    shown_text, last_edit = text, time.monotonic()
+    except RateLimitedError:
+        text += "\n\nAI so'rovlar limiti to'lgan, birozdan keyin urinib ko'ring."
+    except CircuitOpenError:
+        text += "\n\nAI vaqtincha ishlamayapti, birozdan keyin urinib ko'ring."
+    except GeminiBlockedError as e:
+        text += f"\n\nAI javob berishda qiyinchilikka uchradi. Sabab: {e}"
+    except httpx.RequestError:
+        text += "\n\nTashqi API bilan bog'lanishda xatolik yuz berdi."
+    except Exception as e:
+        masked_error = mask_sensitive_info(str(e), gemini_api_key, GEMINI_BASE_API_URL)
+        logging.error(f"Gemini oqimida kutilmagan xatolik: {masked_error}", exc_info=True)
+        text += "\n\nKutilmagan xatolik yuz berdi."
+    text = await roll_over(text.strip())
+    if text is None:
+        return
+    text = text or "AI javob bermadi."
+    # Yakuniy tahrir o'tmasa xabar oraliq "▌" matnida qolmasin: markdownsiz qayta uriniladi, bo'lmasa yangi xabar yuboriladi
+    if not await safe_edit(message, format_gemini_text(text), wait_flood=True) and not await safe_edit(message, text, parse_mode=None, wait_flood=True):
+        logging.warning("Oqimning yakuniy matnini tahrirlab bo'lmadi, yangi xabar yuborilmoqda.")
+        await telegram_send(lambda: client.send_message(event.chat_id, text, reply_to=event.message.id, parse_mode=None))
 
+@metrics.timed("handler")
 async def handle_gemini_command(event, prompt):
-    if event.sender_id != my_telegram_id and not allow_all_users: return
+    if event.sender_id != my_telegram_id and not config.get("allow_all_users"): return
     thinking_message = await event.reply("Javob yozilmoqda... ⏳")
+    if GEMINI_STREAMING:
+        await stream_gemini_to_message(event, prompt, thinking_message)
+        return
     response_text = await get_gemini_response(prompt, event.chat_id, event.sender_id, event.is_private)
+    if not response_text:
+        await safe_edit(thinking_message, "AI so'rovlar limiti to'lgan, birozdan keyin urinib ko'ring.")
+        return
     await thinking_message.delete()
-    if response_text:
-        await send_long_message(event.chat_id, response_text, reply_to=event.message.id)
+    await send_long_message(event.chat_id, response_text, reply_to=event.message.id)
 
+@metrics.timed("handler")
 async def handle_image_command(event, prompt):
-    if event.sender_id != my_telegram_id and not allow_all_users: return
+    if event.sender_id != my_telegram_id and not config.get("allow_all_users"): return
     await generate_image_with_progress(prompt, event)
 
-async def search_for_reply(original_text: str, search_limit_per_chat=1000):
+# Detektiv: (xabar matni -> u reply qilgan xabar) juftliklarining lokal indeksi
+REPLY_INDEX_FILE = os.environ.get("REPLY_INDEX_FILE", data_path("reply_index.db"))
+REPLY_INDEX_MAX_PAIRS = int(os.environ.get("REPLY_INDEX_MAX_PAIRS", 200000))
+REPLY_INDEX_RECENT_SIZE = int(os.environ.get("REPLY_INDEX_RECENT_SIZE", 20000))
+REPLY_INDEX_FLUSH_INTERVAL = float(os.environ.get("REPLY_INDEX_FLUSH_INTERVAL", 10))
+REPLY_INDEX_BACKFILL_INTERVAL = float(os.environ.get("REPLY_INDEX_BACKFILL_INTERVAL", 6 * 3600))
+REPLY_INDEX_BACKFILL_LIMIT = int(os.environ.get("REPLY_INDEX_BACKFILL_LIMIT", 2000))
+REPLY_INDEX_BACKFILL_PAUSE = float(os.environ.get("REPLY_INDEX_BACKFILL_PAUSE", 5))
+DETECTIVE_TIMEOUT = float(os.environ.get("DETECTIVE_TIMEOUT", 15))
+DETECTIVE_LIVE_FALLBACK = os.environ.get("DETECTIVE_LIVE_FALLBACK", "0") == "1"
+DETECTIVE_MAX_RESULTS = 5
+
+def normalize_text(text):
+    text = re.sub(r"['`ʻʼ‘’]", "", (text or "").lower())
+    text = re.sub(r"[^\w\s]", " ", text)
+    text = re.sub(r"(.)\1{2,}", r"\1", text)
+    return " ".join(text.split())
+
+def text_terms(normalized, max_terms=12):
+    return list(dict.fromkeys(word for word in normalized.split() if len(word) > 1))[:max_terms]
+
+class ReplyIndex:
+    """Guruhlardagi reply juftliklari SQLite indeksi. NewMessage oqimi va sekin fon to'ldirish orqali yangilanadi,
+    qidiruv esa tarmoqqa murojaat qilmasdan normallashtirilgan matn yoki so'zlar bo'yicha bajariladi."""
+
+    def __init__(self, db_path, max_pairs, recent_size):
+        self.db_path = db_path
+        self.max_pairs = max_pairs
+        self.recent_size = recent_size
+        self._recent = OrderedDict()  # (chat_id, msg_id) -> (text, sender_id)
+        self._pending = []
+        self._db = None
+        self._lock = threading.Lock()
+
+    def _conn(self):
+        if self._db is None:
+            db = sqlite3.connect(self.db_path, check_same_thread=False)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.executescript("""
+                CREATE TABLE IF NOT EXISTS reply_pairs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    text_key TEXT NOT NULL,
+                    reply_text TEXT NOT NULL,
+                    chat_id INTEGER NOT NULL,
+                    message_id INTEGER NOT NULL,
+                    UNIQUE (chat_id, message_id)
+                );
+                CREATE INDEX IF NOT EXISTS idx_reply_pairs_key ON reply_pairs (text_key);
+                CREATE TABLE IF NOT EXISTS reply_terms (term TEXT NOT NULL, pair_id INTEGER NOT NULL);
+                CREATE INDEX IF NOT EXISTS idx_reply_terms ON reply_terms (term, pair_id);
+                CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+            """)
+            self._db = db
+        return self._db
+
+    def observe(self, chat_id, msg_id, text, sender_id, reply_to_msg_id):
+        """Yangi guruh xabarini eslab qoladi; u xotiradagi xabarga reply bo'lsa, juftlik navbatga qo'shiladi."""
+        if not text:
+            return
+        self._recent[(chat_id, msg_id)] = (text, sender_id)
+        if len(self._recent) > self.recent_size:
+            self._recent.popitem(last=False)
+        if reply_to_msg_id and sender_id != my_telegram_id:
+            parent = self._recent.get((chat_id, reply_to_msg_id))
+            if parent and parent[1] != my_telegram_id:
+                self._pending.append((chat_id, msg_id, text, parent[0]))
+
+    def _write_pairs(self, pairs):
+        with self._lock, self._conn() as db:
+            for chat_id, msg_id, text, reply_text in pairs:
+                text_key = normalize_text(text)
+                if not text_key:
+                    continue
+                cursor = db.execute("INSERT OR IGNORE INTO reply_pairs (text_key, reply_text, chat_id, message_id) VALUES (?, ?, ?, ?)", (text_key, reply_text, chat_id, msg_id))
+                if cursor.rowcount:
+                    db.executemany("INSERT INTO reply_terms (term, pair_id) VALUES (?, ?)", [(term, cursor.lastrowid) for term in text_terms(text_key)])
+            threshold = db.execute("SELECT MAX(id) FROM reply_pairs").fetchone()[0] or 0
+            threshold -= self.max_pairs
+            if threshold > 0:
+                db.execute("DELETE FROM reply_pairs WHERE id <= ?", (threshold,))
+                db.execute("DELETE FROM reply_terms WHERE pair_id <= ?", (threshold,))
+
+    def _lookup(self, text, limit):
+        text_key = normalize_text(text)
+        if not text_key:
+            return []
+        with self._lock:
+            db = self._conn()
+            rows = db.execute("SELECT reply_text FROM reply_pairs WHERE text_key = ? ORDER BY id DESC LIMIT ?", (text_key, limit)).fetchall()
+            terms = text_terms(text_key)
+            if not rows and terms:
+                # Telegram qidiruvidagidek: so'rovdagi barcha so'zlar uchraydigan xabarlar
+                placeholders = ",".join("?" * len(terms))
+                rows = db.execute(f"SELECT reply_text FROM reply_pairs WHERE id IN (SELECT pair_id FROM reply_terms WHERE term IN ({placeholders}) "
+                                  f"GROUP BY pair_id HAVING COUNT(DISTINCT term) = ? ORDER BY pair_id DESC LIMIT ?)", (*terms, len(terms), limit)).fetchall()
+            return [row[0] for row in rows]
+
+    async def lookup(self, text, limit=DETECTIVE_MAX_RESULTS):
+        return await asyncio.to_thread(self._lookup, text, limit)
+
+    async def flush(self):
+        pairs, self._pending = self._pending, []
+        if pairs:
+            try:
+                await asyncio.to_thread(self._write_pairs, pairs)
+            except sqlite3.Error as e:
+                logging.error(f"Reply indeksiga yozishda xatolik: {e}", exc_info=True)
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(REPLY_INDEX_FLUSH_INTERVAL)
+            await self.flush()
+
+    def _get_meta(self, key):
+        with self._lock:
+            row = self._conn().execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+            return row[0] if row else None
+
+    def _set_meta(self, key, value):
+        with self._lock, self._conn() as db:
+            db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+    async def backfill_chat(self, chat_id):
+        """Guruhning oxirgi to'ldirishdan keyingi xabarlarini o'qib, bir partiya ichidagi reply juftliklarini indekslaydi.
+        Marker bo'lsa xabarlar undan yuqoriga eskidan yangiga o'qiladi, shuning uchun marker faqat haqiqatan o'qilgan
+        xabarlargacha suriladi va qolganlari keyingi aylanishda olinadi. Birinchi marta oxirgi xabarlar olinadi."""
+        min_id = int(await asyncio.to_thread(self._get_meta, f"backfill:{chat_id}") or 0)
+        batch, max_id = {}, min_id
+        async for message in client.iter_messages(chat_id, limit=REPLY_INDEX_BACKFILL_LIMIT, min_id=min_id, reverse=bool(min_id), wait_time=1):
+            max_id = max(max_id, message.id)
+            if message.text:
+                batch[message.id] = message
+        pairs = []
+        for message in batch.values():
+            parent = batch.get(message.reply_to_msg_id) if message.reply_to_msg_id else None
+            if parent and my_telegram_id not in (message.sender_id, parent.sender_id):
+                pairs.append((chat_id, message.id, message.text, parent.text))
+        if pairs:
+            await asyncio.to_thread(self._write_pairs, pairs)
+        await asyncio.to_thread(self._set_meta, f"backfill:{chat_id}", str(max_id))
+        return len(pairs)
+
+    async def backfill_loop(self):
+        await asyncio.sleep(60)
+        while True:
+            indexed = 0
+            try:
+                async for dialog in client.iter_dialogs(limit=100):
+                    if dialog.is_group and getattr(dialog.entity, 'participants_count', 0) and dialog.entity.participants_count > 200:
+                        try:
+                            indexed += await self.backfill_chat(dialog.id)
+                        except Exception as e:
+                            logging.warning(f"'{dialog.title}' guruhini indekslashda xatolik: {e}")
+                        await asyncio.sleep(REPLY_INDEX_BACKFILL_PAUSE)
+                logging.info(f"Reply indeksi to'ldirildi: {indexed} ta yangi juftlik.")
+            except Exception as e:
+                logging.error(f"Reply indeksini to'ldirishda xatolik: {e}", exc_info=True)
+            await asyncio.sleep(REPLY_INDEX_BACKFILL_INTERVAL)
+
+    async def close(self):
+        await self.flush()
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+reply_index = ReplyIndex(REPLY_INDEX_FILE, REPLY_INDEX_MAX_PAIRS, REPLY_INDEX_RECENT_SIZE)
+
+@metrics.timed("upstream", "detective")
+async def search_for_reply(original_text: str):
+    cache_key = ("detective", normalize_text(original_text))
+    found_replies = detective_cache.get(cache_key)
+    if found_replies is None:
+        found_replies = await ai_single_flight.do(cache_key, lambda: find_replies(original_text))
+        detective_cache.set(cache_key, found_replies)
+    return found_replies
+
+async def find_replies(original_text: str):
+    found_replies = await reply_index.lookup(original_text)
+    if found_replies:
+        logging.info(f"Detektiv indeksdan {len(found_replies)} ta javob topdi.")
+    elif DETECTIVE_LIVE_FALLBACK:
+        found_replies = await search_for_reply_live(original_text)
+    return found_replies
+
+async def search_for_reply_live(original_text: str, search_limit_per_chat=1000):
     logging.info(f"Detektivlik boshlandi: '{original_text}' uchun javob qidirilmoqda.")
     found_replies = []
     
@@ -354,8 +2408,8 @@ async def search_for_reply(original_text: str, search_limit_per_chat=1000):
                         reply_message = await message.get_reply_message()
                         if reply_message and reply_message.sender_id != my_telegram_id:
                             found_replies.append(reply_message)
-                            if len(found_replies) >= 5:
-                                logging.info(f"5 ta mos javob topildi. Qidiruv to'xtatildi.")
+                            if len(found_replies) >= DETECTIVE_MAX_RESULTS:
+                                logging.info(f"{DETECTIVE_MAX_RESULTS} ta mos javob topildi. Qidiruv to'xtatildi.")
                                 return found_replies
             except Exception as e:
                 logging.warning(f"'{dialog.title}' guruhini skanerlashda xatolik: {e}")
@@ -363,50 +2417,405 @@ async def search_for_reply(original_text: str, search_limit_per_chat=1000):
     logging.info(f"Detektivlik yakunlandi. Jami topilgan javoblar: {len(found_replies)} ta.")
     return found_replies
 
-async def handle_auto_reply(event):
-    if (not auto_reply_enabled or not event.is_group or 
-        event.chat_id not in load_active_groups() or not event.text or 
-        event.sender_id == my_telegram_id):
-        return
+# Har bir chatda akkaunt yuborgan oxirgi xabarlar IDsi: "bizga javobmi?" savoli RPCsiz hal qilinadi
+OWN_MESSAGE_IDS_PER_CHAT = int(os.environ.get("OWN_MESSAGE_IDS_PER_CHAT", 2000))
+OWN_MESSAGE_WARM_LIMIT = int(os.environ.get("OWN_MESSAGE_WARM_LIMIT", 300))
+
+class OwnMessageTracker:
+    """Chat bo'yicha chegaralangan o'z xabar IDlari to'plami. Chiquvchi eventlar va yuborish natijalaridan
+    to'ldiriladi; faol guruhlar uchun ishga tushishda oxirgi xabarlardan isitiladi."""
+
+    def __init__(self, per_chat):
+        self.per_chat = per_chat
+        self.chats = {}
+        self.warm_chats = set()
+        self._warming = set()
+
+    def add(self, chat_id, message_id):
+        ids = self.chats.setdefault(chat_id, OrderedDict())
+        ids[message_id] = None
+        if len(ids) > self.per_chat:
+            ids.popitem(last=False)
+
+    def track(self, result):
+        """send_message/reply natijasini (bitta xabar yoki ro'yxat) qayd etadi."""
+        for msg in result if isinstance(result, list) else [result]:
+            if isinstance(msg, Message) and msg.out:
+                self.add(msg.chat_id, msg.id)
+
+    def is_own(self, chat_id, message_id):
+        return message_id in self.chats.get(chat_id, ())
+
+    def is_warm(self, chat_id):
+        return chat_id in self.warm_chats
+
+    async def warm(self, chat_id):
+        if chat_id in self.warm_chats or chat_id in self._warming: return
+        self._warming.add(chat_id)
+        try:
+            ids = [msg.id async for msg in client.iter_messages(chat_id, from_user='me', limit=OWN_MESSAGE_WARM_LIMIT)]
+            for message_id in reversed(ids):
+                self.add(chat_id, message_id)
+            self.warm_chats.add(chat_id)
+        except Exception as e:
+            logging.warning(f"{chat_id} chatidagi o'z xabarlarini yuklab bo'lmadi: {e}")
+        finally:
+            self._warming.discard(chat_id)
 
-    sender = await event.get_sender()
-    if sender and sender.bot: return
+    async def warm_active(self):
+        for chat_id in list(config.active_groups):
+            await self.warm(chat_id)
+        logging.info(f"O'z xabarlari {len(self.warm_chats)} ta faol guruh uchun yuklandi.")
 
+own_messages = OwnMessageTracker(OWN_MESSAGE_IDS_PER_CHAT)
+
+def auto_reply_candidate(event, voice=False):
+    """Avto-javob uchun faqat lokal ma'lumotlar bilan tekshiruv: guruhlardagi trafikning asosiy qismi
+    shu yerda hech qanday RPCsiz rad etiladi. Isitilmagan chatlar uchun True qaytadi (tekshiruv handlerda).
+    voice=True bo'lsa matn o'rniga ovozli xabar talab qilinadi."""
+    if (not config.get("auto_reply_enabled") or not event.is_group or not (event.message.voice if voice else event.text) or
+        event.sender_id == my_telegram_id or not config.is_active(event.chat_id)):
+        return False
+    reply_to_msg_id = event.message.reply_to_msg_id
+    if not reply_to_msg_id:
+        return False
+    sender = event.sender  # update bilan kelgan entity, RPC talab qilmaydi
+    if sender is not None and getattr(sender, 'bot', False):
+        return False
+    return not own_messages.is_warm(event.chat_id) or own_messages.is_own(event.chat_id, reply_to_msg_id)
+
+# Detektiv va Gemini parallel boshlanadi; detektiv afzallik oynasi ichida javob topsa, u Gemini dan ustun
+AUTO_REPLY_RACE = os.environ.get("AUTO_REPLY_RACE", "1") == "1"
+AUTO_REPLY_PREFERENCE_WINDOW = float(os.environ.get("AUTO_REPLY_PREFERENCE_MS", 1500)) / 1000
+AUTO_REPLY_DEADLINE = float(os.environ.get("AUTO_REPLY_DEADLINE", 60))
+
+def detective_task_replies(task):
+    if task.cancelled():
+        return []
+    error = task.exception()
+    if isinstance(error, asyncio.TimeoutError):
+        logging.info("Detektivlik vaqti tugadi. Javob topilmadi.")
+    elif error is not None:
+        logging.error(f"Detektivlik jarayonida kutilmagan xatolik: {error}", exc_info=error)
+    return [] if error else task.result()
+
+def auto_reply_gemini(event, prompt):
+    return generate_gemini_answer(prompt, event.chat_id, event.sender_id, event.is_private,
+                                  context_key=(event.chat_id, event.message.reply_to_msg_id), max_wait=AUTO_REPLY_MAX_WAIT)
+
+async def race_auto_reply(event, prompt):
+    """("detective", javoblar), ("gemini", matn), ("error", xato matni yoki None) yoki (None, None) qaytaradi.
+    Avval lokal reply indeksi o'qiladi: unda javob bo'lsa Gemini chaqirilmaydi. Aks holda jonli detektiv
+    (DETECTIVE_LIVE_FALLBACK) va Gemini parallel boshlanadi. Yutqazgan vazifa bekor qilinadi va tugashi kutiladi,
+    shuning uchun uning Telethon iteratorlari va HTTP so'rovlari shu yerning o'zida yopiladi."""
+    found_replies = await reply_index.lookup(prompt)
+    if found_replies:
+        logging.info(f"Detektiv indeksdan {len(found_replies)} ta javob topdi.")
+        return "detective", found_replies
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    detective = asyncio.create_task(asyncio.wait_for(search_for_reply(prompt), timeout=DETECTIVE_TIMEOUT)) if DETECTIVE_LIVE_FALLBACK else None
+    gemini = asyncio.create_task(auto_reply_gemini(event, prompt))
+    tasks = [task for task in (detective, gemini) if task is not None]
+    pending, result = set(tasks), (None, None)
     try:
-        replied_msg = await event.get_reply_message()
-        if not (replied_msg and replied_msg.from_id and replied_msg.from_id.user_id == my_telegram_id):
-            return
-    except Exception: return
+        while pending:
+            done, pending = await asyncio.wait(pending, timeout=max(0.0, start + AUTO_REPLY_DEADLINE - loop.time()), return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                logging.warning("Avto-javob umumiy muddati tugadi.")
+                break
+            if detective in done and (replies := detective_task_replies(detective)):
+                return "detective", replies
+            if gemini in done:
+                if gemini.exception() is not None:
+                    # Gemini xato berdi: detektiv hali ishlayotgan bo'lsa uning natijasi kutiladi
+                    result = "error", gemini_error_text(gemini.exception())
+                    continue
+                # Gemini tayyor, lekin afzallik oynasi tugamagan bo'lsa detektivga qolgan vaqt beriladi
+                window_left = start + AUTO_REPLY_PREFERENCE_WINDOW - loop.time()
+                if detective in pending and window_left > 0:
+                    await asyncio.wait({detective}, timeout=window_left)
+                    if detective.done() and (replies := detective_task_replies(detective)):
+                        return "detective", replies
+                return "gemini", gemini.result()
+        return result
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+async def sequential_auto_reply(event, prompt):
+    """AUTO_REPLY_RACE o'chirilgan bo'lsa: avval detektiv, javob topilmasa Gemini. Natija race_auto_reply kabi."""
+    try:
+        found_replies = await asyncio.wait_for(search_for_reply(prompt), timeout=DETECTIVE_TIMEOUT)
+        if found_replies:
+            return "detective", found_replies
+    except asyncio.TimeoutError:
+        logging.info("Detektivlik vaqti tugadi. Javob topilmadi.")
+    except Exception as e:
+        logging.error(f"Detektivlik jarayonida kutilmagan xatolik: {e}", exc_info=True)
+    logging.info("AIga murojaat qilinmoqda...")
+    try:
+        return "gemini", await auto_reply_gemini(event, prompt)
+    except Exception as e:
+        return "error", gemini_error_text(e)
+
+async def auto_reply_allowed(event):
+    """Avto-javobdan oldingi arzon tekshiruvlar: reply nishoni (chat isitilmagan bo'lsa), yuboruvchi bot emasligi
+    va anti-flood limitlari. Detektiv, Gemini va ovozni matnga aylantirish faqat shulardan keyin boshlanadi."""
+    if not own_messages.is_warm(event.chat_id):
+        # Chat hali isitilmagan: eski yo'l bilan tekshiramiz va fonda IDlarni yuklaymiz
+        asyncio.create_task(own_messages.warm(event.chat_id))
+        try:
+            replied_msg = await event.get_reply_message()
+            if not (replied_msg and replied_msg.from_id and replied_msg.from_id.user_id == my_telegram_id):
+                return False
+        except Exception: return False
+
+    if event.sender is None:
+        sender = await event.get_sender()
+        if sender and sender.bot: return False
 
-    current_time = time.time()
-    last_reply_time = user_reply_cooldown.get(event.sender_id, 0)
-    if current_time - last_reply_time < COOLDOWN_SECONDS:
+    if not limiter.try_acquire("user", event.sender_id):
         logging.info(f"Anti-flood: {event.sender_id} IDli foydalanuvchiga javob berilmadi.")
-        return
-    user_reply_cooldown[event.sender_id] = current_time
+        return False
+    if not limiter.try_acquire("chat", event.chat_id):
+        logging.info(f"Anti-flood: {event.chat_id} chatida javoblar limiti to'lgan.")
+        return False
+    return True
 
-    prompt = event.text.strip()
+@metrics.timed("handler")
+async def handle_auto_reply(event, followups=()):
+    """event - botga reply qilingan xabar; followups - debounce oynasida shu foydalanuvchidan kelgan keyingi xabarlar.
+    Hammasi bitta prompt sifatida bitta AI chaqiruvi va bitta javob bilan qayta ishlanadi."""
+    if not auto_reply_candidate(event) or not await auto_reply_allowed(event):
+        return
+    prompt = "\n".join(msg.text.strip() for msg in (event, *followups) if msg.text and msg.text.strip())
+    await answer_auto_reply(event, prompt, followups[-1].message.id if followups else event.message.id)
 
+async def answer_auto_reply(event, prompt, last_message_id):
+    """Tekshiruvlardan o'tgan avto-javob: detektiv va Gemini orqali javob topib last_message_id ga reply qiladi.
+    Suhbat tarixiga faqat haqiqatan yuborilgan Gemini javobi yoziladi."""
     async with client.action(event.chat_id, 'typing'):
+        source, result = await (race_auto_reply if AUTO_REPLY_RACE else sequential_auto_reply)(event, prompt)
+        if source == "detective":
+            chosen_reply = random.choice(result)
+            logging.info("Detektiv javob topdi. Topilgan javob yuborilmoqda.")
+            await telegram_send(lambda: client.send_message(event.chat_id, chosen_reply, reply_to=last_message_id))
+        elif source == "gemini":
+            if await send_long_message(event.chat_id, result, reply_to=last_message_id):
+                await remember_gemini_exchange(event.chat_id, event.sender_id, event.is_private, prompt, result)
+        elif source == "error" and result:
+            await send_long_message(event.chat_id, result, reply_to=last_message_id)
+
+# Guruhlarda odamlar bitta fikrni 2-3 ta tez xabar bilan yozadi: ular bitta promptga birlashtiriladi
+AUTO_REPLY_DEBOUNCE = float(os.environ.get("AUTO_REPLY_DEBOUNCE", 2))  # 0 - o'chirilgan
+AUTO_REPLY_DEBOUNCE_MAX = float(os.environ.get("AUTO_REPLY_DEBOUNCE_MAX", 6))
+AUTO_REPLY_BATCH_MAX = int(os.environ.get("AUTO_REPLY_BATCH_MAX", 5))
+
+class MessageDebouncer:
+    """(chat, foydalanuvchi) bo'yicha debounce. Har yangi xabar oynani `delay` ga uzaytiradi, lekin birinchi
+    xabardan `max_delay` yoki `max_messages` ta xabardan keyin partiya albatta jo'natiladi."""
+
+    def __init__(self, delay, max_delay, max_messages, flush):
+        self.delay = delay
+        self.max_delay = max_delay
+        self.max_messages = max_messages
+        self.flush = flush
+        self.merged = 0
+        self._pending = {}  # (chat_id, sender_id) -> [xabarlar, birinchi xabar vaqti, timer]
+
+    @property
+    def pending(self):
+        """Hali jo'natilmagan partiyalar soni."""
+        return len(self._pending)
+
+    def is_open(self, chat_id, sender_id):
+        return (chat_id, sender_id) in self._pending
+
+    def add(self, event):
+        loop = asyncio.get_running_loop()
+        key, now = (event.chat_id, event.sender_id), loop.time()
+        batch = self._pending.get(key)
+        if batch is None:
+            batch = self._pending[key] = [[event], now, None]
+        else:
+            batch[0].append(event)
+            batch[2].cancel()
+            self.merged += 1
+        remaining = batch[1] + self.max_delay - now
+        if len(batch[0]) >= self.max_messages or remaining <= 0:
+            self._flush(key)
+        else:
+            batch[2] = loop.call_later(min(self.delay, remaining), self._flush, key)
+
+    def _flush(self, key):
+        events = self._pending.pop(key)[0]
+        self.flush(events)
+
+    def close(self):
+        for _, _, timer in self._pending.values():
+            timer.cancel()
+        self._pending.clear()
+
+auto_debouncer = MessageDebouncer(AUTO_REPLY_DEBOUNCE, AUTO_REPLY_DEBOUNCE_MAX, AUTO_REPLY_BATCH_MAX,
+                                  lambda events: scheduler.submit("auto", events[0].chat_id, lambda: handle_auto_reply(events[0], events[1:])))
+
+# Ovozli xabarlar: oqim bilan yuklab olish -> pydub konvertatsiya (jarayonlar pulida) -> transkripsiya -> oddiy javob yo'li
+VOICE_ENABLED = os.environ.get("VOICE_ENABLED", "1") == "1"
+VOICE_WORKERS = int(os.environ.get("VOICE_WORKERS", 2))  # konvertatsiya jarayonlari soni
+VOICE_MAX_DURATION = int(os.environ.get("VOICE_MAX_DURATION", 120))
+VOICE_TRANSCRIBER = os.environ.get("VOICE_TRANSCRIBER", "gemini")  # gemini | stub
+VOICE_STUB_TEXT = os.environ.get("VOICE_STUB_TEXT", "salom")
+CHAT_LANGUAGE_TTL = float(os.environ.get("CHAT_LANGUAGE_TTL", 24 * 3600))
+
+voice_executor = None
+
+def get_voice_executor():
+    global voice_executor
+    if voice_executor is None:
+        voice_executor = create_process_pool(VOICE_WORKERS)
+    return voice_executor
+
+def shutdown_voice_executor():
+    global voice_executor
+    if voice_executor is not None:
+        voice_executor.shutdown(wait=False, cancel_futures=True)
+        voice_executor = None
+
+def detect_language(text):
+    from langdetect import DetectorFactory, LangDetectException, detect
+    DetectorFactory.seed = 0
+    try:
+        return detect(text)
+    except LangDetectException:
+        return None
+
+def read_base64(path):
+    with open(path, 'rb') as f:
+        return base64.b64encode(f.read()).decode()
+
+class Transcriber(abc.ABC):
+    """Audio fayldan matn oluvchi interfeys; language - chat uchun aniqlangan til kodi (bo'lmasa None)."""
+
+    @abc.abstractmethod
+    async def transcribe(self, path, mime_type, language=None):
+        ...
+
+class GeminiTranscriber(Transcriber):
+    """Audio inlineData sifatida Gemini ga yuboriladi; umumiy gemini limiti va HTTP pooli ishlatiladi."""
+
+    @metrics.timed("upstream", "gemini_transcribe")
+    async def transcribe(self, path, mime_type, language=None):
+        if not await limiter.acquire("gemini", max_wait=GEMINI_MAX_WAIT):
+            raise RateLimitedError("gemini")
+        audio = await asyncio.to_thread(read_base64, path)
+        instruction = "Ushbu ovozli xabarni so'zma-so'z matnga aylantir. Faqat matnning o'zini qaytar."
+        if language:
+            instruction += f" Taxminiy til: {language}."
+        body = {"contents": [{"role": "user", "parts": [{"text": instruction}, {"inlineData": {"mimeType": mime_type, "data": audio}}]}],
+                "generationConfig": {"temperature": 0}}
+        response = await get_http_client("gemini").post(f"{GEMINI_BASE_API_URL}:generateContent", params={"key": gemini_api_key}, json=body)
+        check_upstream_response("gemini", response)
+        candidates = response.json().get("candidates") or []
+        parts = candidates[0].get("content", {}).get("parts", []) if candidates else []
+        return "".join(part.get("text", "") for part in parts).strip()
+
+class StubTranscriber(Transcriber):
+    """Tarmoqsiz ishlash va benchmark uchun: yonidagi .txt faylni yoki VOICE_STUB_TEXT ni qaytaradi."""
+
+    async def transcribe(self, path, mime_type, language=None):
         try:
-            detective_task = asyncio.create_task(search_for_reply(prompt))
-            found_replies = await asyncio.wait_for(detective_task, timeout=15.0)
+            with open(path + ".txt", 'r', encoding='utf-8') as f:
+                return f.read().strip()
+        except FileNotFoundError:
+            return VOICE_STUB_TEXT
 
-            if found_replies:
-                chosen_reply = random.choice(found_replies)
-                logging.info("Detektiv muvaffaqiyatli. Topilgan javob yuborilmoqda.")
-                await event.reply(chosen_reply)
-                return
-        except asyncio.TimeoutError:
-            logging.info("Detektivlik vaqti tugadi. Javob topilmadi.")
+def create_transcriber():
+    return StubTranscriber() if VOICE_TRANSCRIBER == "stub" else GeminiTranscriber()
+
+def voice_candidate(event):
+    if event.is_private:
+        return event.sender_id != my_telegram_id and bool(config.get("allow_all_users"))
+    return auto_reply_candidate(event, voice=True)
+
+class VoicePipeline:
+    """Ovozli xabarlar umumiy rejalashtiruvchi yo'laklari orqali bajariladi: guruhlarda "auto", shaxsiy chatlarda
+    "command". CPU og'ir konvertatsiya alohida jarayonlarda bajariladi, Telethon event loopi bloklanmaydi."""
+
+    def __init__(self, transcriber):
+        self.transcriber = transcriber
+        self.languages = TTLCache(AI_CACHE_SIZE, CHAT_LANGUAGE_TTL)  # chat_id -> til kodi
+        self.processed = self.failed = self.dropped = 0
+
+    def submit(self, event):
+        duration = getattr(event.message.file, 'duration', None) or 0
+        if duration > VOICE_MAX_DURATION:
+            logging.info(f"{event.chat_id} chatidagi ovozli xabar juda uzun ({duration} s), o'tkazib yuborildi.")
+            return False
+        if not scheduler.submit("command" if event.is_private else "auto", event.chat_id, lambda: self._run(event)):
+            self.dropped += 1
+            return False
+        return True
+
+    async def download(self, event):
+        # Fayl I/O rasm quvuridagi kabi oqimlarda: sekin disk event loopni to'xtatmasin
+        fd, path = await asyncio.to_thread(tempfile.mkstemp, suffix=".ogg")
+        f = os.fdopen(fd, 'wb')
+        try:
+            try:
+                async for chunk in client.iter_download(event.message.media):
+                    await asyncio.to_thread(f.write, chunk)
+            finally:
+                await asyncio.to_thread(f.close)
+        except BaseException:
+            await asyncio.to_thread(remove_file, path)
+            raise
+        return path
+
+    async def transcribe(self, chat_id, path):
+        language = self.languages.get(chat_id)
+        text = await self.transcriber.transcribe(path, "audio/mp3", language)
+        if text and language is None:
+            language = await asyncio.to_thread(detect_language, text)
+            if language:
+                self.languages.set(chat_id, language)
+        return text
+
+    @metrics.timed("handler", "voice")
+    async def process(self, event):
+        # Guruhlarda arzon tekshiruvlar (reply nishoni, anti-flood) yuklab olish va transkripsiyadan oldin
+        if not event.is_private and not await auto_reply_allowed(event):
+            return
+        src_path = await self.download(event)
+        dst_path = src_path + ".mp3"
+        try:
+            await asyncio.get_running_loop().run_in_executor(get_voice_executor(), convert_voice, src_path, dst_path)
+            text = await self.transcribe(event.chat_id, dst_path)
+        finally:
+            for path in (src_path, dst_path):
+                await asyncio.to_thread(remove_file, path)
+        if not text:
+            return
+        logging.info(f"Ovozli xabar matnga aylantirildi ({len(text)} belgi).")
+        if event.is_private:
+            await handle_gemini_command(event, text)
+        else:
+            await answer_auto_reply(event, text, event.message.id)
+
+    async def _run(self, event):
+        try:
+            await self.process(event)
+            self.processed += 1
         except Exception as e:
-            logging.error(f"Detektivlik jarayonida kutilmagan xatolik: {e}", exc_info=True)
-    
-    logging.info("AIga murojaat qilinmoqda...")
-    async with client.action(event.chat_id, 'typing'):
-        response = await get_gemini_response(prompt, event.chat_id, event.sender_id, event.is_private)
-        if response:
-            await send_long_message(event.chat_id, response, reply_to=event.message.id)
+            self.failed += 1
+            masked_error = mask_sensitive_info(str(e), gemini_api_key, GEMINI_BASE_API_URL)
+            logging.error(f"Ovozli xabarni qayta ishlashda xatolik: {masked_error}", exc_info=True)
+
+    def stats(self):
+        return {"processed": self.processed, "failed": self.failed, "dropped": self.dropped}
+
+voice_pipeline = VoicePipeline(create_transcriber())
 
 async def _do_auto_send(chat_id, text, interval, count, original_msg_id):
     try:
@@ -421,6 +2830,7 @@ async def _do_auto_send(chat_id, text, interval, count, original_msg_id):
     finally:
         active_auto_send_tasks.pop(chat_id, None)
 
+@metrics.timed("handler")
 async def handle_auto_text_command(event: Message):
     if event.sender_id != my_telegram_id: return
     chat_id = event.chat_id
@@ -442,6 +2852,7 @@ async def handle_auto_text_command(event: Message):
     active_auto_send_tasks[chat_id] = task
     await event.delete()
 
+@metrics.timed("handler")
 async def handle_info_command(event: Message):
     if event.sender_id != my_telegram_id or not event.reply_to_msg_id:
         await event.delete()
@@ -454,7 +2865,7 @@ async def handle_info_command(event: Message):
         if user.status:
             status_text = user.status.__class__.__name__.replace("UserStatus", "")
             if hasattr(user.status, 'was_online'):
-                 status_text += f" ({datetime.fromtimestamp(user.status.was_online).astimezone(pytz.timezone('Asia/Tashkent')).strftime('%Y-%m-%d %H:%M')})"
+                 status_text += f" ({datetime.fromtimestamp(user.status.was_online).astimezone(tashkent_tz()).strftime('%Y-%m-%d %H:%M')})"
         
         info = (f"👤 **Foydalanuvchi Ma'lumotlari**\n\n"
                 f"**ID:** `{user.id}`\n"
@@ -474,6 +2885,7 @@ async def handle_info_command(event: Message):
     except Exception as e:
         await event.edit(f"Ma'lumot olishda xatolik: {e}")
 
+@metrics.timed("handler")
 async def handle_help_command(event: Message):
     if event.sender_id != my_telegram_id: return
     help_text = """
@@ -500,11 +2912,19 @@ async def handle_help_command(event: Message):
     `.adm sendavto on/off` - Guruhlarda avtomatik javob berishni yoqish/o'chirish.
     `.adm online on/off` - Doimiy "online" rejimini yoqish/o'chirish.
     `.adm statistika` - Akkaunt statistikasi.
+    `.adm pool` - HTTP ulanishlar pooli holati.
+    `.adm cache` - Kesh va birlashtirilgan so'rovlar statistikasi.
+    `.adm queue` - Ish navbatlari holati.
+    `.adm limits` - Rate limit statistikasi.
+    `.adm metrics` - Handler va upstream kechikishlari (p50/p95/p99).
+    `.adm del [son] [dan:YYYY-MM-DD] [gacha:YYYY-MM-DD]` - Chatdagi o'z xabarlarimni o'chirish.
+    `.adm del stop` - O'chirish jarayonini to'xtatish.
     
     **🗣️ Faol Guruhlarni Boshqarish:**
     `.adm set active` - Joriy guruhni avto-javob uchun faollashtirish.
     `.adm del active` - Joriy guruhni faollar ro'yxatidan o'chirish.
     `.adm active status` - Barcha faol guruhlar ro'yxati.
+    `.adm clear chat history` - Joriy chatdagi barcha AI suhbat tarixlarini o'chirish.
     
     **ℹ️ Yordam:**
     `.help` - Ushbu yordam menyusini ko'rsatish.
@@ -512,6 +2932,7 @@ async def handle_help_command(event: Message):
     reply_message = await event.reply(textwrap.dedent(help_text))
     asyncio.create_task(delete_message_after_delay(event, reply_message, delay=60))
 
+@metrics.timed("handler")
 async def handle_tosh_command(event: Message):
     """Omadli (5 yoki 6) tosh tushguncha 'o'chirib-yuborish' usulida ishlaydi."""
     if event.sender_id != my_telegram_id:
@@ -550,39 +2971,236 @@ async def handle_tosh_command(event: Message):
 
     logging.warning(f"{max_tries} urinishda omadli tosh topilmadi.")
 
+# Ish rejalashtiruvchisi: ustuvorlik yo'laklari, har bir chat ichida FIFO tartib va umumiy/yo'lak bo'yicha limitlar
+SCHEDULER_MAX_CONCURRENCY = int(os.environ.get("SCHEDULER_MAX_CONCURRENCY", 16))
+SCHEDULER_LANES = [
+    # (nomi, parallel ishlar limiti, navbat sig'imi, ishning maksimal yoshi soniyada yoki None, to'lganda eskisini tashlash)
+    ("owner", int(os.environ.get("SCHEDULER_OWNER_CONCURRENCY", 4)), 200, None, False),
+    ("command", int(os.environ.get("SCHEDULER_COMMAND_CONCURRENCY", 8)), int(os.environ.get("SCHEDULER_COMMAND_QUEUE", 200)), None, False),
+    ("auto", int(os.environ.get("SCHEDULER_AUTO_CONCURRENCY", 6)), int(os.environ.get("SCHEDULER_AUTO_QUEUE", 100)), float(os.environ.get("SCHEDULER_AUTO_MAX_AGE", 30)), True),
+]
+
+class SchedulerLane:
+    def __init__(self, name, concurrency, max_queue, max_age, shed_oldest):
+        self.name = name
+        self.concurrency = concurrency
+        self.max_queue = max_queue
+        self.max_age = max_age
+        self.shed_oldest = shed_oldest
+        self.queues = {}  # chat_id -> deque[(submitted_at, coro_factory)]
+        self.ready = deque()  # navbatida ish bor va hozir band bo'lmagan chatlar
+        self.running = set()
+        self.active = 0
+        self.queued = 0
+        self.dropped = 0
+
+    def drop_oldest(self):
+        heads = [(queue[0][0], chat_id) for chat_id, queue in self.queues.items() if queue]
+        if not heads:
+            return False
+        _, chat_id = min(heads)
+        queue = self.queues[chat_id]
+        queue.popleft()
+        self.queued -= 1
+        self.dropped += 1
+        if not queue:
+            del self.queues[chat_id]
+            if chat_id in self.ready:
+                self.ready.remove(chat_id)
+        return True
+
+class WorkScheduler:
+    """Handlerlar ishini yo'laklar bo'yicha navbatga qo'yadi. Yuqori yo'laklar birinchi ishga tushadi,
+    bir chatdagi ishlar bitta yo'lak ichida ketma-ket bajariladi, eskirgan avto-javoblar tashlab yuboriladi."""
+
+    def __init__(self, lanes, max_concurrency):
+        self.lanes = [SchedulerLane(*lane) for lane in lanes]
+        self._lanes = {lane.name: lane for lane in self.lanes}
+        self.max_concurrency = max_concurrency
+        self.active = 0
+        self._tasks = set()
+
+    def submit(self, lane_name, chat_id, coro_factory):
+        lane = self._lanes[lane_name]
+        if lane.queued >= lane.max_queue and not (lane.shed_oldest and lane.drop_oldest()):
+            lane.dropped += 1
+            logging.warning(f"'{lane.name}' navbati to'lgan, {chat_id} chatidagi ish tashlab yuborildi.")
+            return False
+        queue = lane.queues.setdefault(chat_id, deque())
+        queue.append((time.monotonic(), coro_factory))
+        lane.queued += 1
+        if len(queue) == 1 and chat_id not in lane.running:
+            lane.ready.append(chat_id)
+        self._dispatch()
+        return True
+
+    def _dispatch(self):
+        for lane in self.lanes:
+            while lane.ready and self.active < self.max_concurrency and lane.active < lane.concurrency:
+                chat_id = lane.ready.popleft()
+                queue = lane.queues[chat_id]
+                submitted_at, coro_factory = queue.popleft()
+                lane.queued -= 1
+                if not queue:
+                    del lane.queues[chat_id]
+                if lane.max_age is not None and time.monotonic() - submitted_at > lane.max_age:
+                    lane.dropped += 1
+                    if chat_id in lane.queues:
+                        lane.ready.append(chat_id)
+                    continue
+                lane.running.add(chat_id)
+                lane.active += 1
+                self.active += 1
+                task = asyncio.create_task(self._run(lane, chat_id, coro_factory))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, lane, chat_id, coro_factory):
+        try:
+            await coro_factory()
+        except Exception as e:
+            masked_error = mask_sensitive_info(str(e), gemini_api_key, GEMINI_BASE_API_URL)
+            logging.error(f"Xatolik yuz berdi: {masked_error}", exc_info=True)
+        finally:
+            lane.running.discard(chat_id)
+            lane.active -= 1
+            self.active -= 1
+            if chat_id in lane.queues:
+                lane.ready.append(chat_id)
+            self._dispatch()
+
+    def stats(self):
+        return {lane.name: {"active": lane.active, "queued": lane.queued, "dropped": lane.dropped} for lane in self.lanes}
+
+    async def close(self):
+        for lane in self.lanes:
+            lane.queues.clear()
+            lane.ready.clear()
+            lane.queued = 0
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+scheduler = WorkScheduler(SCHEDULER_LANES, SCHEDULER_MAX_CONCURRENCY)
+
+@client.on(events.MessageRead(inbox=True))
+async def dialog_read_handler(event):
+    await startup_ready.wait()
+    dialog_cache.on_read(event.chat_id)
+
+@client.on(events.ChatAction)
+async def dialog_action_handler(event):
+    await startup_ready.wait()
+    try:
+        dialog_cache.on_chat_action(event)
+    except Exception as e:
+        logging.debug(f"ChatAction ni qayta ishlashda xatolik: {e}")
+
 @client.on(events.NewMessage)
 async def my_event_handler(event: Message):
+    if not startup_ready.is_set():
+        await startup_ready.wait()
+    try:
+        dialog_cache.on_new_message(event)
+    except Exception as e:
+        logging.debug(f"Dialoglar keshini yangilashda xatolik: {e}")
     if not (event.is_private or event.is_group): return
     try:
+        if event.out:
+            own_messages.add(event.chat_id, event.message.id)
+        if event.is_group:
+            reply_index.observe(event.chat_id, event.message.id, event.text, event.sender_id, event.message.reply_to_msg_id)
         text_lower = event.text.lower() if event.text else ""
-        if text_lower.startswith(".adm "): await handle_admin_command(event, event.text[5:].strip())
-        elif text_lower.startswith(".text"): await handle_auto_text_command(event)
+        owner_lane = "owner" if event.sender_id == my_telegram_id else "command"
+        if text_lower.startswith(".adm "): lane, job = owner_lane, lambda: handle_admin_command(event, event.text[5:].strip())
+        elif text_lower.startswith(".text"): lane, job = owner_lane, lambda: handle_auto_text_command(event)
         elif text_lower.startswith((".ai ", ".chatgpt ")):
             prefix_len = 4 if text_lower.startswith(".ai ") else 9
-            await handle_gemini_command(event, event.text[prefix_len:].strip())
-        elif text_lower.startswith(".pic "): await handle_image_command(event, event.text[5:].strip())
-        elif text_lower == ".info": await handle_info_command(event)
-        elif text_lower == ".help": await handle_help_command(event)
-        elif text_lower == ".tosh": await handle_tosh_command(event) 
-        elif event.text: await handle_auto_reply(event)
+            lane, job = "command", lambda: handle_gemini_command(event, event.text[prefix_len:].strip())
+        elif text_lower.startswith(".pic "): lane, job = "command", lambda: handle_image_command(event, event.text[5:].strip())
+        elif text_lower == ".info": lane, job = owner_lane, lambda: handle_info_command(event)
+        elif text_lower == ".help": lane, job = owner_lane, lambda: handle_help_command(event)
+        elif text_lower == ".tosh": lane, job = owner_lane, lambda: handle_tosh_command(event)
+        elif VOICE_ENABLED and event.message.voice and voice_candidate(event):
+            voice_pipeline.submit(event)
+            return
+        elif AUTO_REPLY_DEBOUNCE and event.text and (auto_debouncer.is_open(event.chat_id, event.sender_id) or auto_reply_candidate(event)):
+            auto_debouncer.add(event)
+            return
+        elif auto_reply_candidate(event): lane, job = "auto", lambda: handle_auto_reply(event)
+        else: return
+        scheduler.submit(lane, event.chat_id, job)
     except Exception as e:
         masked_error = mask_sensitive_info(str(e), gemini_api_key, GEMINI_BASE_API_URL)
         logging.error(f"Xatolik yuz berdi: {masked_error}", exc_info=True)
 
+# Ishga tushish: lokal holat Telegram ulanishi bilan parallel yuklanadi, handlerlar startup_ready ni kutadi
+HTTP_PREWARM = os.environ.get("HTTP_PREWARM", "1") == "1"
+startup_ready = asyncio.Event()
+
+async def timed_phase(timings, name, awaitable):
+    start = time.monotonic()
+    try:
+        return await awaitable
+    finally:
+        timings[name] = time.monotonic() - start
+        metrics.observe("startup", name, timings[name])
+
+def prepare_history_store():
+    create_chat_history_dir()
+    migrate_json_histories(history_cache.store)
+
+async def prewarm_http_clients():
+    """Upstream bilan TCP/TLS ulanishlarini oldindan ochadi, birinchi .ai/.pic so'rovi handshake kutmaydi."""
+    async def warm(name, method, url, params=None):
+        try:
+            await get_http_client(name).request(method, url, params=params)
+        except Exception as e:
+            logging.debug(f"{name} ulanishini oldindan ochib bo'lmadi: {e}")
+    await asyncio.gather(warm("gemini", "GET", GEMINI_BASE_API_URL, {"key": gemini_api_key}),
+                         warm("pollinations", "HEAD", POLLINATIONS_IMAGE_API_BASE_URL))
+
+async def announce_identity(me=None):
+    me = me or await client.get_me()
+    logging.info(f"Userbot {me.first_name} (@{me.username}) nomi bilan ishlamoqda. ID: {my_telegram_id}")
+
 async def main():
+    timings, started = {}, time.monotonic()
     try:
-        create_chat_history_dir()
-        await client.start()
+        open_http_clients()
+        await asyncio.gather(
+            timed_phase(timings, "telegram", client.start()),
+            timed_phase(timings, "config", asyncio.to_thread(config.load)),
+            timed_phase(timings, "persona", asyncio.to_thread(persona_prefix.refresh)),
+            timed_phase(timings, "dialog_cache", asyncio.to_thread(dialog_cache.load)),
+            timed_phase(timings, "history", asyncio.to_thread(prepare_history_store)),
+        )
         logging.info("Bot ishga tushirildi.")
-        me = await client.get_me()
         global my_telegram_id
-        if not my_telegram_id: my_telegram_id = me.id
-        logging.info(f"Userbot {me.first_name} (@{me.username}) nomi bilan ishlamoqda. ID: {my_telegram_id}")
-        await asyncio.gather(client.run_until_disconnected(), account_online_loop())
+        if my_telegram_id:
+            # ID .env da bor: get_me faqat log uchun, handlerlarni kutdirmaydi
+            asyncio.create_task(announce_identity())
+        else:
+            me = await timed_phase(timings, "get_me", client.get_me())
+            my_telegram_id = me.id
+            await announce_identity(me)
+        startup_ready.set()
+        timings["ready"] = time.monotonic() - started
+        logging.info("Ishga tushish vaqtlari: " + ", ".join(f"{name} {seconds:.2f}s" for name, seconds in timings.items()))
+        await asyncio.gather(client.run_until_disconnected(), account_online_loop(), history_cache.run(), config.run(), limiter.run(), run_summarizer(), dialog_cache.run(), metrics.run(), own_messages.warm_active(),
+                             reply_index.run(), reply_index.backfill_loop(), *([prewarm_http_clients()] if HTTP_PREWARM else []))
     except Exception as e:
         logging.critical(f"Bot ishga tushirishda kutilmagan xatolik: {e}", exc_info=True)
     finally:
         logging.info("Bot to'xtatildi.")
+        auto_debouncer.close()
+        await scheduler.close()
+        await history_cache.close()
+        await reply_index.close()
+        await dialog_cache.save()
+        await close_http_clients()
+        shutdown_image_executor()
+        shutdown_voice_executor()
         if client.is_connected(): await client.disconnect()
 
 if __name__ == '__main__':
@@ -0,0 +1,25 @@
+# --- START OF FILE media_workers.py ---
+# Jarayonlar pulida bajariladigan CPU og'ir ishlar. bot.py runtime.py orqali "bot_<akkaunt>" nomi bilan yuklanadi,
+# bola jarayonlar esa funksiyalarni modul nomi bo'yicha import qiladi, shuning uchun ular shu alohida modulda turadi.
+# Bu modul import paytida hech narsa qilmaydi, og'ir kutubxonalar (Pillow, pydub) birinchi vazifada yuklanadi.
+# forkserver/spawn bola jarayonda asosiy skriptni ham qayta bajaradi, shuning uchun bot start.py yoki runtime.py
+# orqali ishga tushiriladi: ularda import paytida yon ta'sir yo'q.
+
+def recompress_image(src_path, image_format, max_side, quality):
+    """Rasmni kichraytirib Telegramga mos JPEG/WebP ga o'giradi. Pool ichida ishlaydi, natija fayl yo'lini qaytaradi."""
+    from PIL import Image
+    dst_path = f"{src_path}.{image_format.lower()}"
+    with Image.open(src_path) as image:
+        image.thumbnail((max_side, max_side), Image.LANCZOS)
+        if image_format == "JPEG":
+            image.convert("RGB").save(dst_path, "JPEG", quality=quality, optimize=True, progressive=True)
+        else:
+            image.save(dst_path, image_format, quality=quality, method=4)
+    return dst_path
+
+def convert_voice(src_path, dst_path):
+    """Jarayonlar pulida ishlaydi: OGG/Opus ni 16 kHz mono MP3 ga o'tkazadi va davomiyligini qaytaradi."""
+    from pydub import AudioSegment
+    audio = AudioSegment.from_file(src_path)
+    audio.set_channels(1).set_frame_rate(16000).export(dst_path, format="mp3", bitrate="32k")
+    return len(audio) / 1000
@@ -0,0 +1,157 @@
+# --- START OF FILE runtime.py ---
+# Bir nechta akkauntni bitta konfiguratsiyadan ishga tushirish. Akkauntlar shardlarga bo'linadi, har bir shard
+# alohida jarayonda bitta event loopda ishlaydi, supervisor yiqilgan jarayonlarni qayta ishga tushiradi.
+# Ishlatish: python runtime.py [accounts.json]
+#
+# accounts.json:
+# {
+#   "shards": 2,                              // jarayonlar soni (standart: CPU yadrolari soni)
+#   "shared_store": "shared_store.db",        // upstream limitlari, AI keshi va persona keshi uchun umumiy ombor
+#   "data_dir": "accounts",                   // har bir akkaunt fayllari <data_dir>/<name>/ ichida
+#   "env": {"GEMINI_API_KEY": "..."},         // barcha akkauntlar uchun umumiy sozlamalar
+#   "accounts": [
+#     {"name": "asosiy", "api_id": 123, "api_hash": "...", "session": "userbot_session", "my_telegram_id": 111,
+#      "env": {"METRICS_PORT": "9101"}}
+#   ]
+# }
+
+import asyncio
+import importlib.util
+import json
+import logging
+import multiprocessing
+import os
+import re
+import signal
+import sys
+import time
+
+BOT_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bot.py")
+ACCOUNTS_FILE = os.environ.get("ACCOUNTS_FILE", "accounts.json")
+RESTART_BACKOFF = float(os.environ.get("RUNTIME_RESTART_BACKOFF", 5))
+RESTART_BACKOFF_MAX = float(os.environ.get("RUNTIME_RESTART_BACKOFF_MAX", 300))
+RESTART_RESET_AFTER = float(os.environ.get("RUNTIME_RESTART_RESET_AFTER", 600))
+STOP_TIMEOUT = float(os.environ.get("RUNTIME_STOP_TIMEOUT", 30))
+
+def load_runtime_config(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        config = json.load(f)
+    names = [account["name"] for account in config["accounts"]]
+    if len(set(names)) != len(names):
+        raise ValueError("Akkaunt nomlari takrorlanmasligi kerak.")
+    return config
+
+def account_env(account, config):
+    """Akkaunt uchun bot.py o'qiydigan muhit o'zgaruvchilari. Akkauntga xos kalitlar har doim beriladi,
+    aks holda .env dagi asosiy akkaunt qiymatlari boshqa akkauntlarga o'tib ketadi."""
+    data_dir = os.path.join(config.get("data_dir", "accounts"), account["name"])
+    env = {"METRICS_PORT": "0", **config.get("env", {}), **account.get("env", {})}
+    env.update({
+        "API_ID": str(account["api_id"]),
+        "API_HASH": account["api_hash"],
+        "SESSION_NAME": account.get("session", os.path.join(data_dir, "session")),
+        "MY_TELEGRAM_ID": str(account.get("my_telegram_id", 0)),
+        "BOT_DATA_DIR": data_dir,
+    })
+    if config.get("shared_store"):
+        env["SHARED_STORE_FILE"] = config["shared_store"]
+    return {key: str(value) for key, value in env.items()}
+
+def load_account_module(account, config):
+    """bot.py ni akkaunt nomi bilan alohida modul sifatida yuklaydi: har bir nusxada o'z klienti, navbatlari va
+    keshlari bo'ladi. bot.py sozlamalarni import paytida o'qigani uchun muhit faqat shu vaqtga almashtiriladi."""
+    env = account_env(account, config)
+    os.makedirs(env["BOT_DATA_DIR"], exist_ok=True)
+    saved = {key: os.environ.get(key) for key in env}
+    os.environ.update(env)
+    try:
+        spec = importlib.util.spec_from_file_location("bot_" + re.sub(r"\W", "_", account["name"]), BOT_FILE)
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[spec.name] = module
+        spec.loader.exec_module(module)
+        return module
+    finally:
+        for key, value in saved.items():
+            if value is None: os.environ.pop(key, None)
+            else: os.environ[key] = value
+
+def run_shard(shard_index, accounts, config):
+    """Worker jarayoni: shard akkauntlarini bitta event loopda ishlatadi. Birorta akkaunt to'xtasa, qolganlari
+    to'g'ri yopiladi va jarayon xato kodi bilan chiqadi, supervisor esa shardni qayta ishga tushiradi."""
+    logging.basicConfig(level=logging.INFO, format=f'%(asctime)s - shard{shard_index} - %(levelname)s - %(message)s')
+    modules = {account["name"]: load_account_module(account, config) for account in accounts}
+
+    async def run_all():
+        loop = asyncio.get_running_loop()
+        tasks = {asyncio.create_task(module.main()): name for name, module in modules.items()}
+        stop = asyncio.Event()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(sig, stop.set)
+        stopper = asyncio.create_task(stop.wait())
+        done, _ = await asyncio.wait([*tasks, stopper], return_when=asyncio.FIRST_COMPLETED)
+        stopped_by_signal = stopper in done
+        for task in done:
+            if task in tasks:
+                logging.error(f"'{tasks[task]}' akkaunti to'xtadi, shard qayta ishga tushiriladi.")
+        for task in [*tasks, stopper]:
+            task.cancel()
+        # main() ning finally bloklari (tarixni yozish, klientlarni yopish) shu yerda bajariladi
+        await asyncio.gather(*tasks, stopper, return_exceptions=True)
+        return 0 if stopped_by_signal else 1
+
+    sys.exit(asyncio.run(run_all()))
+
+def split_shards(accounts, count):
+    return [shard for shard in (accounts[i::count] for i in range(count)) if shard]
+
+def supervise(config):
+    """Har bir shard uchun bitta jarayon. Yiqilgan jarayon eksponensial kutish bilan qayta ishga tushiriladi;
+    jarayon RESTART_RESET_AFTER dan uzoq ishlagan bo'lsa kutish qayta boshlang'ich qiymatga tushadi."""
+    context = multiprocessing.get_context("spawn")
+    shards = split_shards(config["accounts"], int(config.get("shards") or os.cpu_count() or 1))
+    workers = {}  # shard indeksi -> [jarayon, ishga tushgan vaqti, keyingi kutish, qayta ishga tushirish vaqti]
+    stopping = False
+
+    def start(index):
+        process = context.Process(target=run_shard, args=(index, shards[index], config), name=f"shard{index}")
+        process.start()
+        logging.info(f"shard{index} ishga tushdi (pid {process.pid}): {', '.join(a['name'] for a in shards[index])}")
+        return process
+
+    def request_stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+    for index in range(len(shards)):
+        workers[index] = [start(index), time.monotonic(), RESTART_BACKOFF, None]
+
+    while not stopping:
+        time.sleep(1)
+        now = time.monotonic()
+        for index, worker in workers.items():
+            process, started, backoff, restart_at = worker
+            if restart_at is not None:
+                if now >= restart_at:
+                    worker[:] = [start(index), now, backoff, None]
+            elif not process.is_alive():
+                if now - started > RESTART_RESET_AFTER:
+                    backoff = RESTART_BACKOFF
+                logging.warning(f"shard{index} {process.exitcode} kodi bilan to'xtadi, {backoff:.0f} soniyadan keyin qayta ishga tushiriladi.")
+                worker[2:] = [min(backoff * 2, RESTART_BACKOFF_MAX), now + backoff]
+
+    logging.info("Shardlar to'xtatilmoqda...")
+    alive = [worker[0] for worker in workers.values() if worker[3] is None and worker[0].is_alive()]
+    for process in alive:
+        process.terminate()  # SIGTERM: worker akkauntlarni to'g'ri yopadi
+    deadline = time.monotonic() + STOP_TIMEOUT
+    for process in alive:
+        process.join(max(0.0, deadline - time.monotonic()))
+        if process.is_alive():
+            logging.warning(f"{process.name} o'z vaqtida to'xtamadi, majburan to'xtatilmoqda.")
+            process.kill()
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - supervisor - %(levelname)s - %(message)s')
+    supervise(load_runtime_config(sys.argv[1] if len(sys.argv) > 1 else ACCOUNTS_FILE))
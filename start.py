@@ -0,0 +1,15 @@
+# --- START OF FILE start.py ---
+# Bitta akkauntni ishga tushirish: python start.py (bir nechta akkaunt uchun runtime.py).
+# Rasm va ovoz konvertatsiyasi uchun jarayonlar puli forkserver/spawn bilan ishlaydi va har bir bola jarayonda asosiy
+# skriptni qayta bajaradi. Bu skript import paytida hech narsa qilmaydi: bot.py (Telegram klienti, sessiya fayli,
+# .env) faqat shu asosiy jarayonda yuklanadi.
+
+import asyncio
+import logging
+
+if __name__ == '__main__':
+    import bot
+    try:
+        asyncio.run(bot.main())
+    except KeyboardInterrupt:
+        logging.info("Bot foydalanuvchi tomonidan to'xtatildi.")
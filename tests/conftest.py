@@ -0,0 +1,19 @@
+# bot.py sozlamalarni import paytida muhitdan o'qiydi va Telegram klientini yaratadi: testlar uchun soxta
+# akkaunt va vaqtinchalik papka shu yerda, bot import qilinishidan oldin beriladi. Ishlatish: python -m pytest tests
+
+import os
+import sys
+import tempfile
+
+DATA_DIR = tempfile.mkdtemp(prefix="tg-server-tests-")
+os.environ.update({
+    "API_ID": "1",
+    "API_HASH": "test",
+    "MY_TELEGRAM_ID": "1",
+    "SESSION_NAME": os.path.join(DATA_DIR, "session"),
+    "BOT_DATA_DIR": DATA_DIR,
+    "METRICS_PORT": "0",
+    "SHARED_STORE_FILE": "",
+})
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.chdir(DATA_DIR)  # nisbiy yo'lli ma'lumot fayllari (persona.json, sozlamalar) ham vaqtinchalik papkaga tushadi
@@ -0,0 +1,97 @@
+# Single-flight va AI javoblari keshi uchun testlar.
+
+import asyncio
+import time
+
+import pytest
+
+import bot
+
+
+def test_single_flight_shares_one_call():
+    calls = []
+
+    async def fetch():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return "javob"
+
+    async def main():
+        flight = bot.SingleFlight()
+        results = await asyncio.gather(*(flight.do("k", fetch) for _ in range(5)))
+        assert results == ["javob"] * 5
+        assert (flight.leaders, flight.shared) == (1, 4)
+        assert flight.stats()["in_flight"] == 0
+
+    asyncio.run(main())
+    assert len(calls) == 1
+
+
+def test_single_flight_propagates_error_to_all_waiters():
+    async def fail():
+        await asyncio.sleep(0.01)
+        raise ValueError("xato")
+
+    async def main():
+        flight = bot.SingleFlight()
+        results = await asyncio.gather(flight.do("k", fail), flight.do("k", fail), return_exceptions=True)
+        assert all(isinstance(result, ValueError) for result in results)
+
+    asyncio.run(main())
+
+
+def test_ttl_cache_expires_and_evicts_oldest(monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr(bot.time, "monotonic", lambda: now[0])
+    cache = bot.TTLCache(2, ttl=10)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    cache.set("c", 3)  # "b" eng uzoq ishlatilmagan
+    assert cache.get("b") is None and cache.get("c") == 3
+    now[0] = 11
+    assert cache.get("a") is None
+    assert cache.stats() == {"hits": 2, "misses": 2, "size": 1}
+
+
+@pytest.fixture
+def answer_env(monkeypatch, tmp_path):
+    calls = []
+
+    async def generate(context, prompt, *args):
+        calls.append((tuple(turn["parts"][0]["text"] for turn in context), prompt))
+        await asyncio.sleep(0.02)
+        return f"javob {len(calls)}"
+
+    store = bot.SqliteHistoryStore(str(tmp_path / "history.db"), bot.HISTORY_MAX_TURNS)
+    monkeypatch.setattr(bot, "history_cache", bot.ChatHistoryCache(store, 100, 600, 60))
+    monkeypatch.setattr(bot, "ai_response_cache", bot.TTLCache(100, 60))
+    monkeypatch.setattr(bot, "ai_single_flight", bot.SingleFlight())
+    monkeypatch.setattr(bot, "generate_gemini_text", generate)
+    yield calls
+    store.close()
+
+
+def test_two_senders_share_one_answer(answer_env):
+    """Bir xil bot xabariga reply qilgan, tarixi yo'q ikki foydalanuvchi bitta Gemini chaqiruvini bo'lishadi."""
+    async def main():
+        return await asyncio.gather(
+            bot.get_gemini_response("Salom!", -1001, 5, False, context_key=(-1001, 10)),
+            bot.get_gemini_response("salom", -1001, 6, False, context_key=(-1001, 10)))
+
+    assert asyncio.run(main()) == ["javob 1", "javob 1"]
+    assert len(answer_env) == 1
+    assert bot.ai_single_flight.stats()["shared"] == 1
+
+
+def test_sender_history_gets_own_answer(answer_env):
+    async def main():
+        await bot.history_cache.append(-1001, 6, False, [bot.gemini_user_turn("oldingi savol"),
+                                                         {"role": "model", "parts": [{"text": "oldingi javob"}]}], time.time())
+        first = await bot.get_gemini_response("salom", -1001, 5, False, context_key=(-1001, 10))
+        second = await bot.get_gemini_response("salom", -1001, 6, False, context_key=(-1001, 10))
+        third = await bot.get_gemini_response("salom", -1001, 7, False, context_key=(-1001, 10))
+        return first, second, third
+
+    assert asyncio.run(main()) == ("javob 1", "javob 2", "javob 1")
+    assert answer_env == [((), "salom"), (("oldingi savol", "oldingi javob"), "salom")]
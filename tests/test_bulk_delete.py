@@ -0,0 +1,99 @@
+# `.adm del` ommaviy o'chirish uchun testlar. Telegram klienti va xabar tahrirlari soxta funksiyalar bilan almashtiriladi.
+
+import asyncio
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import pytest
+from telethon import errors
+
+import bot
+
+START = datetime(2024, 6, 1, tzinfo=bot.tashkent_tz())
+STATUS_ID = 1000
+
+
+@pytest.fixture
+def delete_env(monkeypatch):
+    env = SimpleNamespace(messages=[], deleted=[], edits=[], floods=[], block=None)
+
+    async def iter_messages(chat_id, from_user, limit, offset_date):
+        messages = [message for message in env.messages if not offset_date or message.date < offset_date]
+        for message in messages[:limit]:
+            yield message
+
+    async def delete_messages(chat_id, ids, revoke):
+        if env.block:
+            await env.block.wait()
+        if env.floods:
+            raise errors.FloodWaitError(request=None, capture=env.floods.pop())
+        env.deleted.append(list(ids))
+        return [SimpleNamespace(pts_count=len(ids))]
+
+    async def safe_edit(message, text, **kwargs):
+        env.edits.append(text)
+        return True
+
+    async def delete_message_after_delay(command_message, reply_message=None, delay=15):
+        pass
+
+    monkeypatch.setattr(bot, "client", SimpleNamespace(iter_messages=iter_messages, delete_messages=delete_messages))
+    monkeypatch.setattr(bot, "safe_edit", safe_edit)
+    monkeypatch.setattr(bot, "delete_message_after_delay", delete_message_after_delay)
+    monkeypatch.setattr(bot, "limiter", bot.RateLimiter({"telegram": (1000, 100)}, idle_seconds=600))
+    return env
+
+
+def own_messages(count, first_id=1):
+    """Yangisidan eskisiga: iter_messages tartibi."""
+    return [SimpleNamespace(id=msg_id, date=START - timedelta(minutes=msg_id)) for msg_id in range(first_id, first_id + count)]
+
+
+def test_parse_bulk_delete_args():
+    limit, after, before = bot.parse_bulk_delete_args(["500", "dan:2024-01-01", "gacha:2024-06-01"])
+    assert limit == 500
+    assert (after.year, after.month, before.month) == (2024, 1, 6)
+    assert bot.parse_bulk_delete_args([]) == (None, None, None)
+    with pytest.raises(ValueError):
+        bot.parse_bulk_delete_args(["hammasi"])
+
+
+def test_deletes_in_batches_and_skips_status(delete_env):
+    delete_env.messages = own_messages(250) + [SimpleNamespace(id=STATUS_ID, date=START)]
+    asyncio.run(bot.bulk_delete_own_messages(-1001, SimpleNamespace(id=STATUS_ID)))
+    assert [len(batch) for batch in delete_env.deleted] == [100, 100, 50]
+    assert STATUS_ID not in sum(delete_env.deleted, [])
+    assert delete_env.edits[-1] == "Bu chatdagi 250 ta xabarim o'chirildi."
+
+
+def test_date_range_and_limit(delete_env):
+    delete_env.messages = own_messages(30)
+    after, before = START - timedelta(minutes=20), START - timedelta(minutes=5)
+    asyncio.run(bot.bulk_delete_own_messages(-1001, SimpleNamespace(id=STATUS_ID), limit=10, after=after, before=before))
+    assert delete_env.deleted == [list(range(6, 16))]
+
+
+def test_flood_wait_retries_same_batch(delete_env):
+    delete_env.messages = own_messages(3)
+    delete_env.floods = [0]
+    asyncio.run(bot.bulk_delete_own_messages(-1001, SimpleNamespace(id=STATUS_ID)))
+    assert delete_env.deleted == [[1, 2, 3]]
+    assert any(text.startswith("⏳ FloodWait") for text in delete_env.edits)
+    assert bot.limiter.stats()["telegram"]["penalties"] == 1
+
+
+def test_cancel_stops_collector(delete_env):
+    delete_env.messages = own_messages(400)
+    delete_env.block = asyncio.Event()  # o'chirish osilib qoladi, yig'uvchi to'la navbatga put() da kutadi
+
+    async def main():
+        task = bot.bulk_delete_tasks[-1001] = asyncio.create_task(bot.bulk_delete_own_messages(-1001, SimpleNamespace(id=STATUS_ID)))
+        await asyncio.sleep(0.01)
+        task.cancel()
+        await asyncio.wait_for(task, 1)
+        return task
+
+    task = asyncio.run(main())
+    assert task.done() and not task.cancelled()
+    assert delete_env.edits[-1] == "⛔ To'xtatildi: 0 ta xabar o'chirildi."
+    assert -1001 not in bot.bulk_delete_tasks
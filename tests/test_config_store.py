@@ -0,0 +1,85 @@
+# ConfigStore uchun testlar: yozish faqat o'zgarishda, qo'lda tahrirlangan fayllarni qayta yuklash.
+
+import json
+import os
+
+import pytest
+
+import bot
+
+
+@pytest.fixture
+def paths(tmp_path):
+    return str(tmp_path / "settings.json"), str(tmp_path / "groups.json")
+
+
+def read_json(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def touch_later(path, data):
+    """Faylni qayta yozib mtime ni aniq o'zgartiradi (ba'zi fayl tizimlarida mtime aniqligi past)."""
+    stat = os.stat(path)
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(data)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+
+
+def test_load_creates_settings_from_defaults(paths):
+    store = bot.ConfigStore(*paths, {"a": 1, "b": 2})
+    store.load()
+    assert store.settings == {"a": 1, "b": 2}
+    assert read_json(paths[0]) == {"a": 1, "b": 2}
+    assert store.active_groups == {}
+
+
+def test_update_writes_only_changes(paths):
+    store = bot.ConfigStore(*paths, {"a": 1})
+    store.load()
+    mtime = os.stat(paths[0]).st_mtime_ns
+    assert not store.update(a=1)
+    assert os.stat(paths[0]).st_mtime_ns == mtime
+    assert store.update(a=2)
+    assert store.get("a") == 2 and read_json(paths[0]) == {"a": 2}
+
+
+def test_active_groups_keep_order_and_persist(paths):
+    store = bot.ConfigStore(*paths, {})
+    store.load()
+    assert store.add_active(-3) and store.add_active(-1)
+    assert not store.add_active(-3)
+    assert store.is_active(-1) and not store.is_active(-2)
+    assert store.remove_active(-3) and not store.remove_active(-3)
+    assert read_json(paths[1]) == {"groups": [-1]}
+    store.add_active(-2)
+    reloaded = bot.ConfigStore(*paths, {})
+    reloaded.load()
+    assert list(reloaded.active_groups) == [-1, -2]
+
+
+def test_reload_picks_up_manual_edit(paths):
+    store = bot.ConfigStore(*paths, {"a": 1})
+    store.load()
+    store.reload_if_changed()
+    assert store.get("a") == 1
+    touch_later(paths[0], json.dumps({"a": 5}))
+    store.reload_if_changed()
+    assert store.get("a") == 5
+
+
+def test_malformed_file_keeps_values_and_is_not_reread(paths, monkeypatch):
+    store = bot.ConfigStore(*paths, {"a": 1})
+    store.load()
+    store.update(a=2)
+    touch_later(paths[0], "{buzilgan")
+    store.reload_if_changed()
+    assert store.get("a") == 2
+    reads = []
+    original = store._read_json
+    monkeypatch.setattr(store, "_read_json", lambda path: reads.append(path) or original(path))
+    store.reload_if_changed()
+    assert reads == []  # fayl yana o'zgarmaguncha qayta o'qilmaydi
+    touch_later(paths[0], json.dumps({"a": 3}))
+    store.reload_if_changed()
+    assert store.get("a") == 3
@@ -0,0 +1,73 @@
+# MessageDebouncer uchun testlar.
+
+import asyncio
+from types import SimpleNamespace
+
+import bot
+
+
+def make_event(chat_id=-1001, sender_id=5, message_id=11, reply_to_msg_id=10):
+    return SimpleNamespace(chat_id=chat_id, sender_id=sender_id, is_private=False,
+                           message=SimpleNamespace(id=message_id, reply_to_msg_id=reply_to_msg_id))
+
+
+def test_debouncer_merges_burst():
+    batches = []
+
+    async def main():
+        debouncer = bot.MessageDebouncer(0.03, 1, 10, batches.append)
+        debouncer.add(make_event(message_id=1))
+        debouncer.add(make_event(message_id=2))
+        assert debouncer.is_open(-1001, 5)
+        await asyncio.sleep(0.08)
+        assert not debouncer.is_open(-1001, 5)
+        assert debouncer.merged == 1
+
+    asyncio.run(main())
+    assert [[event.message.id for event in batch] for batch in batches] == [[1, 2]]
+
+
+def test_debouncer_flushes_at_max_messages():
+    batches = []
+
+    async def main():
+        debouncer = bot.MessageDebouncer(10, 60, 3, batches.append)
+        for message_id in range(3):
+            debouncer.add(make_event(message_id=message_id))
+        assert len(batches) == 1 and len(batches[0]) == 3
+        debouncer.close()
+
+    asyncio.run(main())
+
+
+def test_debouncer_flushes_at_max_delay():
+    """Xabarlar to'xtamasdan kelsa ham birinchi xabardan max_delay o'tgach partiya jo'natiladi."""
+    batches = []
+
+    async def main():
+        debouncer = bot.MessageDebouncer(0.05, 0.1, 100, batches.append)
+        for message_id in range(6):
+            debouncer.add(make_event(message_id=message_id))
+            await asyncio.sleep(0.03)
+        await asyncio.sleep(0.1)
+        debouncer.close()
+
+    asyncio.run(main())
+    assert len(batches) >= 2
+    assert sum(len(batch) for batch in batches) == 6
+
+
+def test_debouncer_counts_pending_batches():
+    batches = []
+
+    async def main():
+        debouncer = bot.MessageDebouncer(0.03, 1, 10, batches.append)
+        debouncer.add(make_event(sender_id=5, message_id=1))
+        debouncer.add(make_event(sender_id=5, message_id=2))
+        debouncer.add(make_event(sender_id=6, message_id=3))
+        assert debouncer.pending == 2
+        await asyncio.sleep(0.08)
+        assert debouncer.pending == 0
+
+    asyncio.run(main())
+    assert len(batches) == 2
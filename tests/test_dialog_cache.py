@@ -0,0 +1,112 @@
+# DialogCache uchun testlar. Telegram klienti iter_dialogs va get_entity ga ega soxta obyekt bilan almashtiriladi.
+
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import bot
+
+
+def dialog(chat_id, name, kind, unread=0):
+    entity = SimpleNamespace(bot=kind == "bot")
+    return SimpleNamespace(id=chat_id, name=name, unread_count=unread, entity=entity, is_user=kind in ("user", "bot"),
+                           is_group=kind == "group", is_channel=kind in ("group", "channel"))
+
+
+def message_event(chat_id, out=False, is_private=False, is_group=True, chat=None):
+    return SimpleNamespace(chat_id=chat_id, out=out, is_private=is_private, is_group=is_group, chat=chat)
+
+
+@pytest.fixture
+def fake_client(monkeypatch):
+    client = SimpleNamespace(dialogs=[], entities={}, entity_calls=[])
+
+    async def iter_dialogs():
+        for item in client.dialogs:
+            yield item
+
+    async def get_entity(chat_ids):
+        client.entity_calls.append(chat_ids)
+        if isinstance(chat_ids, list):
+            return [client.entities[chat_id] for chat_id in chat_ids]
+        return client.entities[chat_ids]
+
+    client.iter_dialogs, client.get_entity = iter_dialogs, get_entity
+    monkeypatch.setattr(bot, "client", client)
+    return client
+
+
+def test_refresh_stats_and_reload(fake_client, tmp_path):
+    fake_client.dialogs = [dialog(1, "Ali", "user", 2), dialog(2, "Bot", "bot"), dialog(-1001, "Guruh", "group", 5),
+                           dialog(-1002, "Kanal", "channel", 1)]
+    path = str(tmp_path / "dialogs.json")
+    cache = bot.DialogCache(path)
+
+    async def main():
+        await cache.refresh()
+        await cache.save()
+
+    asyncio.run(main())
+    assert cache.stats() == {'users': 1, 'groups': 1, 'channels': 1, 'bots': 1, 'unread': 8}
+    reloaded = bot.DialogCache(path)
+    reloaded.load()
+    assert reloaded.dialogs == cache.dialogs and reloaded.refreshed_at == cache.refreshed_at
+
+
+def test_save_writes_only_when_dirty(fake_client, tmp_path, monkeypatch):
+    writes = []
+    monkeypatch.setattr(bot, "atomic_write_json", lambda path, data, indent=None: writes.append(data))
+    cache = bot.DialogCache(str(tmp_path / "dialogs.json"))
+    cache.on_new_message(message_event(-1001, chat=SimpleNamespace(title="Guruh")))
+
+    async def main():
+        await cache.save()
+        await cache.save()
+        cache.on_read(-1001)
+        cache.on_read(-1001)
+        await cache.save()
+
+    asyncio.run(main())
+    assert [data["dialogs"][-1001]["unread"] for data in writes] == [1, 0]
+
+
+def test_updates_follow_events(fake_client, tmp_path):
+    cache = bot.DialogCache(str(tmp_path / "dialogs.json"))
+    cache.on_new_message(message_event(-1001, chat=SimpleNamespace(title="Guruh")))
+    cache.on_new_message(message_event(-1001))
+    cache.on_new_message(message_event(7, is_private=True, is_group=False, chat=SimpleNamespace(bot=True, first_name="Yordamchi")))
+    assert cache.dialogs[-1001] == {"kind": "group", "title": "Guruh", "unread": 2}
+    assert cache.dialogs[7] == {"kind": "bot", "title": "Yordamchi", "unread": 1}
+    cache.on_new_message(message_event(-1001, out=True))
+    assert cache.dialogs[-1001]["unread"] == 0
+    cache.on_chat_action(SimpleNamespace(chat_id=-1001, new_title="Yangi nom", user_left=False, user_kicked=False, user_id=None))
+    assert cache.dialogs[-1001]["title"] == "Yangi nom"
+    cache.on_chat_action(SimpleNamespace(chat_id=-1001, new_title=None, user_left=True, user_kicked=False, user_id=bot.my_telegram_id))
+    assert -1001 not in cache.dialogs
+
+
+def test_titles_fetch_missing_once_and_stay_out_of_stats(fake_client, tmp_path):
+    fake_client.dialogs = [dialog(-1001, "Guruh", "group")]
+    fake_client.entities = {-1002: SimpleNamespace(title="Eski guruh"), 5: SimpleNamespace(first_name="Vali")}
+    cache = bot.DialogCache(str(tmp_path / "dialogs.json"))
+
+    async def main():
+        await cache.refresh()
+        first = await cache.titles([-1001, -1002, 5])
+        second = await cache.titles([-1002, 5])
+        return first, second
+
+    first, second = asyncio.run(main())
+    assert first == {-1001: "Guruh", -1002: "Eski guruh", 5: "Vali"}
+    assert second == {-1002: "Eski guruh", 5: "Vali"}
+    assert fake_client.entity_calls == [[-1002, 5]]
+    assert cache.stats()['groups'] == 1 and sum(cache.stats().values()) == 1
+
+
+def test_titles_fall_back_to_single_lookups(fake_client, tmp_path):
+    fake_client.entities = {-1002: SimpleNamespace(title="Eski guruh")}
+    cache = bot.DialogCache(str(tmp_path / "dialogs.json"))
+    titles = asyncio.run(cache.titles([-1002, -1003]))
+    assert titles == {-1002: "Eski guruh", -1003: None}
+    assert fake_client.entity_calls == [[-1002, -1003], -1002, -1003]
@@ -0,0 +1,106 @@
+# Circuit breaker, hedge va qayta urinishlar uchun testlar. gemini_attempt soxta funksiya bilan almashtiriladi.
+
+import asyncio
+import time
+
+import httpx
+import pytest
+
+import bot
+
+
+def test_circuit_breaker_opens_and_recovers():
+    breaker = bot.CircuitBreaker("test", threshold=2, reset_seconds=0.05)
+    breaker.record_failure()
+    assert breaker.state == "closed" and breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == "open" and not breaker.allow()
+    time.sleep(0.06)
+    assert breaker.state == "half-open"
+    assert breaker.allow()  # bitta sinov chaqiruvi
+    assert not breaker.allow()
+    breaker.record_success()
+    assert breaker.state == "closed" and breaker.allow()
+
+
+def test_circuit_breaker_failed_probe_reopens():
+    breaker = bot.CircuitBreaker("test", threshold=1, reset_seconds=0.05)
+    breaker.record_failure()
+    time.sleep(0.06)
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == "open"
+
+
+@pytest.fixture
+def gemini_env(monkeypatch):
+    monkeypatch.setattr(bot, "GEMINI_HEDGE", True)
+    monkeypatch.setattr(bot, "GEMINI_HEDGE_DEFAULT_DELAY", 0.02)
+    monkeypatch.setattr(bot, "GEMINI_HEDGE_MIN_SAMPLES", 10 ** 9)
+    monkeypatch.setattr(bot, "GEMINI_RETRY_BASE", 0.001)
+    monkeypatch.setattr(bot, "gemini_hedge_stats", {"fired": 0, "won": 0})
+    monkeypatch.setattr(bot, "limiter", bot.RateLimiter({"gemini": (1000, 100)}, idle_seconds=600))
+    return monkeypatch
+
+
+def fake_attempts(monkeypatch, *behaviours):
+    """gemini_attempt ni almashtiradi: n-chaqiruv behaviours[n] (kutish, natija yoki xato) bo'yicha ishlaydi."""
+    calls, cancelled = [], []
+
+    async def attempt(model_url, request_data, timeout):
+        delay, outcome = behaviours[min(len(calls), len(behaviours) - 1)]
+        calls.append(1)
+        try:
+            await asyncio.sleep(delay)
+        except asyncio.CancelledError:
+            cancelled.append(len(calls))
+            raise
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+    monkeypatch.setattr(bot, "gemini_attempt", attempt)
+    return calls, cancelled
+
+
+def test_hedge_wins_when_primary_is_slow(gemini_env):
+    calls, cancelled = fake_attempts(gemini_env, (1, "asosiy"), (0, "hedge"))
+
+    async def main():
+        result = await bot.hedged_gemini_call("url", {}, time.monotonic() + 5)
+        assert cancelled == [2]  # yutqazgan asosiy urinish qaytishdan oldin bekor qilinib kutilgan
+        return result
+
+    assert asyncio.run(main()) == "hedge"
+    assert bot.gemini_hedge_stats == {"fired": 1, "won": 1}
+
+
+def test_hedge_error_does_not_abort_primary(gemini_env):
+    fake_attempts(gemini_env, (0.1, "asosiy"), (0, bot.GeminiBlockedError("SAFETY")))
+    assert asyncio.run(bot.hedged_gemini_call("url", {}, time.monotonic() + 5)) == "asosiy"
+
+
+def test_hedge_prefers_non_retryable_error(gemini_env):
+    fake_attempts(gemini_env, (0.05, httpx.ConnectError("ulanish")), (0, bot.GeminiBlockedError("SAFETY")))
+    with pytest.raises(bot.GeminiBlockedError):
+        asyncio.run(bot.hedged_gemini_call("url", {}, time.monotonic() + 5))
+
+
+def test_hedge_skipped_without_token(gemini_env):
+    gemini_env.setattr(bot, "limiter", bot.RateLimiter({"gemini": (0.001, 1)}, idle_seconds=600))
+    bot.limiter.try_acquire("gemini")
+    calls, _ = fake_attempts(gemini_env, (0.05, "asosiy"))
+    assert asyncio.run(bot.hedged_gemini_call("url", {}, time.monotonic() + 5)) == "asosiy"
+    assert len(calls) == 1
+
+
+def test_retries_take_limiter_tokens(gemini_env):
+    """Har bir qayta urinish token oladi: token tugagach oxirgi xato ko'tariladi."""
+    gemini_env.setattr(bot, "GEMINI_HEDGE", False)
+    gemini_env.setattr(bot, "GEMINI_RETRIES", 5)
+    gemini_env.setattr(bot, "limiter", bot.RateLimiter({"gemini": (0.001, 2)}, idle_seconds=600))
+    calls, _ = fake_attempts(gemini_env, (0, httpx.ConnectError("ulanish")))
+    breaker = bot.CircuitBreaker("test", threshold=100, reset_seconds=60)
+    with pytest.raises(httpx.ConnectError):
+        asyncio.run(bot.call_gemini_resilient(breaker, "url", {}, time.monotonic() + 5))
+    assert len(calls) == 3  # birinchi urinish (token chaqiruvchida) + ikkita tokenli qayta urinish
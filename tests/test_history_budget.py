@@ -0,0 +1,87 @@
+# Tarix token byudjeti va xulosalar uchun testlar.
+
+import asyncio
+
+import pytest
+
+import bot
+
+
+def turn(role, index):
+    return {"role": role, "parts": [{"text": f"{index:02d}" + "x" * 38}]}  # 15 token
+
+
+@pytest.fixture
+def cache(monkeypatch, tmp_path):
+    monkeypatch.setattr(bot, "CONTEXT_TOKEN_BUDGET", 60)
+    monkeypatch.setattr(bot, "HISTORY_MAX_TURNS", 30)
+    store = bot.SqliteHistoryStore(str(tmp_path / "history.db"), 30)
+    cache = bot.ChatHistoryCache(store, 100, 600, 60)
+    yield cache
+    store.close()
+
+
+def test_trim_to_budget_keeps_newest_turns():
+    history = [turn("user", 0), turn("model", 1), turn("user", 2)]
+    assert bot.trim_to_budget(history, 10, 30) == (history[1:], history[:1])
+    assert bot.trim_to_budget(history, 1, 1000) == (history[2:], history[:2])
+    assert bot.trim_to_budget(history, 10, 1) == (history[2:], history[:2])  # oxirgi navbat doim qoladi
+
+
+def test_build_context_subtracts_summary_and_starts_with_user(monkeypatch):
+    monkeypatch.setattr(bot, "CONTEXT_TOKEN_BUDGET", 60)
+    history = [turn("user", 0), turn("model", 1), turn("user", 2), turn("model", 3)]
+    assert bot.build_context(history, "") == history
+    assert bot.build_context(history, "s" * 60) == history[2:]  # 16 token xulosa: ikki navbat sig'adi
+    assert bot.build_context(history[1:], "") == history[2:]  # kontekst model navbati bilan boshlanmaydi
+
+
+def test_append_trims_to_budget_left_after_summary(cache):
+    key = (-1001, 5, False)
+
+    async def main():
+        await cache.append(*key, [turn("user", 0), turn("model", 1)], 1.0)
+        assert await cache.set_summary(key, "s" * 60, cache.generation(key))
+        await cache.append(*key, [turn("user", 2), turn("model", 3)], 2.0)
+        history, _ = await cache.get(*key)
+        context, summary = await cache.get_context(*key)
+        return history, context, summary
+
+    history, context, summary = asyncio.run(main())
+    assert history == context == [turn("user", 2), turn("model", 3)]  # byudjet 60 - 16 = 44: ikki navbat
+    assert summary == "s" * 60
+    assert cache.summary_backlog[key] == [turn("user", 0), turn("model", 1)]
+    assert cache.summary_needed.is_set()
+
+
+def test_longer_summary_moves_overflow_to_backlog(cache):
+    key = (-1001, 5, False)
+
+    async def main():
+        await cache.append(*key, [turn("user", index) for index in range(4)], 1.0)
+        assert key not in cache.summary_backlog
+        assert await cache.set_summary(key, "s" * 100, cache.generation(key))  # 26 token
+        await cache.flush()
+        return cache.store.load(key)
+
+    history, _, summary = asyncio.run(main())
+    assert history == [turn("user", 2), turn("user", 3)]
+    assert summary == "s" * 100
+    assert cache.summary_backlog[key] == [turn("user", 0), turn("user", 1)]
+
+
+def test_summary_for_cleared_history_is_dropped(cache):
+    key = (-1001, 5, False)
+
+    async def main():
+        await cache.append(*key, [turn("user", 0)], 1.0)
+        generation = cache.generation(key)
+        await cache.discard(*key)
+        assert not await cache.set_summary(key, "eski xulosa", generation)
+        await cache.append(*key, [turn("user", 1)], 2.0)
+        generation = cache.generation(key)
+        await cache.purge_chat(-1001)
+        assert not await cache.set_summary(key, "eski xulosa", generation)
+        return await cache.get_summary(key)
+
+    assert asyncio.run(main()) == ""
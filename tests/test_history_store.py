@@ -0,0 +1,64 @@
+# SQLite suhbat tarixi ombori va eski JSON fayllardan ko'chirish uchun testlar.
+
+import json
+import os
+
+import pytest
+
+import bot
+
+
+def turn(role, text):
+    return {"role": role, "parts": [{"text": text}]}
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = bot.SqliteHistoryStore(str(tmp_path / "history.db"), max_turns=4)
+    yield store
+    store.close()
+
+
+def test_sqlite_store_roundtrip(store):
+    key = (-1001, 5, False)
+    assert store.load(key) == ([], 0, "")
+    history = [turn("user", "salom"), turn("model", "va alaykum")]
+    assert store.write_batch([(key, (history, history, 100.0, "xulosa"))]) == []
+    assert store.load(key) == (history, 100.0, "xulosa")
+    assert store.load((-1001, 5, True)) == ([], 0, "")
+
+
+def test_sqlite_store_appends_and_keeps_last_turns(store):
+    key = (7, 7, True)
+    history = []
+    for index in range(3):
+        new_turns = [turn("user", f"savol {index}"), turn("model", f"javob {index}")]
+        history = (history + new_turns)[-4:]
+        store.write_batch([(key, (history, new_turns, float(index), ""))])
+    assert store.load(key) == (history, 2.0, "")
+    assert [row[0] for row in store._conn().execute("SELECT COUNT(*) FROM turns")] == [4]
+
+
+def test_sqlite_store_delete_and_purge_chat(store):
+    keys = [(-1001, 5, False), (-1001, 6, False), (-1002, 5, False)]
+    store.write_batch([(key, ([turn("user", "x")], [turn("user", "x")], 1.0, "")) for key in keys])
+    assert store.delete(keys[0])
+    assert not store.delete(keys[0])
+    assert store.purge_chat(-1001) == 1
+    assert store.load(keys[1])[0] == []
+    assert store.load(keys[2])[0] == [turn("user", "x")]
+    assert [row[0] for row in store._conn().execute("SELECT COUNT(*) FROM turns")] == [1]
+
+
+def test_migrate_json_histories_runs_once(store, tmp_path, monkeypatch):
+    monkeypatch.setattr(bot, "CHAT_HISTORY_DIR", str(tmp_path / "chat_histories"))
+    history = [turn("user", "eski"), turn("model", "javob")]
+    for key in [(9, 9, True), (-1001, 5, False)]:
+        path = bot.get_chat_history_file_path(*key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({"history": history, "last_activity": 50.0}, f)
+    assert bot.migrate_json_histories(store) == 2
+    assert store.load((-1001, 5, False))[0] == history
+    assert store.load((9, 9, True))[:2] == (history, 50.0)
+    assert bot.migrate_json_histories(store) == 0
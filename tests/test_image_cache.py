@@ -0,0 +1,99 @@
+# Rasm disk keshi va build_cached_image uchun testlar. Yuklab olish va qayta siqish soxta funksiyalar bilan almashtiriladi.
+
+import asyncio
+import concurrent.futures
+import os
+import shutil
+
+import pytest
+
+import bot
+
+PNG = b"\x89PNG\r\n\x1a\n" + b"\0" * 100
+
+
+def write_file(path, data):
+    with open(path, 'wb') as f:
+        f.write(data)
+    return path
+
+
+def test_put_and_get(tmp_path):
+    cache = bot.ImageDiskCache(str(tmp_path / "cache"), 10 ** 6, "jpg")
+    assert cache.get(("mushuk", "flux")) is None
+    path = cache.put(("mushuk", "flux"), write_file(tmp_path / "a", b"x" * 10))
+    assert path.endswith(".jpg") and cache.get(("mushuk", "flux")) == path
+    png_path = cache.put(("it", "flux"), write_file(tmp_path / "b", PNG), "png")
+    assert png_path.endswith(".png") and cache.get(("it", "flux")) == png_path
+    assert cache.stats() == {"hits": 2, "misses": 1, "size": 2, "bytes": 10 + len(PNG)}
+
+
+def test_evicts_least_recently_used(tmp_path):
+    cache = bot.ImageDiskCache(str(tmp_path / "cache"), 350, "jpg")
+    paths = []
+    for index in range(3):
+        paths.append(cache.put(("rasm", index), write_file(tmp_path / str(index), b"x" * 100)))
+        os.utime(paths[-1], (index, index))
+    os.utime(paths[0], (10, 10))  # get() dagi kabi: yaqinda ishlatilgan
+    paths.append(cache.put(("rasm", 3), write_file(tmp_path / "3", b"x" * 100)))
+    assert [os.path.exists(path) for path in paths] == [True, False, True, True]
+    assert cache.stats()["bytes"] == 300
+
+
+@pytest.fixture
+def image_env(monkeypatch, tmp_path):
+    monkeypatch.setattr(bot, "image_disk_cache", bot.ImageDiskCache(str(tmp_path / "cache"), 10 ** 6, "jpg"))
+    monkeypatch.setattr(bot, "IMAGE_FORMAT", "JPEG")
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    monkeypatch.setattr(bot, "get_image_executor", lambda: executor)
+
+    def download(data):
+        async def download_image_from_pollinations(prompt):
+            fd, path = bot.image_disk_cache.new_temp_file()
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            return path
+        monkeypatch.setattr(bot, "download_image_from_pollinations", download_image_from_pollinations)
+
+    yield monkeypatch, download
+    executor.shutdown()
+
+
+def test_build_cached_image_recompresses(image_env):
+    monkeypatch, download = image_env
+    download(PNG)
+
+    def recompress_image(src_path, image_format, max_side, quality):
+        return shutil.copy(src_path, f"{src_path}.jpg")
+
+    monkeypatch.setattr(bot, "recompress_image", recompress_image)
+    path = asyncio.run(bot.build_cached_image(("mushuk", "flux")))
+    assert path.endswith(".jpg") and bot.image_disk_cache.get(("mushuk", "flux")) == path
+    assert os.listdir(os.path.join(bot.image_disk_cache.root_dir, "tmp")) == []
+
+
+def test_build_cached_image_keeps_original_format_on_failure(image_env):
+    monkeypatch, download = image_env
+    download(PNG)
+
+    def recompress_image(src_path, image_format, max_side, quality):
+        raise OSError("Pillow yo'q")
+
+    monkeypatch.setattr(bot, "recompress_image", recompress_image)
+    path = asyncio.run(bot.build_cached_image(("mushuk", "flux")))
+    assert path.endswith(".png")
+    with open(path, 'rb') as f:
+        assert f.read() == PNG
+    assert bot.image_disk_cache.get(("mushuk", "flux")) == path
+
+
+def test_build_cached_image_rejects_non_image(image_env):
+    monkeypatch, download = image_env
+    download(b"<html>xato</html>")
+
+    def recompress_image(src_path, image_format, max_side, quality):
+        raise OSError("rasm emas")
+
+    monkeypatch.setattr(bot, "recompress_image", recompress_image)
+    assert asyncio.run(bot.build_cached_image(("mushuk", "flux"))) is None
+    assert os.listdir(os.path.join(bot.image_disk_cache.root_dir, "tmp")) == []
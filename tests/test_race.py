@@ -0,0 +1,141 @@
+# Detektiv va Gemini poygasi uchun testlar. Telegram chaqiruvlari soxta funksiyalar bilan almashtiriladi.
+
+import asyncio
+import contextlib
+from types import SimpleNamespace
+
+import pytest
+
+import bot
+
+
+def make_event(chat_id=-1001, sender_id=5, message_id=11, reply_to_msg_id=10):
+    return SimpleNamespace(chat_id=chat_id, sender_id=sender_id, is_private=False,
+                           message=SimpleNamespace(id=message_id, reply_to_msg_id=reply_to_msg_id))
+
+
+def test_single_flight_cancel_waits_for_cleanup():
+    """Oxirgi kutuvchi bekor qilinganda umumiy vazifa bekor qilinadi va uning finally bloki do() qaytguncha bajariladi."""
+    cleaned = []
+
+    async def slow():
+        try:
+            await asyncio.sleep(10)
+        finally:
+            await asyncio.sleep(0.01)
+            cleaned.append(1)
+
+    async def main():
+        flight = bot.SingleFlight()
+        waiter = asyncio.create_task(flight.do("k", slow))
+        await asyncio.sleep(0.01)
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        assert cleaned == [1]
+        assert flight.stats()["in_flight"] == 0
+
+    asyncio.run(main())
+
+
+@pytest.fixture
+def race_env(monkeypatch):
+    monkeypatch.setattr(bot, "AUTO_REPLY_RACE", True)
+    monkeypatch.setattr(bot, "AUTO_REPLY_PREFERENCE_WINDOW", 0.1)
+    monkeypatch.setattr(bot, "DETECTIVE_LIVE_FALLBACK", True)
+    sent, remembered = [], []
+
+    async def index_lookup(text):
+        return []
+
+    async def send_long_message(chat_id, text, reply_to=None, parse_mode="markdown"):
+        sent.append(("gemini", text))
+        return True
+
+    async def telegram_send(coro_factory):
+        sent.append(("detective", None))
+        return True
+
+    async def remember(chat_id, sender_id, is_private, prompt, response_text):
+        remembered.append(response_text)
+
+    monkeypatch.setattr(bot.reply_index, "lookup", index_lookup)
+    monkeypatch.setattr(bot, "send_long_message", send_long_message)
+    monkeypatch.setattr(bot, "telegram_send", telegram_send)
+    monkeypatch.setattr(bot, "remember_gemini_exchange", remember)
+    monkeypatch.setattr(bot, "client", SimpleNamespace(action=lambda chat_id, action: contextlib.nullcontext(),
+                                                         send_message=lambda *args, **kwargs: None))
+    return monkeypatch, sent, remembered
+
+
+def fake_race(monkeypatch, detective_delay, detective_result, gemini_delay, gemini_result):
+    started = []
+
+    async def detective(prompt):
+        started.append("detective")
+        await asyncio.sleep(detective_delay)
+        return detective_result
+
+    async def gemini(event, prompt):
+        started.append("gemini")
+        await asyncio.sleep(gemini_delay)
+        if isinstance(gemini_result, Exception):
+            raise gemini_result
+        return gemini_result
+
+    monkeypatch.setattr(bot, "search_for_reply", detective)
+    monkeypatch.setattr(bot, "auto_reply_gemini", gemini)
+    return started
+
+
+def test_race_index_hit_skips_gemini(race_env):
+    monkeypatch, sent, remembered = race_env
+
+    async def index_lookup(text):
+        return ["indeksdan"]
+
+    monkeypatch.setattr(bot.reply_index, "lookup", index_lookup)
+    started = fake_race(monkeypatch, 0, [], 0, "gemini")
+    assert asyncio.run(bot.race_auto_reply(make_event(), "salom")) == ("detective", ["indeksdan"])
+    assert started == []
+
+
+def test_race_detective_in_window_beats_gemini(race_env):
+    monkeypatch, sent, remembered = race_env
+    fake_race(monkeypatch, 0.05, ["topildi"], 0, "gemini javobi")
+    asyncio.run(bot.answer_auto_reply(make_event(), "salom", 11))
+    assert sent == [("detective", None)]
+    assert remembered == []  # yuborilmagan Gemini javobi tarixga yozilmaydi
+
+
+def test_race_gemini_answer_is_remembered_after_send(race_env):
+    monkeypatch, sent, remembered = race_env
+    fake_race(monkeypatch, 1, ["kech"], 0, "gemini javobi")
+    asyncio.run(bot.answer_auto_reply(make_event(), "salom", 11))
+    assert sent == [("gemini", "gemini javobi")]
+    assert remembered == ["gemini javobi"]
+
+
+def test_race_unsent_gemini_answer_is_not_remembered(race_env):
+    monkeypatch, sent, remembered = race_env
+
+    async def send_long_message(chat_id, text, reply_to=None, parse_mode="markdown"):
+        return False
+
+    monkeypatch.setattr(bot, "send_long_message", send_long_message)
+    fake_race(monkeypatch, 1, [], 0, "gemini javobi")
+    asyncio.run(bot.answer_auto_reply(make_event(), "salom", 11))
+    assert remembered == []
+
+
+def test_race_gemini_error_waits_for_detective(race_env):
+    monkeypatch, sent, remembered = race_env
+    fake_race(monkeypatch, 0.2, ["topildi"], 0, bot.CircuitOpenError("gemini"))
+    assert asyncio.run(bot.race_auto_reply(make_event(), "salom")) == ("detective", ["topildi"])
+
+
+def test_race_rate_limited_gemini_sends_nothing(race_env):
+    monkeypatch, sent, remembered = race_env
+    fake_race(monkeypatch, 0, [], 0, bot.RateLimitedError("gemini"))
+    asyncio.run(bot.answer_auto_reply(make_event(), "salom", 11))
+    assert sent == [] and remembered == []
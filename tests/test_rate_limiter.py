@@ -0,0 +1,50 @@
+# Token bucket va RateLimiter uchun testlar.
+
+import asyncio
+import time
+
+import pytest
+
+import bot
+
+
+def test_token_bucket_refills_at_rate():
+    bucket = bot.TokenBucket(rate=1, capacity=2, now=0)
+    for _ in range(2):
+        assert bucket.wait_time(0) == 0
+        bucket.tokens -= 1
+    assert bucket.wait_time(0) == pytest.approx(1.0)
+    assert bucket.wait_time(0.5) == pytest.approx(0.5)
+    assert bucket.wait_time(1.0) == 0
+
+
+def test_rate_limiter_burst_then_reject():
+    limiter = bot.RateLimiter({"x": (1, 2)}, idle_seconds=600)
+    assert limiter.try_acquire("x", "a")
+    assert limiter.try_acquire("x", "a")
+    assert not limiter.try_acquire("x", "a")
+    assert limiter.try_acquire("x", "b")  # kalitlar alohida bucketlarga ega
+    assert limiter.stats()["x"]["rejected"] == 1
+
+
+def test_rate_limiter_acquire_waits_within_max_wait():
+    async def main():
+        limiter = bot.RateLimiter({"x": (20, 1)}, idle_seconds=600)
+        assert await limiter.acquire("x")
+        assert not await limiter.acquire("x", max_wait=0.01)
+        start = time.monotonic()
+        assert await limiter.acquire("x", max_wait=0.2)
+        assert time.monotonic() - start >= 0.03
+
+    asyncio.run(main())
+
+
+def test_rate_limiter_penalize_blocks_bucket():
+    async def main():
+        limiter = bot.RateLimiter({"x": (100, 5)}, idle_seconds=600)
+        limiter.penalize("x", 5)
+        assert not limiter.try_acquire("x")
+        assert not await limiter.acquire("x", max_wait=1)
+        assert limiter.stats()["x"]["penalties"] == 1
+
+    asyncio.run(main())
@@ -0,0 +1,86 @@
+# ReplyIndex uchun testlar: oqimdan juftliklarni yig'ish, qidiruv, cheklov va fon to'ldirish.
+
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import bot
+
+ME = bot.my_telegram_id
+
+
+@pytest.fixture
+def index(tmp_path):
+    index = bot.ReplyIndex(str(tmp_path / "index.db"), max_pairs=100, recent_size=10)
+    yield index
+    asyncio.run(index.close())
+
+
+def test_observe_indexes_replies_between_others(index):
+    async def main():
+        index.observe(-1001, 1, "Qayerda uchrashamiz?", 5, None)
+        index.observe(-1001, 2, "Bozor yonida!!!", 6, 1)
+        index.observe(-1001, 3, "Menga yozilgan savol", 7, None)
+        index.observe(-1001, 4, "o'z javobim", ME, 3)
+        index.observe(-1001, 5, "Menga reply", 8, 4)
+        await index.flush()
+        return await index.lookup("bozor yoniiiida"), await index.lookup("o'z javobim"), await index.lookup("menga reply")
+
+    assert asyncio.run(main()) == (["Qayerda uchrashamiz?"], [], [])
+
+
+def test_lookup_falls_back_to_all_terms(index):
+    async def main():
+        index.observe(-1001, 1, "savol", 5, None)
+        index.observe(-1001, 2, "ertaga soat beshda kinoga boramiz", 6, 1)
+        await index.flush()
+        return await index.lookup("kinoga ertaga"), await index.lookup("kinoga bugun")
+
+    assert asyncio.run(main()) == (["savol"], [])
+
+
+def test_recent_window_and_pair_limit(tmp_path):
+    index = bot.ReplyIndex(str(tmp_path / "index.db"), max_pairs=2, recent_size=2)
+    words = ["olma", "nok", "anor", "uzum"]
+
+    async def main():
+        index.observe(-1001, 1, "birinchi", 5, None)
+        index.observe(-1001, 2, "ikkinchi", 5, None)
+        index.observe(-1001, 3, "olma", 6, 1)  # 1-xabar oynadan chiqqan
+        for msg_id, word in enumerate(words[1:], start=4):
+            index.observe(-1001, msg_id, word, 6, msg_id - 1)
+        await index.flush()
+        return [await index.lookup(word) for word in words]
+
+    try:
+        replies = asyncio.run(main())
+    finally:
+        asyncio.run(index.close())
+    assert replies == [[], [], ["nok"], ["anor"]]  # eng eski juftlik (nok -> olma) max_pairs dan oshgani uchun o'chirilgan
+
+
+def test_backfill_pages_upward_from_marker(index, monkeypatch):
+    messages = [SimpleNamespace(id=msg_id, text=f"xabar {msg_id}", sender_id=5 + msg_id % 2,
+                                reply_to_msg_id=msg_id - 1 if msg_id % 2 == 0 else None) for msg_id in range(1, 9)]
+    requests = []
+
+    async def iter_messages(chat_id, limit, min_id, reverse, wait_time):
+        requests.append((min_id, reverse))
+        selected = [m for m in messages if m.id > min_id]
+        for message in (selected[:limit] if reverse else selected[::-1][:limit]):
+            yield message
+
+    monkeypatch.setattr(bot, "client", SimpleNamespace(iter_messages=iter_messages))
+    monkeypatch.setattr(bot, "REPLY_INDEX_BACKFILL_LIMIT", 4)
+
+    async def main():
+        first = await index.backfill_chat(-1001)  # oxirgi 4 ta: 5..8
+        second = await index.backfill_chat(-1001)  # 8 dan yuqorisi yo'q
+        messages.extend(SimpleNamespace(id=msg_id, text=f"xabar {msg_id}", sender_id=6, reply_to_msg_id=msg_id - 1) for msg_id in range(9, 15))
+        third = await index.backfill_chat(-1001)  # 9..12; 9 ning ota xabari partiyada yo'q
+        fourth = await index.backfill_chat(-1001)
+        return first, second, third, fourth, await index.lookup("xabar 14")
+
+    assert asyncio.run(main()) == (2, 0, 3, 1, ["xabar 13"])
+    assert requests == [(0, False), (8, True), (8, True), (12, True)]
@@ -0,0 +1,102 @@
+# WorkScheduler uchun testlar: lane ustuvorligi, chat tartibi va navbat to'lganda tashlash.
+
+import asyncio
+
+import bot
+
+
+def test_scheduler_runs_higher_lane_first():
+    order = []
+
+    async def main():
+        scheduler = bot.WorkScheduler([("high", 1, 10, None, False), ("low", 1, 10, None, False)], max_concurrency=1)
+        gate = asyncio.Event()
+
+        async def job(name, wait=False):
+            if wait:
+                await gate.wait()
+            order.append(name)
+
+        scheduler.submit("low", 1, lambda: job("blocker", wait=True))
+        scheduler.submit("low", 2, lambda: job("low"))
+        scheduler.submit("high", 3, lambda: job("high"))
+        await asyncio.sleep(0.01)
+        gate.set()
+        while scheduler.active:
+            await asyncio.sleep(0.01)
+        await scheduler.close()
+
+    asyncio.run(main())
+    assert order == ["blocker", "high", "low"]
+
+
+def test_scheduler_keeps_chat_order():
+    """Lane concurrency 2 bo'lsa ham bir chatdagi ishlar ketma-ket va kelgan tartibda bajariladi."""
+    events = []
+
+    async def main():
+        scheduler = bot.WorkScheduler([("auto", 2, 10, None, False)], max_concurrency=4)
+
+        async def job(index):
+            events.append(("start", index))
+            await asyncio.sleep(0.01)
+            events.append(("end", index))
+
+        for index in range(3):
+            scheduler.submit("auto", 1, lambda index=index: job(index))
+        while scheduler.active:
+            await asyncio.sleep(0.01)
+        await scheduler.close()
+
+    asyncio.run(main())
+    assert events == [("start", 0), ("end", 0), ("start", 1), ("end", 1), ("start", 2), ("end", 2)]
+
+
+def test_scheduler_sheds_oldest_when_full():
+    ran = []
+
+    async def main():
+        scheduler = bot.WorkScheduler([("auto", 1, 1, None, True)], max_concurrency=1)
+        gate = asyncio.Event()
+
+        async def job(name, wait=False):
+            if wait:
+                await gate.wait()
+            ran.append(name)
+
+        scheduler.submit("auto", 1, lambda: job("blocker", wait=True))
+        assert scheduler.submit("auto", 2, lambda: job("old"))
+        assert scheduler.submit("auto", 3, lambda: job("new"))
+        gate.set()
+        while scheduler.active:
+            await asyncio.sleep(0.01)
+        assert scheduler.stats()["auto"]["dropped"] == 1
+        await scheduler.close()
+
+    asyncio.run(main())
+    assert ran == ["blocker", "new"]
+
+
+def test_scheduler_drops_stale_jobs():
+    ran = []
+
+    async def main():
+        scheduler = bot.WorkScheduler([("auto", 1, 10, 0.02, False)], max_concurrency=1)
+        gate = asyncio.Event()
+
+        async def job(name, wait=False):
+            if wait:
+                await gate.wait()
+            ran.append(name)
+
+        scheduler.submit("auto", 1, lambda: job("blocker", wait=True))
+        scheduler.submit("auto", 2, lambda: job("stale"))
+        await asyncio.sleep(0.05)
+        gate.set()
+        while scheduler.active:
+            await asyncio.sleep(0.01)
+        assert scheduler.stats()["auto"]["dropped"] == 1
+        await scheduler.close()
+
+    asyncio.run(main())
+    assert ran == ["blocker"]
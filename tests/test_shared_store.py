@@ -0,0 +1,81 @@
+# Akkauntlar orasidagi umumiy ombor uchun testlar. Akkauntlar runtime.py dagi kabi alohida bot modullari sifatida yuklanadi.
+
+import asyncio
+import json
+import sys
+
+import pytest
+
+import bot
+import runtime
+
+
+def test_kv_and_expiry(tmp_path):
+    first, second = bot.SharedStore(str(tmp_path / "shared.db")), bot.SharedStore(str(tmp_path / "shared.db"))
+    first.set("kalit", {"javob": "salom"}, ttl=60)
+    first.set("eskirgan", "x", ttl=-1)
+    assert second.get("kalit") == {"javob": "salom"}
+    assert second.get("eskirgan") is None
+    second.purge_expired()
+    assert [row[0] for row in first._conn().execute("SELECT key FROM kv")] == ["kalit"]
+
+
+def test_bucket_is_shared_between_stores(tmp_path):
+    first, second = bot.SharedStore(str(tmp_path / "shared.db")), bot.SharedStore(str(tmp_path / "shared.db"))
+    assert first.reserve("gemini", 0.001, 2, 0) == 0
+    assert second.reserve("gemini", 0.001, 2, 0) == 0
+    assert first.reserve("gemini", 0.001, 2, 0) is None
+    second.penalize("other", 1, 5, 60)
+    assert first.reserve("other", 1, 5, 10) is None
+
+
+@pytest.fixture
+def accounts(tmp_path, monkeypatch):
+    """Umumiy omborli ikki akkaunt va boshqa personali uchinchisi; Gemini chaqiruvlari sanaladi."""
+    for name, role in (("persona_a.json", "yordamchi"), ("persona_b.json", "shoir")):
+        (tmp_path / name).write_text(json.dumps({"persona": {"role": role}}), encoding='utf-8')
+    config = {"shared_store": str(tmp_path / "shared.db"), "data_dir": str(tmp_path / "accounts")}
+    specs = [("bir", 11, "persona_a.json"), ("ikki", 12, "persona_a.json"), ("uch", 13, "persona_b.json")]
+    modules, calls = [], []
+    for name, account_id, persona in specs:
+        account = {"name": name, "api_id": 1, "api_hash": "test", "my_telegram_id": account_id,
+                   "session": str(tmp_path / name), "env": {"PERSONA_FILE": str(tmp_path / persona)}}
+        module = runtime.load_account_module(account, config)
+
+        async def generate(context, prompt, max_wait=None, summary="", name=name):
+            calls.append(name)
+            return f"{name} javobi"
+
+        monkeypatch.setattr(module, "generate_gemini_text", generate)
+        monkeypatch.setitem(sys.modules, module.__name__, module)
+        modules.append(module)
+    yield modules, calls
+    for module in modules:
+        sys.modules.pop(module.__name__, None)
+
+
+def test_two_accounts_share_one_answer(accounts):
+    (first, second, other), calls = accounts
+
+    async def main():
+        return (await first.generate_shared_gemini_text([], "Salom, qalaysan?", 5),
+                await second.generate_shared_gemini_text([], "salom qalaysan", 5),
+                await other.generate_shared_gemini_text([], "salom qalaysan", 5))
+
+    assert asyncio.run(main()) == ("bir javobi", "bir javobi", "uch javobi")
+    assert calls == ["bir", "uch"]
+    assert first.shared_answer_key("Salom, qalaysan?") == second.shared_answer_key("salom qalaysan")
+    assert first.shared_answer_key("salom") != other.shared_answer_key("salom")
+
+
+def test_requests_with_history_are_not_shared(accounts):
+    (first, second, _), calls = accounts
+    context = [first.gemini_user_turn("oldingi savol")]
+
+    async def main():
+        await first.generate_shared_gemini_text([], "salom", 5)
+        await second.generate_shared_gemini_text(context, "salom", 5)
+        await second.generate_shared_gemini_text([], "salom", 5, summary="avvalgi suhbat")
+
+    asyncio.run(main())
+    assert calls == ["bir", "ikki", "ikki"]
@@ -0,0 +1,74 @@
+# Gemini oqimini xabar tahrirlari orqali ko'rsatish uchun testlar. Oqim va Telegram chaqiruvlari soxta.
+
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import bot
+
+
+class FakeMessage:
+    def __init__(self, name, log):
+        self.name, self.log = name, log
+
+    async def edit(self, text, parse_mode="markdown"):
+        self.log.append((self.name, text))
+
+
+@pytest.fixture
+def stream_env(monkeypatch):
+    env = SimpleNamespace(log=[], chunks=[], sent=0, send_ok=True, error=None)
+    monkeypatch.setattr(bot, "MAX_MESSAGE_LENGTH", 30)
+    monkeypatch.setattr(bot, "GEMINI_STREAM_EDIT_INTERVAL", 0)
+
+    async def stream_gemini_response(prompt, chat_id, sender_id, is_private):
+        for chunk in env.chunks:
+            yield chunk
+        if env.error:
+            raise env.error
+
+    async def telegram_send(coro_factory):
+        if not env.send_ok:
+            return None
+        env.sent += 1
+        return FakeMessage(f"xabar{env.sent}", env.log)
+
+    monkeypatch.setattr(bot, "stream_gemini_response", stream_gemini_response)
+    monkeypatch.setattr(bot, "telegram_send", telegram_send)
+    monkeypatch.setattr(bot, "client", SimpleNamespace(send_message=lambda *args, **kwargs: None))
+    return env
+
+
+def run_stream(env):
+    event = SimpleNamespace(chat_id=-1001, sender_id=5, is_private=False, message=SimpleNamespace(id=11))
+    asyncio.run(bot.stream_gemini_to_message(event, "savol", FakeMessage("xabar0", env.log)))
+
+
+def test_progressive_edits_end_with_final_text(stream_env):
+    stream_env.chunks = ["Salom", " dunyo"]
+    run_stream(stream_env)
+    assert stream_env.log == [("xabar0", "Salom ▌"), ("xabar0", "Salom dunyo ▌"), ("xabar0", "Salom dunyo")]
+
+
+def test_long_answer_rolls_over_to_new_message(stream_env):
+    stream_env.chunks = ["birinchi qator\n", "ikkinchi qatorning davomi"]
+    run_stream(stream_env)
+    assert stream_env.log == [("xabar0", "birinchi qator\n ▌"), ("xabar0", "birinchi qator"),
+                              ("xabar1", "ikkinchi qatorning davomi ▌"), ("xabar1", "ikkinchi qatorning davomi")]
+
+
+def test_rollover_without_new_message_stops(stream_env):
+    stream_env.chunks = ["birinchi qator\n", "ikkinchi qatorning davomi", " yana"]
+    stream_env.send_ok = False
+    run_stream(stream_env)
+    # Yakunlangan xabar davom matni bilan qayta tahrirlanmaydi
+    assert stream_env.log == [("xabar0", "birinchi qator\n ▌"), ("xabar0", "birinchi qator")]
+
+
+def test_error_is_appended_to_partial_text(stream_env, monkeypatch):
+    stream_env.chunks = ["Qisman"]
+    stream_env.error = bot.GeminiBlockedError("SAFETY")
+    monkeypatch.setattr(bot, "MAX_MESSAGE_LENGTH", 200)
+    run_stream(stream_env)
+    assert stream_env.log[-1] == ("xabar0", "Qisman\n\nAI javob berishda qiyinchilikka uchradi. Sabab: SAFETY")
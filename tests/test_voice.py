@@ -0,0 +1,60 @@
+# Ovozli xabarlar quvuri uchun testlar: yuklab olish va jarayonlar puli. Telegram klienti soxta.
+
+import asyncio
+import concurrent.futures
+import os
+from types import SimpleNamespace
+
+import pytest
+
+import bot
+import media_workers
+
+
+def fake_download(monkeypatch, chunks, error=None):
+    async def iter_download(media):
+        for chunk in chunks:
+            yield chunk
+        if error:
+            raise error
+
+    monkeypatch.setattr(bot, "client", SimpleNamespace(iter_download=iter_download))
+
+
+def test_download_writes_all_chunks(monkeypatch):
+    fake_download(monkeypatch, [b"Ogg", b"S\0", b"ovoz"])
+    path = asyncio.run(bot.voice_pipeline.download(SimpleNamespace(message=SimpleNamespace(media=object()))))
+    try:
+        with open(path, 'rb') as f:
+            assert f.read() == b"OggS\0ovoz"
+    finally:
+        os.remove(path)
+
+
+def test_download_removes_partial_file_on_error(monkeypatch, tmp_path):
+    monkeypatch.setattr(bot.tempfile, "tempdir", str(tmp_path))
+    fake_download(monkeypatch, [b"OggS"], ConnectionError("uzildi"))
+    with pytest.raises(ConnectionError):
+        asyncio.run(bot.voice_pipeline.download(SimpleNamespace(message=SimpleNamespace(media=object()))))
+    assert os.listdir(tmp_path) == []
+
+
+def test_process_pool_when_imported():
+    """bot modul sifatida yuklanganda (start.py, runtime.py) haqiqiy jarayonlar puli yaratiladi."""
+    pool = bot.create_process_pool(1)
+    try:
+        assert isinstance(pool, concurrent.futures.ProcessPoolExecutor)
+        assert pool._mp_context.get_start_method() in ("forkserver", "spawn")
+    finally:
+        pool.shutdown()
+
+
+def test_thread_pool_when_run_as_script(monkeypatch):
+    monkeypatch.setitem(bot.create_process_pool.__globals__, "__name__", "__main__")
+    pool = bot.create_process_pool(1)
+    pool.shutdown()
+    assert isinstance(pool, concurrent.futures.ThreadPoolExecutor)
+
+
+def test_media_workers_import_has_no_side_effects():
+    assert [name for name in vars(media_workers) if not name.startswith("__")] == ["recompress_image", "convert_voice"]